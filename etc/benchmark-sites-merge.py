@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+This script compares the engines that `pheweb sites` can use to merge `parsed/*` into `sites-unannotated.tsv`.
+It makes a temporary data_dir full of random parsed files, runs each engine on it, and checks that they agree.
+
+    ./etc/benchmark-sites-merge.py --num-phenos=1000 --num-variants=20000 --fan-in=8 --fan-in=256
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+def make_data_dir(data_dir, num_phenos, num_variants, seed):
+    from pheweb.file_utils import VariantFileWriter, get_pheno_filepath
+
+    rng = random.Random(seed)
+    # Phenotypes share most of their variants, like they would if they came from the same imputation.
+    all_variants = sorted(
+        set(
+            (
+                rng.randrange(1, 23),
+                rng.randrange(1, 250_000_000),
+                "A",
+                rng.choice("CGT"),
+            )
+            for _ in range(num_variants * 2)
+        )
+    )
+    phenolist = []
+    for i in range(num_phenos):
+        phenocode = "pheno{}".format(i)
+        phenolist.append({"phenocode": phenocode, "assoc_files": ["/dev/null"]})
+        with VariantFileWriter(
+            get_pheno_filepath("parsed", phenocode, must_exist=False), use_gzip=False
+        ) as writer:
+            for chrom, pos, ref, alt in all_variants:
+                if rng.random() < 0.5:
+                    writer.write(
+                        {
+                            "chrom": str(chrom),
+                            "pos": pos,
+                            "ref": ref,
+                            "alt": alt,
+                            "pval": rng.random(),
+                        }
+                    )
+    with open(os.path.join(data_dir, "pheno-list.json"), "w") as f:
+        json.dump(phenolist, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num-phenos", type=int, default=300)
+    parser.add_argument("--num-variants", type=int, default=5000)
+    parser.add_argument("--num-procs", type=int, default=4)
+    parser.add_argument(
+        "--fan-in",
+        type=int,
+        action="append",
+        help="fan-in to try with the heap engine (may be given more than once)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from pheweb import conf
+    from pheweb.file_utils import get_filepath
+    from pheweb.load import sites
+
+    data_dir = tempfile.mkdtemp(prefix="pheweb-benchmark-sites-")
+    try:
+        conf.set_override("data_dir", data_dir)
+        conf.set_override("num_procs", args.num_procs)
+        print(
+            "Making {} parsed files in {}".format(args.num_phenos, data_dir), flush=True
+        )
+        make_data_dir(data_dir, args.num_phenos, args.num_variants, args.seed)
+        out_filepath = get_filepath("unanno", must_exist=False)
+
+        runs = [("bisect", None)] + [
+            ("heap", fan_in) for fan_in in args.fan_in or [256]
+        ]
+        results = []
+        expected_contents = None
+        for engine, fan_in in runs:
+            if fan_in is not None:
+                conf.set_override("sites_merge_fan_in", fan_in)
+            start_time = time.time()
+            if engine == "bisect":
+                stats = sites.run_bisect_merge(out_filepath)
+            else:
+                stats = sites.run_heap_merge(out_filepath)
+            elapsed = time.time() - start_time
+            with gzip.open(out_filepath, "rt") as f:
+                contents = f.read()
+            if expected_contents is None:
+                expected_contents = contents
+            elif contents != expected_contents:
+                raise Exception("{} engine gave a different result".format(engine))
+            results.append((engine, fan_in, stats, elapsed))
+
+        print(
+            "\n{:8} {:>6} {:>7} {:>7} {:>9}".format(
+                "engine", "fan-in", "rounds", "merges", "seconds"
+            )
+        )
+        for engine, fan_in, stats, elapsed in results:
+            print(
+                "{:8} {:>6} {:>7} {:>7} {:>9.2f}".format(
+                    engine,
+                    fan_in or sites.MAX_NUM_FILES_TO_MERGE_AT_ONCE,
+                    stats["num_rounds"],
+                    stats["num_merges"],
+                    elapsed,
+                )
+            )
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -44,17 +44,20 @@ for submodule in """
  sites
  download_rsids
  download_rsids_from_scratch
+ make_rsids_blocks
  download_genes
  download_genes_from_scratch
  make_gene_aliases_sqlite3
  add_rsids
  add_genes
  make_cpras_rsids_sqlite3
+ make_autocomplete_index
  augment_phenos
  pheno_correlation
  best_of_pheno
  manhattan
  qq
+ summarize
  matrix
  top_hits
  phenotypes
@@ -63,6 +66,7 @@ for submodule in """
  wsgi
  top_loci
  detect_ref
+ precompress
 """.split():
 
     def f(submodule: str, argv: List[str]) -> None:
@@ -228,10 +228,40 @@ def get_assoc_min_maf() -> float:
     return _get_config_float("assoc_min_maf", 0)
 
 
+def get_assoc_parse_engine() -> str:
+    ret = _get_config_str("assoc_parse_engine", "python")
+    if ret not in ["python", "chunked"]:
+        raise PheWebError(
+            "assoc_parse_engine must be either 'python' or 'chunked', not {!r}".format(
+                ret
+            )
+        )
+    return ret
+
+
 def get_field_aliases() -> Dict[str, str]:
     return overrides.get("field_aliases", parse_utils.default_field_aliases)
 
 
+## Sites config
+def get_sites_merge_engine() -> str:
+    ret = _get_config_str("sites_merge_engine", "heap")
+    if ret not in ["heap", "bisect"]:
+        raise PheWebError(
+            "sites_merge_engine must be either 'heap' or 'bisect', not {!r}".format(
+                ret
+            )
+        )
+    return ret
+
+
+def get_sites_merge_fan_in() -> int:
+    ret = _get_config_int("sites_merge_fan_in", 256)
+    if ret < 2:
+        raise PheWebError("sites_merge_fan_in must be at least 2, not {!r}".format(ret))
+    return ret
+
+
 ## Manhattan / top-hits / top-loci config
 def get_within_pheno_mask_around_peak() -> int:
     return _get_config_int("within_pheno_mask_around_peak", 500_000)
@@ -261,6 +291,15 @@ def get_manhattan_peak_variant_counting_pval_threshold() -> float:
     return _get_config_float("manhattan_peak_variant_counting_pval_threshold", 5e-8)
 
 
+def get_manhattan_binner() -> str:
+    ret = _get_config_str("manhattan_binner", "python")
+    if ret not in ["python", "numpy"]:
+        raise PheWebError(
+            "manhattan_binner must be either 'python' or 'numpy', not {!r}".format(ret)
+        )
+    return ret
+
+
 def get_top_hits_pval_cutoff() -> float:
     return _get_config_float("top_hits_pval_cutoff", 1e-6)
 
@@ -287,6 +326,23 @@ def should_allow_variant_json_cors() -> bool:
     return _get_config_bool("allow_variant_json_cors", True)
 
 
+def get_region_engine() -> str:
+    ret = _get_config_str("region_engine", "columns")
+    if ret not in ["columns", "dicts"]:
+        raise PheWebError(
+            "region_engine must be either 'columns' or 'dicts', not {!r}".format(ret)
+        )
+    return ret
+
+
+def get_response_cache_max_memory_mb() -> float:
+    return _get_config_float("response_cache_max_memory_mb", 64)
+
+
+def get_response_cache_max_disk_mb() -> float:
+    return _get_config_float("response_cache_max_disk_mb", 1024)
+
+
 def get_urlprefix() -> str:
     return _get_config_str("urlprefix", "").rstrip("/")
 
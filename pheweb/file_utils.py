@@ -1,4 +1,4 @@
-from .utils import PheWebError, get_phenolist, chrom_order
+from .utils import PheWebError, get_phenolist, chrom_order, chrom_order_list
 from . import conf
 from . import parse_utils
 
@@ -9,10 +9,18 @@ from contextlib import contextmanager
 import json
 import gzip
 import datetime
+import math
+import shutil
+import array
+import collections
+import threading
+import mmap
+import struct
 from boltons.fileutils import AtomicSaver, mkdir_p
 import itertools, random
+import numpy as np
 from pathlib import Path
-from typing import List, Callable, Dict, Union, Iterator, Optional, Any
+from typing import List, Callable, Dict, Union, Iterator, Optional, Any, Tuple
 
 try:  # pragma: no cover - optional dependency
     import pysam  # type: ignore
@@ -57,6 +65,7 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
         lambda: os.path.join(conf.get_data_dir(), "pheno-correlations.txt")
     ),
     "phenolist": (lambda: os.path.join(conf.get_data_dir(), "pheno-list.json")),
+    "pheno-info": (lambda: get_generated_path("pheno-list-info.bin")),
     # depend on hg_build_number, dbsnp_version, genes_version:
     "rsids": (
         lambda: get_generated_path(
@@ -65,6 +74,13 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
             )
         )
     ),
+    "rsids-blocks": (
+        lambda: get_generated_path(
+            "resources/rsids-v{}-hg{}.blocks".format(
+                dbsnp_version, conf.get_hg_build_number()
+            )
+        )
+    ),
     "rsids-hg19": (
         lambda: get_generated_path(
             "resources/rsids-v{}-hg19.tsv.gz".format(dbsnp_version)
@@ -94,6 +110,7 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
         )
     ),
     # simple:
+    "build-manifest": (lambda: get_generated_path("build-manifest.sqlite3")),
     "unanno": (lambda: get_generated_path("sites/sites-unannotated.tsv")),
     "sites-rsids": (lambda: get_generated_path("sites/sites-rsids.tsv")),
     "sites": (lambda: get_generated_path("sites/sites.tsv")),
@@ -105,6 +122,7 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
     ),
     "correlations": (lambda: get_generated_path("pheno-correlations.txt")),
     "cpras-rsids-sqlite3": (lambda: get_generated_path("sites/cpras-rsids.sqlite3")),
+    "autocomplete-index": (lambda: get_generated_path("sites/autocomplete")),
     "matrix": (lambda: get_generated_path("matrix.tsv.gz")),
     "top-hits": (lambda: get_generated_path("top_hits.json")),
     "top-hits-1k": (lambda: get_generated_path("top_hits_1k.json")),
@@ -116,7 +134,9 @@ _single_filepaths: Dict[str, Callable[[], str]] = {
     # directories for pheno filepaths:
     "parsed": (lambda: get_generated_path("parsed")),
     "pheno_gz": (lambda: get_generated_path("pheno_gz")),
+    "pheno_columns": (lambda: get_generated_path("pheno_columns")),
     "best_of_pheno": (lambda: get_generated_path("best_of_pheno")),
+    "best_of_pheno_facets": (lambda: get_generated_path("best_of_pheno_facets")),
     "manhattan": (lambda: get_generated_path("manhattan")),
     "qq": (lambda: get_generated_path("qq")),
 }
@@ -143,7 +163,13 @@ _pheno_filepaths: Dict[str, Callable[[str], str]] = {
     "pheno_gz_tbi": (
         lambda phenocode: get_generated_path("pheno_gz", "{}.gz.tbi".format(phenocode))
     ),
+    "pheno_columns": (lambda phenocode: get_generated_path("pheno_columns", phenocode)),
     "best_of_pheno": (lambda phenocode: get_generated_path("best_of_pheno", phenocode)),
+    "best_of_pheno_facets": (
+        lambda phenocode: get_generated_path(
+            "best_of_pheno_facets", "{}.npz".format(phenocode)
+        )
+    ),
     "manhattan": (
         lambda phenocode: get_generated_path("manhattan", "{}.json".format(phenocode))
     ),
@@ -151,6 +177,11 @@ _pheno_filepaths: Dict[str, Callable[[str], str]] = {
 }
 
 
+# `pheweb precompress` writes compressed copies of some generated files next to them, like `manhattan/a1c.json.br`,
+# and the server sends these (with the matching `Content-Encoding`) instead of compressing the originals for each request.
+precompressed_suffix_for_encoding = {"br": ".br", "gzip": ".gz"}
+
+
 def make_basedir(path: Union[str, Path]) -> None:
     mkdir_p(os.path.dirname(path))
 
@@ -202,7 +233,9 @@ csv.register_dialect(
 
 @contextmanager
 def VariantFileReader(
-    filepath: Union[str, Path], only_per_variant_fields: bool = False
+    filepath: Union[str, Path],
+    only_per_variant_fields: bool = False,
+    chrom: Optional[str] = None,
 ):
     """
     Reads variants (as dictionaries) from an internal file.  Iterable.  Exposes `.fields`.
@@ -211,8 +244,14 @@ def VariantFileReader(
             print(reader.fields)
             for variant in reader:
                 print(variant)
+
+    If `chrom` is given, only reads the variants on that chromosome (see `read_lines_on_chrom()`).
     """
-    with read_maybe_gzip(filepath) as f:
+    with (
+        read_maybe_gzip(filepath)
+        if chrom is None
+        else read_lines_on_chrom(filepath, [chrom], num_header_lines=1)
+    ) as f:
         reader: Iterator[List[str]] = csv.reader(f, dialect="pheweb-internal-dialect")
         try:
             fields = next(reader)
@@ -284,10 +323,118 @@ class _vfr_only_per_variant_fields:
             yield variant
 
 
+class TabixFilePool:
+    """
+    Keeps `pysam.TabixFile`s open between requests, so that the server doesn't re-open the file and re-load its index every time.
+
+        with tabix_file_pool.get(filepath) as tabix_file:
+            tabix_file.fetch(...)
+
+    Each handle is only lent to one caller at a time, so this is safe with threads and with gevent.
+    Handles are dropped when their file's mtime/size/inode changes, and after a fork (because the child would share file offsets).
+    At most `max_idle_handles` handles are kept open, dropping the least-recently-used files first.
+    """
+
+    def __init__(self, max_idle_handles: int = 64):
+        self._max_idle_handles = max_idle_handles
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._num_idle = 0
+        # maps filepath -> [(stat_key, tabix_file), ...], with the most-recently-used filepath last
+        self._idle: (
+            "collections.OrderedDict[str, List[Tuple[Tuple[int, int, int], Any]]]"
+        ) = collections.OrderedDict()
+        self._headers: Dict[str, Tuple[Tuple[int, int, int], Any]] = {}
+
+    @staticmethod
+    def _get_stat_key(filepath: str) -> Tuple[int, int, int]:
+        st = os.stat(filepath)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _drop_all_if_forked(self) -> List[Any]:
+        # must hold `self._lock`
+        if os.getpid() == self._pid:
+            return []
+        self._pid = os.getpid()
+        to_close = [tf for handles in self._idle.values() for _, tf in handles]
+        self._idle.clear()
+        self._headers.clear()
+        self._num_idle = 0
+        return to_close
+
+    @contextmanager
+    def get(self, filepath: str):
+        _require_pysam()
+        stat_key = self._get_stat_key(filepath)
+        tabix_file = None
+        with self._lock:
+            to_close = self._drop_all_if_forked()
+            handles = self._idle.get(filepath)
+            while handles and tabix_file is None:
+                key, tf = handles.pop()
+                self._num_idle -= 1
+                if key == stat_key:
+                    tabix_file = tf
+                else:
+                    to_close.append(tf)
+        for tf in to_close:
+            tf.close()
+        if tabix_file is None:
+            tabix_file = pysam.TabixFile(filepath, parser=None)  # type: ignore[attr-defined]
+        try:
+            yield tabix_file
+        except BaseException:
+            tabix_file.close()  # it might be in a bad state
+            raise
+        self._put_back(filepath, stat_key, tabix_file)
+
+    def _put_back(
+        self, filepath: str, stat_key: Tuple[int, int, int], tabix_file: Any
+    ) -> None:
+        with self._lock:
+            to_close = self._drop_all_if_forked()
+            if to_close:
+                to_close.append(tabix_file)
+            else:
+                self._idle.setdefault(filepath, []).append((stat_key, tabix_file))
+                self._idle.move_to_end(filepath)
+                self._num_idle += 1
+                while self._num_idle > self._max_idle_handles:
+                    _, handles = self._idle.popitem(last=False)
+                    self._num_idle -= len(handles)
+                    to_close.extend(tf for _, tf in handles)
+        for tf in to_close:
+            tf.close()
+
+    def get_header(self, filepath: str, read_header: Callable[[str], Any]) -> Any:
+        """Returns `read_header(filepath)`, cached until the file changes."""
+        stat_key = self._get_stat_key(filepath)
+        with self._lock:
+            to_close = self._drop_all_if_forked()
+            cached = self._headers.get(filepath)
+        for tf in to_close:
+            tf.close()
+        if cached is not None and cached[0] == stat_key:
+            return cached[1]
+        header = read_header(filepath)
+        with self._lock:
+            self._headers[filepath] = (stat_key, header)
+        return header
+
+
+tabix_file_pool = TabixFilePool()
+
+
 @contextmanager
 def IndexedVariantFileReader(phenocode: str):
     _require_pysam()
     filepath = get_pheno_filepath("pheno_gz", phenocode)
+    colidxs = tabix_file_pool.get_header(filepath, _read_indexed_variant_file_colidxs)
+    with tabix_file_pool.get(filepath) as tabix_file:
+        yield _ivfr(tabix_file, colidxs)
+
+
+def _read_indexed_variant_file_colidxs(filepath: str) -> Dict[str, int]:
     with read_gzip(filepath) as f:
         reader: Iterator[List[str]] = csv.reader(f, dialect="pheweb-internal-dialect")
         fields = next(reader)
@@ -300,9 +447,7 @@ def IndexedVariantFileReader(phenocode: str):
             field in parse_utils.per_variant_fields
             or field in parse_utils.per_assoc_fields
         ), field
-    colidxs = {field: idx for idx, field in enumerate(fields)}
-    with pysam.TabixFile(filepath, parser=None) as tabix_file:  # type: ignore[attr-defined]
-        yield _ivfr(tabix_file, colidxs)
+    return {field: idx for idx, field in enumerate(fields)}
 
 
 class _ivfr:
@@ -332,12 +477,87 @@ class _ivfr:
               'chrom': 'X', 'pos': 43254, ...,
             }, ...]
         """
+        for variant_row in self._get_region_rows(chrom, start, end):
+            yield self._parse_variant_row(variant_row)
+
+    def get_region_columns(
+        self, chrom: str, start: int, end: int
+    ) -> Dict[str, List[Any]]:
+        """
+        Like `get_region()`, but returns one list per field instead of one dict per variant.
+        return is like {'chrom': ['X', 'X', ...], 'pos': [43254, 43260, ...], ...}, or {} if there are no variants.
+        """
+        lines = list(self._get_region_lines(chrom, start, end))
+        if not lines:
+            return {}
+        num_fields = len(self._colidxs)
+        joined_lines = "\t".join(lines)
+        if "\\" in joined_lines or '"' in joined_lines:
+            # Only csv knows how to handle quoted or escaped values.
+            rows: List[List[str]] = list(
+                csv.reader(lines, dialect="pheweb-internal-dialect")
+            )
+            values = [val for row in rows for val in row]
+        else:
+            # Splitting all of the lines at once is much faster than splitting each line.
+            values = joined_lines.split("\t")
+        if len(values) != len(lines) * num_fields:
+            for line in lines:
+                if (
+                    len(next(csv.reader([line], dialect="pheweb-internal-dialect")))
+                    != num_fields
+                ):
+                    raise PheWebError(
+                        "ERROR: The line {!r} in file {!r} doesn't have {} fields".format(
+                            line, self._tabix_file.filename, num_fields
+                        )
+                    )
+        return {
+            field: self._read_column(field, values[colidx::num_fields])
+            for field, colidx in self._colidxs.items()
+        }
+
+    def _read_column(self, field: str, values: List[str]) -> List[Any]:
+        field_type = parse_utils.fields[field]["type"]
+        if field_type is str:
+            return values
+        if field_type is parse_utils.scientific_int:
+            field_type = int
+        if field_type in (int, float):
+            try:
+                if "" not in values:
+                    return list(map(field_type, values))
+                if parse_utils.fields[field]["nullable"]:
+                    return [field_type(val) if val else "" for val in values]
+            except ValueError:
+                pass  # Use `reader_for_field`, which handles ints like "1e3" and explains bad values.
+        parser = parse_utils.reader_for_field[field]
+        ret = []
+        for val in values:
+            try:
+                ret.append(parser(val))
+            except Exception as exc:
+                raise PheWebError(
+                    "ERROR: Failed to parse the value {!r} for field {!r} in file {!r}".format(
+                        val, field, self._tabix_file.filename
+                    )
+                ) from exc
+        return ret
+
+    def _get_region_rows(self, chrom: str, start: int, end: int) -> Iterator[List[str]]:
+        reader: Iterator[List[str]] = csv.reader(
+            self._get_region_lines(chrom, start, end),
+            dialect="pheweb-internal-dialect",
+        )
+        yield from reader
+
+    def _get_region_lines(self, chrom: str, start: int, end: int) -> Iterator[str]:
         if start < 1:
             start = 1
         if start >= end:
-            return []
+            return
         if chrom not in self._tabix_file.contigs:
-            return []
+            return
 
         # I do not understand why I need to use `pos-1`.
         # The pysam docs talk about being zero-based or one-based. Is this what they're referring to?
@@ -350,11 +570,7 @@ class _ivfr:
                     chrom, start - 1, end - 1, self._tabix_file.filename
                 )
             ) from exc
-        reader: Iterator[List[str]] = csv.reader(
-            tabix_iter, dialect="pheweb-internal-dialect"
-        )
-        for variant_row in reader:
-            yield self._parse_variant_row(variant_row)
+        yield from tabix_iter
 
     def get_variant(
         self, chrom: str, pos: int, ref: str, alt: int
@@ -369,16 +585,125 @@ class _ivfr:
         return None
 
 
+class PhenoInfoReader:
+    """
+    Reads the info of each phenotype in pheno-list.json (everything but `assoc_files`) from `pheno-list-info.bin`, which is memory-mapped,
+    so processes can look up phenotypes without parsing all of pheno-list.json, and share the pages of the file instead of each having a copy.
+    Use `get_pheno_info_reader()` to get one that's up-to-date with pheno-list.json.
+
+    The file is `_HEADER` (with the mtime, size and inode of the pheno-list.json that it was made from),
+    then the offset of each phenotype's json (uint64), then all of the json, and then the phenocodes joined with `\\n`.
+    """
+
+    _MAGIC = b"PWPHINF1"
+    _HEADER = struct.Struct("<8sQQQQQ")
+
+    def __init__(self, buf: Union[bytes, mmap.mmap]):
+        self._buf = buf
+        magic, *source_stat_key, num_phenos, phenocodes_offset = (
+            self._HEADER.unpack_from(buf)
+        )
+        self.source_stat_key = tuple(source_stat_key)
+        if magic != self._MAGIC:
+            raise PheWebError("This isn't a pheno-list-info file")
+        self._offsets = np.frombuffer(
+            buf, dtype=np.uint64, count=num_phenos + 1, offset=self._HEADER.size
+        )
+        self.phenocodes: List[str] = (
+            bytes(buf[phenocodes_offset:]).decode("utf8").split("\n")
+            if num_phenos
+            else []
+        )
+        self._idx_for_phenocode = {p: i for i, p in enumerate(self.phenocodes)}
+        self._info_cache: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def serialize(
+        cls, phenolist: List[Dict[str, Any]], source_stat_key: Tuple[int, int, int]
+    ) -> bytes:
+        infos = [
+            json.dumps({k: v for k, v in pheno.items() if k != "assoc_files"}).encode(
+                "utf8"
+            )
+            for pheno in phenolist
+        ]
+        offsets = np.cumsum(
+            [0] + [len(info) for info in infos], dtype=np.uint64
+        ) + np.uint64(cls._HEADER.size + 8 * (len(infos) + 1))
+        phenocodes_offset = int(offsets[-1])
+        return b"".join(
+            [
+                cls._HEADER.pack(
+                    cls._MAGIC, *source_stat_key, len(infos), phenocodes_offset
+                ),
+                offsets.tobytes(),
+            ]
+            + infos
+            + ["\n".join(p["phenocode"] for p in phenolist).encode("utf8")]
+        )
+
+    def __contains__(self, phenocode: str) -> bool:
+        return phenocode in self._idx_for_phenocode
+
+    def __getitem__(self, phenocode: str) -> Dict[str, Any]:
+        """Returns the info of the phenotype (which is cached, so don't modify it)"""
+        info = self._info_cache.get(phenocode)
+        if info is None:
+            idx = self._idx_for_phenocode[phenocode]
+            info = self._info_cache[phenocode] = json.loads(
+                self._buf[int(self._offsets[idx]) : int(self._offsets[idx + 1])]
+            )
+        return info
+
+
+_pheno_info_reader: Optional[PhenoInfoReader] = None
+
+
+def get_pheno_info_reader() -> PhenoInfoReader:
+    """
+    Returns a `PhenoInfoReader` for pheno-list.json, re-making `pheno-list-info.bin` first if pheno-list.json has changed.
+    If it can't be written (eg, if `generated-by-pheweb/` is read-only), the reader uses a copy in memory instead.
+    """
+    global _pheno_info_reader
+    phenolist_filepath = get_filepath("phenolist")
+    st = os.stat(phenolist_filepath)
+    stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if (
+        _pheno_info_reader is not None
+        and _pheno_info_reader.source_stat_key == stat_key
+    ):
+        return _pheno_info_reader
+    filepath = get_filepath("pheno-info", must_exist=False)
+    try:
+        with open(filepath, "rb") as f:
+            reader = PhenoInfoReader(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        if reader.source_stat_key == stat_key:
+            _pheno_info_reader = reader
+            return reader
+    except (OSError, ValueError, PheWebError, struct.error):
+        pass  # It's missing or broken, so re-make it.
+    data = PhenoInfoReader.serialize(get_phenolist(), stat_key)
+    try:
+        # Other processes might be re-making it too, so each writes its own tmp file.
+        tmp_filepath = "{}.{}".format(get_tmp_path(filepath), os.getpid())
+        with open(tmp_filepath, "wb") as f:
+            f.write(data)
+        os.replace(tmp_filepath, filepath)
+        with open(filepath, "rb") as f:
+            _pheno_info_reader = PhenoInfoReader(
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+    except OSError:
+        _pheno_info_reader = PhenoInfoReader(data)
+    return _pheno_info_reader
+
+
 class MatrixReader:
     def __init__(self):
         self._filepath = get_generated_path("matrix.tsv.gz")
 
-        phenos: List[Dict[str, Any]] = get_phenolist()
-        phenocodes: List[str] = [pheno["phenocode"] for pheno in phenos]
-        self._info_for_pheno = {
-            pheno["phenocode"]: {k: v for k, v in pheno.items() if k != "assoc_files"}
-            for pheno in phenos
-        }
+        # Each phenotype's info is only parsed when it's first used, instead of parsing all of pheno-list.json.
+        self._info_for_pheno = get_pheno_info_reader()
 
         with read_gzip(self._filepath) as f:
             reader = csv.reader(f, dialect="pheweb-internal-dialect")
@@ -396,7 +721,7 @@ class MatrixReader:
                 assert len(x) == 2, x
                 field, phenocode = x
                 assert field in parse_utils.fields, field
-                assert phenocode in phenocodes, phenocode
+                assert phenocode in self._info_for_pheno, phenocode
                 self._colidxs_for_pheno.setdefault(phenocode, {})[field] = colnum
             else:
                 field = colname
@@ -407,11 +732,30 @@ class MatrixReader:
         return list(self._colidxs_for_pheno)
 
     @contextmanager
-    def context(self):
+    def context(
+        self, fields: Optional[List[str]] = None, max_pval: Optional[float] = None
+    ):
+        """
+        `fields` limits which per-phenotype fields are parsed (default: all of them, plus the phenotype's info from pheno-list.json).
+        `max_pval` skips phenotypes whose pval is greater than it.
+
+            with MatrixReader().context(fields=['pval'], max_pval=1e-4) as matrix_reader:
+                for variant in matrix_reader.get_region(chrom, start, end):
+                    variant['phenos']  # is like {'<phenocode>': {'pval': 3e-5}, ...}
+        """
         _require_pysam()
-        with pysam.TabixFile(self._filepath, parser=None) as tabix_file:  # type: ignore[attr-defined]
+        if fields is not None:
+            for field in fields:
+                if field not in parse_utils.fields:
+                    raise PheWebError("Unknown field {!r}".format(field))
+        with tabix_file_pool.get(self._filepath) as tabix_file:
             yield _mr(
-                tabix_file, self._colidxs, self._colidxs_for_pheno, self._info_for_pheno
+                tabix_file,
+                self._colidxs,
+                self._colidxs_for_pheno,
+                self._info_for_pheno,
+                fields,
+                max_pval,
             )
 
 
@@ -421,12 +765,37 @@ class _mr(_ivfr):
         _tabix_file: "pysam.TabixFile",
         _colidxs: Dict[str, int],
         _colidxs_for_pheno: Dict[str, Dict[str, int]],
-        _info_for_pheno: Dict[str, Dict[str, Any]],
+        _info_for_pheno: "PhenoInfoReader",
+        _fields: Optional[List[str]] = None,
+        _max_pval: Optional[float] = None,
     ):
         self._tabix_file = _tabix_file
         self._colidxs = _colidxs
         self._colidxs_for_pheno = _colidxs_for_pheno
         self._info_for_pheno = _info_for_pheno
+        self._include_info = _fields is None
+        self._max_pval = _max_pval
+
+        # For each phenotype, find one column that is non-empty whenever the phenotype has this variant,
+        # so that we can skip the phenotype by looking at a single cell.
+        # `pval` is required, so it works.  Otherwise we fall back to checking every column.
+        self._pheno_plans: List[Tuple[str, List[int], Optional[int], List[str]]] = []
+        for phenocode, colidx_for_field in _colidxs_for_pheno.items():
+            if "pval" in colidx_for_field:
+                presence_colidxs = [colidx_for_field["pval"]]
+            else:
+                presence_colidxs = list(colidx_for_field.values())
+            pval_colidx = (
+                colidx_for_field.get("pval") if _max_pval is not None else None
+            )
+            wanted_fields = [
+                field
+                for field in colidx_for_field
+                if _fields is None or field in _fields
+            ]
+            self._pheno_plans.append(
+                (phenocode, presence_colidxs, pval_colidx, wanted_fields)
+            )
 
     def _parse_field(
         self, variant_row: List[str], field: str, phenocode: Optional[str] = None
@@ -454,18 +823,58 @@ class _mr(_ivfr):
         variant: Dict[str, Any] = {"phenos": {}}
         for field in self._colidxs:
             variant[field] = self._parse_field(variant_row, field)
-        for phenocode, fields in self._colidxs_for_pheno.items():
-            if any(
-                variant_row[self._colidxs_for_pheno[phenocode][field]] != ""
-                for field in fields
-            ):
-                p = {}
-                for field in fields:
-                    p[field] = self._parse_field(variant_row, field, phenocode)
-                    p.update(self._info_for_pheno[phenocode])
-                    variant["phenos"][phenocode] = p
+        for (
+            phenocode,
+            presence_colidxs,
+            pval_colidx,
+            wanted_fields,
+        ) in self._pheno_plans:
+            if all(variant_row[colidx] == "" for colidx in presence_colidxs):
+                continue
+            if pval_colidx is not None:
+                pval = self._parse_field(variant_row, "pval", phenocode)
+                if pval > self._max_pval:  # type: ignore[operator]
+                    continue
+            p = {}
+            for field in wanted_fields:
+                p[field] = self._parse_field(variant_row, field, phenocode)
+            if self._include_info:
+                p.update(self._info_for_pheno[phenocode])
+            variant["phenos"][phenocode] = p
         return variant
 
+    def get_region_with_rows(
+        self, chrom: str, start: int, end: int
+    ) -> Iterator[Tuple[Dict[str, Any], List[str]]]:
+        """
+        Like `get_region()`, but yields `(variant, variant_row)`.
+        Pass `variant_row` to `parse_pheno()` to get all fields of a phenotype that wasn't fully parsed.
+        """
+        for variant_row in self._get_region_rows(chrom, start, end):
+            yield (self._parse_variant_row(variant_row), variant_row)
+
+    def get_region_rows(self, chrom: str, start: int, end: int) -> Iterator[List[str]]:
+        """
+        Like `get_region()`, but yields each `variant_row` without parsing it.
+        Use `get_colidx()` to find a field in it, and `parse_pheno()` to parse a phenotype.
+        """
+        return self._get_region_rows(chrom, start, end)
+
+    def get_colidx(self, field: str, phenocode: Optional[str] = None) -> int:
+        """Returns the index of a per-variant field, or of a field of `phenocode`, in each `variant_row`"""
+        if phenocode is None:
+            return self._colidxs[field]
+        return self._colidxs_for_pheno[phenocode][field]
+
+    def parse_pheno(self, variant_row: List[str], phenocode: str) -> Dict[str, Any]:
+        """Returns all fields for `phenocode` in `variant_row`, plus its info from pheno-list.json"""
+        p = {
+            field: self._parse_field(variant_row, field, phenocode)
+            for field in self._colidxs_for_pheno[phenocode]
+        }
+        p.update(self._info_for_pheno[phenocode])
+        return p
+
 
 def with_chrom_idx(variants: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
     for v in variants:
@@ -500,12 +909,204 @@ def read_maybe_gzip(filepath: Union[str, Path]):
             yield f
 
 
+@contextmanager
+def read_lines_on_chrom(
+    filepath: Union[str, Path], chrom_names: List[str], num_header_lines: int = 0
+) -> Iterator[Iterator[str]]:
+    """
+    Yields an iterator over the first `num_header_lines` lines of a file (maybe gzipped) that's sorted by chromosome,
+    followed by the lines whose first column is one of `chrom_names` (eg, a chromosome and its aliases).
+    The lines before that chromosome are skipped with `bytes.find()` instead of being split and decoded,
+    and reading stops at the first line of a different chromosome after it, so this is much faster than filtering every line.
+    Lines starting with `#` are ignored.
+    """
+    with open(filepath, "rb") as raw_f:
+        is_gzip = raw_f.read(3) == b"\x1f\x8b\x08"
+    with (
+        gzip.GzipFile(filepath, "rb") if is_gzip else open(filepath, "rb")
+    ) as f, io.BufferedReader(f, buffer_size=2**18) as g:
+        header_lines = [g.readline().decode() for _ in range(num_header_lines)]
+        yield itertools.chain(header_lines, _iter_lines_on_chrom(g, chrom_names))
+
+
+def _iter_lines_on_chrom(f: Any, chrom_names: List[str]) -> Iterator[str]:
+    prefixes = tuple(name.encode() + b"\t" for name in chrom_names)
+    # Start with a newline so that a match on the first line looks like any other.
+    buf = b"\n"
+    while True:
+        starts = [i for i in (buf.find(b"\n" + p) for p in prefixes) if i != -1]
+        if starts:
+            break
+        chunk = f.read(2**22)
+        if not chunk:
+            return
+        # Keep enough of the end of the buffer to find a match that spans two chunks.
+        buf = buf[-max(len(p) for p in prefixes) :] + chunk
+    *complete_lines, partial_line = buf[min(starts) + 1 :].split(b"\n")
+    for line in itertools.chain(complete_lines, [partial_line + f.readline()], f):
+        if line.startswith(prefixes):
+            yield line.decode()
+        elif line and not line.startswith(b"#"):
+            return
+
+
+## Columnar files
+# A columnar file is a directory holding one memory-mappable `.npy` per column and a `columns.json` describing them.
+# - `chrom` is stored as `chrom_idx.npy` (uint8, indexes into `chrom_order_list`)
+# - `pos` is stored as uint32
+# - float fields are stored as float64, with NaN for nulls
+# - every other field is stored as a utf8 heap (`<field>.heap.npy`) plus `<field>.offsets.npy`, where
+#   the value for variant i is `heap[offsets[i]:offsets[i+1]]`.
+
+COLUMNAR_FORMAT_VERSION = 1
+
+
+def _get_column_kind(field: str) -> str:
+    if field == "chrom":
+        return "chrom_idx"
+    if field == "pos":
+        return "uint32"
+    if parse_utils.fields[field]["type"] is float:
+        return "float64"
+    return "str"
+
+
+@contextmanager
+def ColumnarVariantFileReader(dirpath: Union[str, Path]):
+    """
+    Reads variants from a columnar file written by `ColumnarVariantFileWriter`.  Iterable.  Exposes `.fields`.
+    Columns are memory-mapped, so getting a column doesn't parse or copy anything.
+
+        with ColumnarVariantFileReader('pheno_columns/a1c') as reader:
+            pvals = reader.get_column('pval')  # np.ndarray of float64
+            print(reader.get_variant(int(pvals.argmin())))  # same dict that VariantFileReader would give
+    """
+    dirpath = str(dirpath)
+    try:
+        with open(os.path.join(dirpath, "columns.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise PheWebError("The columnar file {} doesn't exist".format(dirpath))
+    if meta.get("version") != COLUMNAR_FORMAT_VERSION:
+        raise PheWebError(
+            "The columnar file {} has version {!r} but this PheWeb reads version {!r}.  Re-run `pheweb augment-phenos`.".format(
+                dirpath, meta.get("version"), COLUMNAR_FORMAT_VERSION
+            )
+        )
+    yield _cvfr(dirpath, meta["fields"], meta["num_variants"])
+
+
+class _cvfr:
+    _iter_chunk_size = 2**16
+
+    def __init__(self, dirpath: str, fields: List[str], num_variants: int):
+        self._dirpath = dirpath
+        self.fields = fields
+        self._num_variants = num_variants
+        self._columns: Dict[str, Any] = {}
+
+    def __len__(self) -> int:
+        return self._num_variants
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self._dirpath, name + ".npy"), mmap_mode="r")
+
+    def get_column(self, field: str) -> Any:
+        """
+        `chrom_idx`, `pos` and float fields give an np.ndarray (float nulls are NaN).
+        `chrom` and string fields give a list-like `_StringColumn`.
+        """
+        if field not in self._columns:
+            if field == "chrom_idx" or field == "chrom":
+                if "chrom" not in self.fields:
+                    raise KeyError(field)
+                chrom_idxs = self._load("chrom_idx")
+                self._columns["chrom_idx"] = chrom_idxs
+                self._columns["chrom"] = _ChromColumn(chrom_idxs)
+            elif field not in self.fields:
+                raise KeyError(field)
+            elif _get_column_kind(field) == "str":
+                self._columns[field] = _StringColumn(
+                    self._load(field + ".offsets"),
+                    self._load(field + ".heap"),
+                    parse_utils.reader_for_field[field],
+                )
+            else:
+                self._columns[field] = self._load(field)
+        return self._columns[field]
+
+    def get_variant(self, idx: int) -> Dict[str, Any]:
+        return next(self._get_variants(idx, idx + 1))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for start in range(0, self._num_variants, self._iter_chunk_size):
+            yield from self._get_variants(
+                start, min(start + self._iter_chunk_size, self._num_variants)
+            )
+
+    def _get_variants(self, start: int, end: int) -> Iterator[Dict[str, Any]]:
+        value_lists = []
+        for field in self.fields:
+            column = self.get_column(field)
+            if isinstance(column, np.ndarray):
+                values = column[start:end].tolist()
+                if parse_utils.fields[field]["nullable"]:
+                    values = ["" if math.isnan(v) else v for v in values]
+            else:
+                values = column.slice_tolist(start, end)
+            value_lists.append(values)
+        for values in zip(*value_lists):
+            yield dict(zip(self.fields, values))
+
+
+class _StringColumn:
+    def __init__(
+        self, offsets: np.ndarray, heap: np.ndarray, reader: Callable[[str], Any]
+    ):
+        self._offsets = offsets
+        self._heap = heap
+        self._reader = reader
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx: int) -> Any:
+        start, end = int(self._offsets[idx]), int(self._offsets[idx + 1])
+        return self._reader(self._heap[start:end].tobytes().decode("utf8"))
+
+    def slice_tolist(self, start: int, end: int) -> List[Any]:
+        offsets = self._offsets[start : end + 1].tolist()
+        heap = self._heap[offsets[0] : offsets[-1]].tobytes()
+        base = offsets[0]
+        return [
+            self._reader(heap[a - base : b - base].decode("utf8"))
+            for a, b in zip(offsets, offsets[1:])
+        ]
+
+
+class _ChromColumn:
+    def __init__(self, chrom_idxs: np.ndarray):
+        self._chrom_idxs = chrom_idxs
+
+    def __len__(self) -> int:
+        return len(self._chrom_idxs)
+
+    def __getitem__(self, idx: int) -> str:
+        return chrom_order_list[self._chrom_idxs[idx]]
+
+    def slice_tolist(self, start: int, end: int) -> List[str]:
+        return [chrom_order_list[i] for i in self._chrom_idxs[start:end].tolist()]
+
+
 ## Writers
 
 
 @contextmanager
 def VariantFileWriter(
-    filepath: str, allow_extra_fields: bool = False, use_gzip: bool = True
+    filepath: str,
+    allow_extra_fields: bool = False,
+    use_gzip: bool = True,
+    write_header: bool = True,
 ):
     """
     Writes variants (represented by dictionaries) to an internal file.
@@ -514,6 +1115,7 @@ def VariantFileWriter(
             writer.write({'chrom': '2', 'pos': 47, ...})
 
     Each variant/association/hit/loci written must have a subset of the keys of the first one.
+    Use `write_header=False` to write a part of a file that will be appended to another.
     """
     part_file = get_tmp_path(filepath)
     make_basedir(filepath)
@@ -526,7 +1128,7 @@ def VariantFileWriter(
             rm_part_on_exc=False,
         ) as f:
             with gzip.open(f, "wt", compresslevel=2) as f_gzip:
-                yield _vfw(f_gzip, allow_extra_fields, filepath)
+                yield _vfw(f_gzip, allow_extra_fields, filepath, write_header)
     else:
         with AtomicSaver(
             filepath,
@@ -535,14 +1137,17 @@ def VariantFileWriter(
             overwrite_part=True,
             rm_part_on_exc=False,
         ) as f:
-            yield _vfw(f, allow_extra_fields, filepath)
+            yield _vfw(f, allow_extra_fields, filepath, write_header)
 
 
 class _vfw:
-    def __init__(self, f, allow_extra_fields: bool, filepath: str):
+    def __init__(
+        self, f, allow_extra_fields: bool, filepath: str, write_header: bool = True
+    ):
         self._f = f
         self._allow_extra_fields = allow_extra_fields
         self._filepath = filepath
+        self._write_header = write_header
 
     def write(self, variant: Dict[str, Any]) -> None:
         if not hasattr(self, "_writer"):
@@ -562,13 +1167,136 @@ class _vfw:
             self._writer = csv.DictWriter(
                 self._f, fieldnames=fields, dialect="pheweb-internal-dialect"
             )
-            self._writer.writeheader()
+            if self._write_header:
+                self._writer.writeheader()
         self._writer.writerow(variant)
 
     def write_all(self, variants: Iterator[Dict[str, Any]]) -> None:
         for v in variants:
             self.write(v)
 
+    def write_rows(self, fields: List[str], rows: Iterator[List[str]]) -> None:
+        """Writes rows of values that are already formatted, like the rows of an internal file.  `fields` must be in the order that `write()` uses."""
+        assert not hasattr(self, "_writer")
+        assert fields == [field for field in parse_utils.fields if field in fields], (
+            fields,
+            self._filepath,
+        )
+        writer = csv.writer(self._f, dialect="pheweb-internal-dialect")
+        if self._write_header:
+            writer.writerow(fields)
+        writer.writerows(rows)
+
+
+@contextmanager
+def ColumnarVariantFileWriter(dirpath: str):
+    """
+    Writes variants (represented by dictionaries) to a columnar file (see `ColumnarVariantFileReader`).
+
+        with ColumnarVariantFileWriter('pheno_columns/a1c') as writer:
+            writer.write({'chrom': '2', 'pos': 47, ...})
+
+    Like `VariantFileWriter`, the fields are taken from the first variant.
+    """
+    make_basedir(dirpath)
+    tmp_dirpath = get_tmp_path(dirpath)
+    mkdir_p(tmp_dirpath)
+    try:
+        writer = _cvfw(dirpath)
+        yield writer
+        writer._save(tmp_dirpath)
+    except BaseException:
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+        raise
+    if os.path.exists(dirpath):
+        shutil.rmtree(dirpath)
+    os.rename(tmp_dirpath, dirpath)
+
+
+class _cvfw:
+    def __init__(self, dirpath: str):
+        self._dirpath = dirpath
+        self._num_variants = 0
+
+    def _setup(self, variant: Dict[str, Any]) -> None:
+        self.fields = [field for field in parse_utils.fields if field in variant]
+        extra_fields = list(set(variant.keys()) - set(self.fields))
+        if extra_fields:
+            raise PheWebError(
+                "ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
+                    extra_fields, self.fields, self._dirpath
+                )
+            )
+        self._arrays: Dict[str, Any] = {}
+        self._appenders = []
+        for field in self.fields:
+            kind = _get_column_kind(field)
+            if kind == "chrom_idx":
+                arr = self._arrays["chrom_idx"] = array.array("B")
+                self._appenders.append((field, self._chrom_appender(arr)))
+            elif kind == "uint32":
+                arr = self._arrays[field] = array.array("I")
+                self._appenders.append((field, arr.append))
+            elif kind == "float64":
+                arr = self._arrays[field] = array.array("d")
+                self._appenders.append((field, self._float_appender(arr)))
+            else:
+                offsets = self._arrays[field + ".offsets"] = array.array("Q", [0])
+                heap = self._arrays[field + ".heap"] = bytearray()
+                self._appenders.append((field, self._str_appender(offsets, heap)))
+
+    @staticmethod
+    def _chrom_appender(arr: array.array) -> Callable[[str], None]:
+        return lambda chrom: arr.append(chrom_order[chrom])
+
+    @staticmethod
+    def _float_appender(arr: array.array) -> Callable[[Any], None]:
+        return lambda value: arr.append(math.nan if value == "" else value)
+
+    @staticmethod
+    def _str_appender(offsets: array.array, heap: bytearray) -> Callable[[Any], None]:
+        def append(value: Any) -> None:
+            heap.extend(str(value).encode("utf8"))
+            offsets.append(len(heap))
+
+        return append
+
+    def write(self, variant: Dict[str, Any]) -> None:
+        if self._num_variants == 0:
+            self._setup(variant)
+        for field, append in self._appenders:
+            append(variant.get(field, ""))
+        self._num_variants += 1
+
+    def write_all(self, variants: Iterator[Dict[str, Any]]) -> None:
+        for v in variants:
+            self.write(v)
+
+    _dtypes = {"B": np.uint8, "I": np.uint32, "d": np.float64, "Q": np.uint64}
+
+    def _save(self, tmp_dirpath: str) -> None:
+        if self._num_variants == 0:
+            raise PheWebError(
+                "ERROR: tried to write file {!r} but didn't supply any variants".format(
+                    self._dirpath
+                )
+            )
+        for name, arr in self._arrays.items():
+            if isinstance(arr, bytearray):
+                np_arr = np.frombuffer(arr, dtype=np.uint8)
+            else:
+                np_arr = np.array(arr, dtype=self._dtypes[arr.typecode])
+            np.save(os.path.join(tmp_dirpath, name + ".npy"), np_arr)
+        with open(os.path.join(tmp_dirpath, "columns.json"), "w") as f:
+            json.dump(
+                {
+                    "version": COLUMNAR_FORMAT_VERSION,
+                    "fields": self.fields,
+                    "num_variants": self._num_variants,
+                },
+                f,
+            )
+
 
 def write_heterogenous_variantfile(
     filepath: str, assocs: List[Dict[str, Any]], use_gzip: bool = True
@@ -606,6 +1334,49 @@ def convert_VariantFile_to_IndexedVariantFile(vf_path: str, ivf_path: str) -> No
     )
 
 
+# The empty block that ends every bgzip file.  See the BGZF section of the SAM spec.
+BGZF_EOF_BLOCK = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+
+def get_tabix_chrom_virtual_offsets(tbi_filepath: str) -> Dict[str, int]:
+    """
+    Reads a tabix index and returns the virtual offset of the first line of each chromosome, like `{'1': 3456, ...}`.
+    A virtual offset is `(offset_of_bgzip_block << 16) | offset_within_uncompressed_block`.
+    """
+    import struct
+
+    with gzip.open(tbi_filepath, "rb") as f:
+        data = f.read()
+    if data[:4] != b"TBI\x01":
+        raise PheWebError("{!r} isn't a tabix index".format(tbi_filepath))
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    names = data[36 : 36 + l_nm].split(b"\0")[:n_ref]
+    idx = 36 + l_nm
+    ret = {}
+    for name in names:
+        n_bin = struct.unpack_from("<i", data, idx)[0]
+        idx += 4
+        first_offset = None
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, idx)
+            idx += 8
+            if bin_id != 37450:  # bin 37450 holds metadata, not chunks.
+                chunk_begs = struct.unpack_from("<" + "Q8x" * n_chunk, data, idx)
+                if chunk_begs and (
+                    first_offset is None or min(chunk_begs) < first_offset
+                ):
+                    first_offset = min(chunk_begs)
+            idx += 16 * n_chunk
+        n_intv = struct.unpack_from("<i", data, idx)[0]
+        idx += 4 + 8 * n_intv
+        if first_offset is not None:
+            ret[name.decode("utf8")] = first_offset
+    return ret
+
+
 def write_json(
     *,
     filepath: Optional[str] = None,
@@ -3,15 +3,24 @@ This script takes a file with the columns [chrom, pos, ...] (but no headers) and
 """
 
 from ..utils import get_gene_tuples
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath
-from .load_utils import mtime
+from ..file_utils import (
+    VariantFileReader,
+    VariantFileWriter,
+    read_maybe_gzip,
+    get_filepath,
+)
+from .. import parse_utils
+from .load_utils import update_annotated_variant_file
+from .build_manifest import BuildTarget, get_file_hash, record_added_lines
 
 from intervaltree import IntervalTree, Interval
 import bisect
+import csv
+import heapq
 import os
 import os.path
 import boltons.iterutils
-from typing import List, Tuple, Optional, Dict, Iterator
+from typing import List, Tuple, Optional, Dict, Iterator, Any
 
 Chrom = str
 GeneName = str
@@ -96,15 +105,151 @@ class GeneAnnotator(object):
         return nearest_gene_start[1]
 
 
+class SweepingGeneAnnotator(object):
+    """
+    Gives the same answers as `GeneAnnotator`, but much faster for positions that increase along each chromosome, like the variants of a sorted file.
+    Instead of querying a tree for every position, it sweeps through the genes of the chromosome alongside the positions:
+    a gene is pushed onto a heap when the sweep passes its start and popped when it reaches its end,
+    and the nearest gene end before and gene start after the position are found by pointers that only move forwards.
+    If a position is lower than the previous one on its chromosome, the sweep starts over.
+    """
+
+    def __init__(self, interval_tuples: Iterator[Tuple[Chrom, int, int, GeneName]]):
+        """interval_tuples is like [('22', 12321, 12345, 'APOL1'), ...]"""
+        self._genes_by_chrom: Dict[Chrom, List[Tuple[int, int, GeneName]]] = {}
+        for chrom, pos_start, pos_end, gene_name in interval_tuples:
+            self._genes_by_chrom.setdefault(chrom, []).append(
+                (pos_start, pos_end, gene_name)
+            )
+        self._chrom: Optional[Chrom] = None
+
+    def _start_sweep(self, chrom: Chrom) -> None:
+        # Sort stably, so that ties are broken the same way as `BisectFinder`.
+        genes = self._genes_by_chrom[chrom]
+        self._chrom = chrom
+        self._pos = 0
+        self._genes = sorted(genes, key=lambda g: g[0])
+        self._starts = [g[0] for g in self._genes]
+        genes_by_end = sorted(genes, key=lambda g: g[1])
+        self._ends = [g[1] for g in genes_by_end]
+        self._end_names = [g[2] for g in genes_by_end]
+        # The genes with start <= pos have been pushed onto the heap.
+        self._num_genes_started = 0
+        self._num_starts_before = 0  # genes with start < pos
+        self._num_ends_before = 0  # genes with end <= pos
+        self._overlapping_genes_heap: List[Tuple[int, GeneName]] = []
+        self._overlapping_gene_counts: Dict[GeneName, int] = {}
+        self._overlapping_genes = ""
+
+    def annotate_position(self, chrom: str, pos: int) -> str:
+        if chrom == "MT":
+            chrom = "M"
+        if chrom not in self._genes_by_chrom:
+            return ""
+        if chrom != self._chrom or pos < self._pos:
+            self._start_sweep(chrom)
+        self._pos = pos
+
+        genes, counts, heap = (
+            self._genes,
+            self._overlapping_gene_counts,
+            self._overlapping_genes_heap,
+        )
+        changed = False
+        while self._num_genes_started < len(genes) and (
+            genes[self._num_genes_started][0] <= pos
+        ):
+            _, pos_end, gene_name = genes[self._num_genes_started]
+            heapq.heappush(heap, (pos_end, gene_name))
+            counts[gene_name] = counts.get(gene_name, 0) + 1
+            self._num_genes_started += 1
+            changed = True
+        while heap and heap[0][0] <= pos:
+            _, gene_name = heapq.heappop(heap)
+            counts[gene_name] -= 1
+            if counts[gene_name] == 0:
+                del counts[gene_name]
+            changed = True
+        if changed:
+            self._overlapping_genes = ",".join(sorted(counts))
+        if self._overlapping_genes:
+            return self._overlapping_genes
+
+        starts, ends = self._starts, self._ends
+        while self._num_starts_before < len(starts) and (
+            starts[self._num_starts_before] < pos
+        ):
+            self._num_starts_before += 1
+        while self._num_ends_before < len(ends) and ends[self._num_ends_before] <= pos:
+            self._num_ends_before += 1
+        nearest_gene_end = (
+            (
+                ends[self._num_ends_before - 1],
+                self._end_names[self._num_ends_before - 1],
+            )
+            if self._num_ends_before > 0
+            else None
+        )
+        nearest_gene_start = (
+            (starts[self._num_starts_before], genes[self._num_starts_before][2])
+            if self._num_starts_before < len(starts)
+            else None
+        )
+        if nearest_gene_end is None or nearest_gene_start is None:
+            if nearest_gene_end is not None:
+                return nearest_gene_end[1]
+            if nearest_gene_start is not None:
+                return nearest_gene_start[1]
+            print("This is very surprising - {!r} {!r}".format(chrom, pos))
+            return ""
+        dist_to_nearest_gene_end = abs(nearest_gene_end[0] - pos)
+        dist_to_nearest_gene_start = abs(nearest_gene_start[0] - pos)
+        if dist_to_nearest_gene_end < dist_to_nearest_gene_start:
+            return nearest_gene_end[1]
+        return nearest_gene_start[1]
+
+
 def annotate_genes(in_filepath: str, out_filepath: str) -> None:
     """Both args are filepaths"""
-    ga = GeneAnnotator(get_gene_tuples())
-    with VariantFileWriter(out_filepath) as out_f, VariantFileReader(
-        in_filepath
-    ) as variants:
-        for v in variants:
-            v["nearest_genes"] = ga.annotate_position(v["chrom"], v["pos"])
-            out_f.write(v)
+    with read_maybe_gzip(in_filepath) as f:
+        in_fields = next(csv.reader(f, dialect="pheweb-internal-dialect"))
+    out_fields = [
+        field
+        for field in parse_utils.fields
+        if field in in_fields or field == "nearest_genes"
+    ]
+    if [field for field in out_fields if field != "nearest_genes"] != in_fields:
+        with VariantFileWriter(out_filepath) as out_f, VariantFileReader(
+            in_filepath
+        ) as variants:
+            out_f.write_all(get_variants_with_nearest_genes(variants))
+        return
+
+    # Only `nearest_genes` is added, so the other columns are copied as strings instead of being parsed and re-formatted.
+    ga = SweepingGeneAnnotator(get_gene_tuples())
+    chrom_col, pos_col = in_fields.index("chrom"), in_fields.index("pos")
+    nearest_genes_col = out_fields.index("nearest_genes")
+    with read_maybe_gzip(in_filepath) as f, VariantFileWriter(out_filepath) as out_f:
+        reader = csv.reader(f, dialect="pheweb-internal-dialect")
+        next(reader)
+        out_f.write_rows(
+            out_fields,
+            (
+                row[:nearest_genes_col]
+                + [ga.annotate_position(row[chrom_col], int(row[pos_col]))]
+                + row[nearest_genes_col:]
+                for row in reader
+            ),
+        )
+
+
+def get_variants_with_nearest_genes(
+    variants: Iterator[Dict[str, Any]],
+) -> Iterator[Dict[str, Any]]:
+    ga = SweepingGeneAnnotator(get_gene_tuples())
+    for v in variants:
+        v["nearest_genes"] = ga.annotate_position(v["chrom"], v["pos"])
+        yield v
 
 
 def run(argv: List[str]) -> None:
@@ -125,9 +270,18 @@ def run(argv: List[str]) -> None:
 
         download_genes.run([])
 
-    if os.path.exists(out_filepath) and max(
-        mtime(genes_filepath), mtime(input_filepath)
-    ) <= mtime(out_filepath):
+    target = BuildTarget([out_filepath], [input_filepath, genes_filepath])
+    if target.is_up_to_date():
         print("gene annotation is up-to-date!")
+    elif target.was_made_from_fewer_lines_of(input_filepath):
+        # Only annotate the variants that were added to sites-rsids.tsv since sites.tsv was made.
+        old_hash = get_file_hash(out_filepath)
+        num_new_variants = update_annotated_variant_file(
+            input_filepath, out_filepath, get_variants_with_nearest_genes
+        )
+        print("Annotated {} new variants with nearest genes".format(num_new_variants))
+        target.record()
+        record_added_lines(out_filepath, old_hash)
     else:
         annotate_genes(input_filepath, out_filepath)
+        target.record()
@@ -11,6 +11,16 @@ Notes:
 In `resources/rsids-*.tsv.gz`, sometimes `alt` contains `N`, which matches any nucleotide I think.
 
 We read one full position at a time.  When we have a position-match, we find all rsids that match a variant.
+
+Instead of parsing the rsids file every time, we convert it once into a binary file (see `make_rsids_blocks.py`).
+For each position of `sites/sites-unannotated.tsv`, we only decompress the block of that file that might contain it.
+
+When annotating every variant, each chromosome is annotated in parallel:
+ + Each task skips through `sites/sites-unannotated.tsv` to its chromosome (see `file_utils.read_lines_on_chrom()`), and reads the blocks of its chromosome.
+ + Each task writes a gzipped part without a header.
+ + Concatenate a gzipped header and the parts in order.  (A file of concatenated gzip members is still a gzip file.)
+
+`debugging_limit_num_variants` only applies to the text rsids file, so with it set we parse that instead.
 """
 
 # TODO: do we need to left-normalize all indels?
@@ -22,13 +32,26 @@ from ..file_utils import (
     VariantFileReader,
     VariantFileWriter,
     get_filepath,
+    get_tmp_path,
     read_maybe_gzip,
 )
 from .. import conf
-from .load_utils import mtime
+from .. import parse_utils
+from .load_utils import update_annotated_variant_file, Parallelizer
+from .make_rsids_blocks import (
+    RsidBlocksReader,
+    get_rsids_blocks_filepath,
+    is_rsids_blocks_file_up_to_date,
+    make_rsids_blocks,
+)
+from .build_manifest import BuildTarget, get_file_hash, record_added_lines
 
 import os
 import sys
+import csv
+import bisect
+import gzip
+import shutil
 import itertools
 from typing import Iterator, Dict, Any, List
 
@@ -98,7 +121,8 @@ def get_rsid_reader(
                     )
                 assert rsid.startswith("rs")
                 # Sometimes the reference contains `N`, and that's okay.
-                assert all(base in "ATCGN" for base in ref), (
+                # `ref.strip("ATCGN")` is only empty if every base is in "ATCGN", and it doesn't loop in Python.
+                assert not ref.strip("ATCGN"), (
                     chrom,
                     pos,
                     ref,
@@ -108,10 +132,10 @@ def get_rsid_reader(
                     # Alt can be a comma-separated list
                     if alt == ".":
                         continue  # TODO: I don't understand what this means or why it happens.  Probably it should match any alt.
-                    assert all(base in "ATCGN" for base in alt), (chrom, pos, ref, alt)
+                    assert not alt.strip("ATCGN"), (chrom, pos, ref, alt)
                     yield {
                         "chrom": chrom,
-                        "pos": int(pos),
+                        "pos": pos,
                         "ref": ref,
                         "alt": alt,
                         "rsid": rsid,
@@ -160,20 +184,148 @@ def run(argv: List[str]) -> None:
 
         download_rsids.run([])
 
-    if os.path.exists(out_filepath) and max(
-        mtime(in_filepath), mtime(rsids_filepath)
-    ) <= mtime(out_filepath):
+    target = BuildTarget(
+        [out_filepath],
+        [in_filepath, rsids_filepath],
+        config={
+            "debugging_limit_num_variants": conf.get_debugging_limit_num_variants()
+        },
+    )
+    if target.is_up_to_date():
         print("rsid annotation is up-to-date!")
         return
 
-    with VariantFileReader(in_filepath) as in_reader, read_maybe_gzip(
-        rsids_filepath
-    ) as rsids_f, VariantFileWriter(out_filepath) as writer:
+    if conf.get_debugging_limit_num_variants():
+        rsids_blocks_filepath = None
+    else:
+        rsids_blocks_filepath = get_rsids_blocks_filepath()
+        if not is_rsids_blocks_file_up_to_date(rsids_blocks_filepath, rsids_filepath):
+            print(
+                "Converting {} to {} (this only happens when the rsids file changes)".format(
+                    rsids_filepath, rsids_blocks_filepath
+                )
+            )
+            make_rsids_blocks(rsids_filepath, rsids_blocks_filepath)
+
+    def annotate(variants: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        if rsids_blocks_filepath is None:
+            return annotate_rsids(variants, rsids_filepath)
+        return annotate_rsids_from_blocks(variants, rsids_blocks_filepath)
 
+    if target.was_made_from_fewer_lines_of(in_filepath):
+        # Only annotate the variants that were added to sites-unannotated.tsv since sites-rsids.tsv was made.
+        old_hash = get_file_hash(out_filepath)
+        num_new_variants = update_annotated_variant_file(
+            in_filepath, out_filepath, annotate
+        )
+        print("Annotated {} new variants with rsids".format(num_new_variants))
+        target.record()
+        record_added_lines(out_filepath, old_hash)
+        return
+
+    if rsids_blocks_filepath is not None and conf.get_num_procs("add-rsids") > 1:
+        annotate_rsids_by_chrom(in_filepath, rsids_blocks_filepath, out_filepath)
+    else:
+        with VariantFileReader(in_filepath) as in_reader, VariantFileWriter(
+            out_filepath
+        ) as writer:
+            writer.write_all(annotate(iter(in_reader)))
+    target.record()
+
+
+def annotate_rsids_by_chrom(
+    in_filepath: str, rsids_blocks_filepath: str, out_filepath: str
+) -> None:
+    with VariantFileReader(in_filepath) as in_reader:
+        in_fields = in_reader.fields
+    # These are the fields that `VariantFileWriter` will write, in the same order.
+    out_fields = [
+        field for field in parse_utils.fields if field in in_fields or field == "rsids"
+    ]
+    tasks = [
+        {
+            "in_filepath": in_filepath,
+            "rsids_blocks_filepath": rsids_blocks_filepath,
+            "chrom": chrom,
+            "out_filepath": get_tmp_path("sites-rsids-chr{}.tsv.gz".format(chrom)),
+        }
+        for chrom in chrom_order_list
+    ]
+    for _ in Parallelizer().run_single_tasks(
+        tasks, annotate_rsids_on_chrom, cmd="add-rsids"
+    ):
+        pass
+
+    tmp_filepath = get_tmp_path(out_filepath)
+    with open(tmp_filepath, "wb") as f:
+        with gzip.open(f, "wt", compresslevel=2) as f_gzip:
+            csv.writer(f_gzip, dialect="pheweb-internal-dialect").writerow(out_fields)
+        for task in tasks:
+            if os.path.exists(task["out_filepath"]):
+                with open(task["out_filepath"], "rb") as f_part:
+                    shutil.copyfileobj(f_part, f)
+                os.remove(task["out_filepath"])
+    os.replace(tmp_filepath, out_filepath)
+
+
+def annotate_rsids_on_chrom(task: Dict[str, Any]) -> None:
+    with VariantFileReader(task["in_filepath"], chrom=task["chrom"]) as in_reader:
+        variants = iter(in_reader)
+        first_variant = next(variants, None)
+        if first_variant is None:
+            return
+        with VariantFileWriter(task["out_filepath"], write_header=False) as writer:
+            writer.write_all(
+                annotate_rsids_from_blocks(
+                    itertools.chain([first_variant], variants),
+                    task["rsids_blocks_filepath"],
+                )
+            )
+
+
+def annotate_rsids_from_blocks(
+    variants: Iterator[Dict[str, Any]], rsids_blocks_filepath: str
+) -> Iterator[Dict[str, Any]]:
+    """Like `annotate_rsids()`, but reads a file made by `make_rsids_blocks()`."""
+    with RsidBlocksReader(rsids_blocks_filepath) as reader:
+        chrom = None
+        for cp_group in get_one_chr_pos_at_a_time(variants):
+            if cp_group[0]["chrom"] != chrom:
+                chrom = cp_group[0]["chrom"]
+                block_ranges = reader.get_block_ranges(chrom)
+                block_num, block, idx = 0, None, 0
+            pos = cp_group[0]["pos"]
+            # Skip the blocks that end before this position, without reading them.
+            while block_num < len(block_ranges) and block_ranges[block_num][1] < pos:
+                block_num, block, idx = block_num + 1, None, 0
+            matches = []
+            if block_num < len(block_ranges) and block_ranges[block_num][0] <= pos:
+                if block is None:
+                    block = reader.read_block(chrom, block_num)
+                positions, refs, alts, rsid_nums = block
+                idx = bisect.bisect_left(positions, pos, idx)
+                end = idx
+                while end < len(positions) and positions[end] == pos:
+                    end += 1
+                matches = list(zip(refs[idx:end], alts[idx:end], rsid_nums[idx:end]))
+            for cpra in cp_group:
+                cpra["rsids"] = ",".join(
+                    "rs{}".format(rsid_num)
+                    for ref, alt, rsid_num in matches
+                    if cpra["ref"] == ref and are_match(cpra["alt"], alt)
+                )
+                yield cpra
+
+
+def annotate_rsids(
+    variants: Iterator[Dict[str, Any]], rsids_filepath: str
+) -> Iterator[Dict[str, Any]]:
+    """Adds `rsids` to each variant.  `variants` must be sorted like the rsids file."""
+    with read_maybe_gzip(rsids_filepath) as rsids_f:
         rsid_group_reader = get_one_chr_pos_at_a_time(
             get_rsid_reader(rsids_f, rsids_filepath)
         )
-        cp_group_reader = get_one_chr_pos_at_a_time(in_reader)
+        cp_group_reader = get_one_chr_pos_at_a_time(variants)
 
         debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
         if debugging_limit_num_variants:
@@ -226,11 +378,11 @@ def run(argv: List[str]) -> None:
                     # if len(rsids) > 1:
                     #     print('WARNING: the variant {chrom}-{pos}-{ref}-{alt} has multiple rsids: {rsids}'.format(**cpra, rsids=rsids))
                     cpra["rsids"] = ",".join(rsids)
-                    writer.write(cpra)
+                    yield cpra
             else:
                 # No match, just print each cpra with an empty `rsids` column
                 for cpra in cp_group:
                     cpra["rsids"] = ""
-                    writer.write(cpra)
+                    yield cpra
 
         print(f"Annotation completed. Total positions processed: {count}")
@@ -2,6 +2,7 @@ from ..utils import PheWebError
 from ..file_utils import (
     VariantFileReader,
     VariantFileWriter,
+    ColumnarVariantFileWriter,
     get_filepath,
     get_pheno_filepath,
     with_chrom_idx,
@@ -32,6 +33,7 @@ def run(argv: List[str]) -> None:
         convert=convert,
         cmd="augment-pheno",
         phenos=phenos,
+        get_lookup_input_filepaths=get_lookup_input_filepaths,
     )
 
 
@@ -42,10 +44,16 @@ def get_input_filepaths(pheno: dict) -> List[str]:
     ]
 
 
+def get_lookup_input_filepaths(pheno: dict) -> List[str]:
+    # Each pheno only looks up its own variants in sites.tsv, so adding variants for new phenos doesn't change it.
+    return [get_filepath("sites")]
+
+
 def get_output_filepaths(pheno: dict) -> List[str]:
     return [
         get_pheno_filepath("pheno_gz", pheno["phenocode"], must_exist=False),
         get_pheno_filepath("pheno_gz_tbi", pheno["phenocode"], must_exist=False),
+        get_pheno_filepath("pheno_columns", pheno["phenocode"], must_exist=False),
     ]
 
 
@@ -55,12 +63,17 @@ def convert(pheno: Dict[str, Any]) -> None:
     sites_filepath = get_filepath("sites")
     out_filepath = get_pheno_filepath("pheno_gz", pheno["phenocode"], must_exist=False)
     out_unzipped_filepath = get_tmp_path(out_filepath)
+    out_columns_filepath = get_pheno_filepath(
+        "pheno_columns", pheno["phenocode"], must_exist=False
+    )
 
     with VariantFileReader(sites_filepath) as sites_reader, VariantFileReader(
         parsed_filepath
     ) as pheno_reader, VariantFileWriter(
         out_unzipped_filepath, use_gzip=False
-    ) as writer:
+    ) as writer, ColumnarVariantFileWriter(
+        out_columns_filepath
+    ) as columnar_writer:
         sites_variants = with_chrom_idx(iter(sites_reader))
         pheno_variants = with_chrom_idx(iter(pheno_reader))
 
@@ -71,6 +84,7 @@ def convert(pheno: Dict[str, Any]) -> None:
             pheno_variant.update(sites_variant)
             del pheno_variant["chrom_idx"]
             writer.write(pheno_variant)
+            columnar_writer.write(pheno_variant)
 
         try:
             pheno_variant = next(pheno_variants)
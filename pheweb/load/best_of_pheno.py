@@ -1,22 +1,43 @@
 """
 This script creates generated-by-pheweb/best-of-pheno/<pheno> which contains the strongest 100k associations for the phenotype.
+
+It also creates generated-by-pheweb/best_of_pheno_facets/<pheno>.npz, which has one entry per variant in best_of_pheno/<pheno> (in the same order):
+- `chrom_idx`, `pos` and `pval`, for `manhattan.ArrayBinner`
+- `flags`, with the bits `FLAG_INDEL`, `FLAG_LOF` and `FLAG_NONSYN`
+- `maf`, from `get_maf()` (NaN if it's unknown)
+so that `/api/manhattan-filtered/` can filter variants with numpy instead of parsing best_of_pheno/<pheno>.
 """
 
-from ..file_utils import VariantFileReader, VariantFileWriter, get_pheno_filepath
-from ..utils import chrom_order
+from ..file_utils import (
+    VariantFileReader,
+    VariantFileWriter,
+    get_pheno_filepath,
+    get_tmp_path,
+    read_maybe_gzip,
+)
+from .. import parse_utils
+from ..utils import chrom_order, vep_consqeuence_category, PheWebError
 from .load_utils import (
     MaxPriorityQueue,
     parallelize_per_pheno,
     get_phenos_subset,
     get_phenolist,
+    get_maf,
 )
 
+import os
+import csv
+import math
 import argparse
-from typing import List, Dict, Any
-
+import numpy as np
+from typing import List, Dict, Any, Optional
 
 NUM_VARIANTS = 100_000
 
+FLAG_INDEL = 1
+FLAG_LOF = 2
+FLAG_NONSYN = 4  # only for nonsynonymous variants that aren't loss-of-function
+
 
 def run(argv: List[str]) -> None:
     parser = argparse.ArgumentParser(description="Make a file .")
@@ -29,31 +50,198 @@ def run(argv: List[str]) -> None:
     phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
 
     parallelize_per_pheno(
-        get_input_filepaths=lambda pheno: get_pheno_filepath(
-            "pheno_gz", pheno["phenocode"]
-        ),
-        get_output_filepaths=lambda pheno: get_pheno_filepath(
-            "best_of_pheno", pheno["phenocode"], must_exist=False
-        ),
+        get_input_filepaths=get_input_filepaths,
+        get_output_filepaths=get_output_filepaths,
         convert=make_bestof_file,
         cmd="best_of_pheno",
         phenos=phenos,
     )
 
 
+def get_input_filepaths(pheno: dict) -> List[str]:
+    return [get_pheno_filepath("pheno_gz", pheno["phenocode"])]
+
+
+def get_output_filepaths(pheno: dict) -> List[str]:
+    return [
+        get_pheno_filepath("best_of_pheno", pheno["phenocode"], must_exist=False),
+        get_pheno_filepath(
+            "best_of_pheno_facets", pheno["phenocode"], must_exist=False
+        ),
+    ]
+
+
 def make_bestof_file(pheno: Dict[str, Any]) -> None:
     make_bestof_file_explicit(
         get_pheno_filepath("pheno_gz", pheno["phenocode"]),
         get_pheno_filepath("best_of_pheno", pheno["phenocode"], must_exist=False),
+        get_pheno_filepath(
+            "best_of_pheno_facets", pheno["phenocode"], must_exist=False
+        ),
+        pheno,
     )
 
 
-def make_bestof_file_explicit(in_filepath: str, out_filepath: str) -> None:
+def make_bestof_file_explicit(
+    in_filepath: str,
+    out_filepath: str,
+    facets_filepath: Optional[str] = None,
+    pheno: Optional[Dict[str, Any]] = None,
+) -> None:
     q = MaxPriorityQueue()
     with VariantFileReader(in_filepath) as vfr:
         for v in vfr:
             q.add_and_keep_size(v, v["pval"], NUM_VARIANTS)
+    write_bestof_file(q, out_filepath, facets_filepath=facets_filepath, pheno=pheno)
+
+
+def write_bestof_file(
+    q: MaxPriorityQueue,
+    out_filepath: str,
+    fields: Optional[List[str]] = None,
+    facets_filepath: Optional[str] = None,
+    pheno: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    If `fields` is given, only those are written (eg, to drop keys that `manhattan.Binner` added to shared variants).
+    If `facets_filepath` is given, the facets are written there.  `pheno` is used to get the MAF from `ac`.
+    """
     assocs = list(q.pop_all())
     assocs.sort(key=lambda v: (chrom_order[v["chrom"]], v["pos"]))
+    if fields is not None:
+        assocs = [{field: v[field] for field in fields} for v in assocs]
     with VariantFileWriter(out_filepath) as vfw:
         vfw.write_all(assocs)
+    if facets_filepath is not None:
+        write_facets_file(assocs, facets_filepath, pheno or {})
+
+
+def write_facets_file(
+    assocs: List[Dict[str, Any]], out_filepath: str, pheno: Dict[str, Any]
+) -> None:
+    flags, mafs = [], []
+    for v in assocs:
+        flag = FLAG_INDEL if len(v["ref"]) != 1 or len(v["alt"]) != 1 else 0
+        csq = vep_consqeuence_category.get(v.get("consequence", ""), "")
+        if csq == "lof":
+            flag |= FLAG_LOF
+        elif csq == "nonsyn":
+            flag |= FLAG_NONSYN
+        flags.append(flag)
+        maf = get_maf_for_filtering(v, pheno)
+        mafs.append(math.nan if maf is None else maf)
+    tmp_filepath = get_tmp_path(out_filepath)
+    os.makedirs(os.path.dirname(out_filepath), exist_ok=True)
+    with open(tmp_filepath, "wb") as f:
+        np.savez(
+            f,
+            chrom_idx=np.array(
+                [chrom_order[v["chrom"]] for v in assocs], dtype=np.uint8
+            ),
+            pos=np.array([v["pos"] for v in assocs], dtype=np.uint32),
+            pval=np.array([v["pval"] for v in assocs], dtype=np.float64),
+            flags=np.array(flags, dtype=np.uint8),
+            maf=np.array(mafs, dtype=np.float64),
+        )
+    os.replace(tmp_filepath, out_filepath)
+
+
+def get_maf_for_filtering(v: Dict[str, Any], pheno: Dict[str, Any]) -> Optional[float]:
+    """Returns the MAF that `/api/manhattan-filtered/` filters `v` by, or None if it's unknown (or its fields disagree), in which case `v` isn't filtered out by MAF."""
+    try:
+        return get_maf(v, pheno)
+    except PheWebError:
+        return None
+
+
+def keeps_variant(
+    v: Dict[str, Any],
+    pheno: Dict[str, Any],
+    indel: str,
+    consequence_category: str,
+    min_maf: Optional[float],
+    max_maf: Optional[float],
+) -> bool:
+    """Like `get_facets_mask()`, but for one parsed variant, for when there's no facets file."""
+    if indel == "true" and len(v["ref"]) == 1 and len(v["alt"]) == 1:
+        return False
+    if indel == "false" and (len(v["ref"]) != 1 or len(v["alt"]) != 1):
+        return False
+    if min_maf is not None or max_maf is not None:
+        maf = get_maf_for_filtering(v, pheno)
+        if maf is not None and min_maf is not None and maf < min_maf:
+            return False
+        if maf is not None and max_maf is not None and maf > max_maf:
+            return False
+    if consequence_category:
+        csq = vep_consqeuence_category.get(v.get("consequence", ""), "")
+        if consequence_category == "lof" and csq != "lof":
+            return False
+        if consequence_category == "nonsyn" and not csq:
+            return False
+    return True
+
+
+def read_facets_file(filepath: str) -> Dict[str, np.ndarray]:
+    with np.load(filepath) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def get_facets_mask(
+    facets: Dict[str, np.ndarray],
+    indel: str,
+    consequence_category: str,
+    min_maf: Optional[float],
+    max_maf: Optional[float],
+) -> np.ndarray:
+    """Returns which variants `/api/manhattan-filtered/` keeps, given its GET parameters."""
+    flags = facets["flags"]
+    mask = np.ones(len(flags), dtype=bool)
+    if indel == "true":
+        mask &= (flags & FLAG_INDEL) != 0
+    elif indel == "false":
+        mask &= (flags & FLAG_INDEL) == 0
+    if min_maf is not None:
+        mask &= ~(facets["maf"] < min_maf)  # NaN isn't filtered out
+    if max_maf is not None:
+        mask &= ~(facets["maf"] > max_maf)
+    if consequence_category == "lof":
+        mask &= (flags & FLAG_LOF) != 0
+    elif consequence_category == "nonsyn":
+        mask &= (flags & (FLAG_LOF | FLAG_NONSYN)) != 0
+    return mask
+
+
+class BestOfPhenoLines:
+    """
+    Parses single variants from best_of_pheno/<pheno>, by their index in it.
+    The file is only decompressed and split into lines, which is much faster than parsing every variant.
+    """
+
+    def __init__(self, filepath: str):
+        with read_maybe_gzip(filepath) as f:
+            lines = f.read().split("\n")
+        if lines and lines[-1] == "":
+            lines.pop()
+        self.fields = next(csv.reader(lines[:1], dialect="pheweb-internal-dialect"))
+        self._parsers = [parse_utils.reader_for_field[field] for field in self.fields]
+        self._lines = lines
+        self._filepath = filepath
+
+    def __len__(self) -> int:
+        return len(self._lines) - 1
+
+    def get_variant(self, idx: int) -> Dict[str, Any]:
+        values = next(
+            csv.reader([self._lines[idx + 1]], dialect="pheweb-internal-dialect")
+        )
+        if len(values) != len(self.fields):
+            raise PheWebError(
+                "The line {} of {} has {} fields but the header has {}".format(
+                    idx + 2, self._filepath, len(values), len(self.fields)
+                )
+            )
+        return {
+            field: parser(value)
+            for field, parser, value in zip(self.fields, self._parsers, values)
+        }
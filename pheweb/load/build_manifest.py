@@ -0,0 +1,310 @@
+"""
+The build manifest remembers what each output of `pheweb process` was made from, so that a step only re-runs when its inputs really changed.
+
+For each output file, it stores a fingerprint: a hash of the content of every input file and of the config values that affect the output.
+An output is up-to-date if it exists and its recorded fingerprint matches the current one.
+Since the input filepaths are part of the fingerprint, removing a phenotype makes outputs built from every phenotype out-of-date.
+
+Content hashes are cached by (size, mtime, inode), so a file is only re-read when it might have changed.
+If an `rsync` touches mtimes without changing content, the files are re-hashed but nothing is rebuilt.
+`PerPhenoParallelizer` checks the phenotypes whose inputs need re-hashing in its worker processes.
+
+Outputs made before the manifest existed have no fingerprint.  For those we fall back to comparing mtimes, and record them if they're up-to-date.
+
+Some steps can update their outputs incrementally when phenotypes are added:
+- `get_added_input_filepaths()` tells `pheweb sites` which `parsed/*` files are new.
+- `record_added_lines()` remembers that the new version of a file only has some extra variants,
+  so that `was_made_from_fewer_lines_of()` can tell `add-rsids` and `add-genes` to only annotate those variants,
+  and so that `augment-phenos` doesn't re-make `pheno_gz/*` files that only look up their own variants in `sites.tsv`.
+
+    target = BuildTarget([out_filepath], input_filepaths, config={"assoc_min_maf": conf.get_assoc_min_maf()})
+    if not target.is_up_to_date():
+        make(out_filepath)
+        target.record()
+"""
+
+from .. import conf
+from ..file_utils import get_filepath
+
+import os
+import json
+import hashlib
+import sqlite3
+import collections
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, Sequence, Iterator, List, Tuple
+
+HASH_BUFFER_SIZE = 2**20
+MAX_NUM_ADDED_LINES_VERSIONS = 100
+
+
+# (pid, db_filepath, connection).  Each process opens its own connection, since SQLite connections mustn't be used across `fork()`.
+_connection: Optional[Tuple[int, str, sqlite3.Connection]] = None
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Yields this process's connection to the manifest, opening it (and creating the tables) the first time."""
+    global _connection
+    db_filepath = get_filepath("build-manifest", must_exist=False)
+    if _connection is not None and _connection[:2] == (os.getpid(), db_filepath):
+        yield _connection[2]
+        return
+    # Worker processes record outputs concurrently, so wait for each other's locks.
+    db = sqlite3.connect(db_filepath, timeout=600)
+    with db:
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes (filepath TEXT PRIMARY KEY, size INT, mtime_ns INT, inode INT, hash TEXT)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs (filepath TEXT PRIMARY KEY, fingerprint TEXT, description TEXT)"
+        )
+        if "description" not in [
+            row[1] for row in db.execute("PRAGMA table_info(outputs)")
+        ]:
+            db.execute("ALTER TABLE outputs ADD COLUMN description TEXT")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS added_lines (filepath TEXT, old_hash TEXT, new_hash TEXT, PRIMARY KEY (filepath, new_hash, old_hash))"
+        )
+    if _connection is not None and _connection[0] == os.getpid():
+        _connection[2].close()  # It was for another data_dir.
+    _connection = (os.getpid(), db_filepath, db)
+    yield db
+
+
+def get_file_hash(filepath: str) -> str:
+    """
+    Returns the content hash of `filepath`, re-reading the file only if its size, mtime or inode changed.
+    For a directory (like `pheno_columns/*`), hashes the names and contents of the files in it.
+    """
+    filepath = os.path.abspath(filepath)
+    if os.path.isdir(filepath):
+        h = hashlib.blake2b(digest_size=20)
+        for name in sorted(os.listdir(filepath)):
+            h.update(
+                "{}\t{}\n".format(
+                    name, get_file_hash(os.path.join(filepath, name))
+                ).encode()
+            )
+        return h.hexdigest()
+    st = os.stat(filepath)
+    cached_hash = _get_cached_hash(filepath, st)
+    if cached_hash is not None:
+        return cached_hash
+    h = hashlib.blake2b(digest_size=20)
+    with open(filepath, "rb") as f:
+        while True:
+            data = f.read(HASH_BUFFER_SIZE)
+            if not data:
+                break
+            h.update(data)
+    ret = h.hexdigest()
+    with _connect() as db, db:
+        db.execute(
+            "INSERT OR REPLACE INTO file_hashes (filepath, size, mtime_ns, inode, hash) VALUES (?,?,?,?,?)",
+            (filepath, st.st_size, st.st_mtime_ns, st.st_ino, ret),
+        )
+    return ret
+
+
+def _get_cached_hash(filepath: str, st: os.stat_result) -> Optional[str]:
+    with _connect() as db:
+        row = db.execute(
+            "SELECT hash FROM file_hashes WHERE filepath=? AND size=? AND mtime_ns=? AND inode=?",
+            (filepath, st.st_size, st.st_mtime_ns, st.st_ino),
+        ).fetchone()
+    return None if row is None else row[0]
+
+
+def get_unhashed_size(filepath: str) -> int:
+    """Returns how many bytes `get_file_hash(filepath)` would have to read, which is 0 if its hash is cached."""
+    filepath = os.path.abspath(filepath)
+    if os.path.isdir(filepath):
+        return sum(
+            get_unhashed_size(os.path.join(filepath, name))
+            for name in os.listdir(filepath)
+        )
+    st = os.stat(filepath)
+    return 0 if _get_cached_hash(filepath, st) is not None else st.st_size
+
+
+def _get_relpath(filepath: str) -> Optional[str]:
+    # Use paths relative to data_dir, so that moving the data_dir doesn't make everything out-of-date.
+    relpath = os.path.relpath(os.path.abspath(filepath), conf.get_data_dir())
+    return None if relpath.startswith(os.pardir) else relpath
+
+
+def record_added_lines(filepath: str, old_hash: str) -> None:
+    """
+    Remember that `filepath` was rewritten with some variants added to it, and every variant that was in the version with `old_hash` left as it was.
+    Call this after `BuildTarget.record()`.
+    """
+    new_hash = get_file_hash(filepath)
+    if new_hash == old_hash:
+        return
+    with _connect() as db, db:
+        db.execute(
+            "INSERT OR REPLACE INTO added_lines (filepath, old_hash, new_hash) VALUES (?,?,?)",
+            (_get_relpath(filepath) or os.path.abspath(filepath), old_hash, new_hash),
+        )
+
+
+def _get_versions_with_fewer_lines(filepath: str) -> List[str]:
+    """Returns the hashes of older versions of `filepath` that the current version only added lines to."""
+    name = _get_relpath(filepath) or os.path.abspath(filepath)
+    ret: List[str] = []
+    queue = collections.deque([get_file_hash(filepath)])
+    with _connect() as db:
+        while queue and len(ret) < MAX_NUM_ADDED_LINES_VERSIONS:
+            new_hash = queue.popleft()
+            for (old_hash,) in db.execute(
+                "SELECT old_hash FROM added_lines WHERE filepath=? AND new_hash=?",
+                (name, new_hash),
+            ):
+                if old_hash not in ret:
+                    ret.append(old_hash)
+                    queue.append(old_hash)
+    return ret
+
+
+class BuildTarget:
+    def __init__(
+        self,
+        output_filepaths: Sequence[str],
+        input_filepaths: Sequence[str],
+        config: Optional[Dict[str, Any]] = None,
+        lookup_input_filepaths: Sequence[str] = (),
+    ):
+        """
+        `lookup_input_filepaths` are inputs (like `sites.tsv` for `augment-phenos`) that are only used to look up the variants in the other inputs,
+        so adding variants to them (see `record_added_lines()`) doesn't make the outputs out-of-date.
+        """
+        self.output_filepaths = list(output_filepaths)
+        self._output_names = [
+            _get_relpath(fp) or os.path.abspath(fp) for fp in output_filepaths
+        ]
+        self.input_filepaths = list(input_filepaths)
+        self.config = config or {}
+        self.lookup_input_filepaths = list(lookup_input_filepaths)
+        self._input_hashes: Optional[List[str]] = None
+
+    def _get_input_hashes(self) -> List[str]:
+        if self._input_hashes is None:
+            self._input_hashes = [get_file_hash(fp) for fp in self.input_filepaths]
+        return self._input_hashes
+
+    def _get_description(self, replaced_hashes: Optional[Dict[str, str]] = None) -> str:
+        # Input files outside of data_dir (like `assoc_files`) are only identified by their contents.
+        inputs = sorted(
+            (_get_relpath(fp) or "", (replaced_hashes or {}).get(fp, h))
+            for fp, h in zip(self.input_filepaths, self._get_input_hashes())
+        )
+        return json.dumps(
+            {"inputs": inputs, "config": self.config}, sort_keys=True, default=repr
+        )
+
+    def get_fingerprint(self, replaced_hashes: Optional[Dict[str, str]] = None) -> str:
+        """
+        Hashes the inputs the first time it's called, so call this before building if the inputs might change during the build.
+        `replaced_hashes` is like `{input_filepath: hash}`, to get the fingerprint that an older version of the inputs would have had.
+        """
+        return hashlib.blake2b(
+            self._get_description(replaced_hashes).encode(), digest_size=20
+        ).hexdigest()
+
+    def _get_recorded(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """Returns `{output_name: (fingerprint, description)}` for each output that's in the manifest."""
+        with _connect() as db:
+            return {
+                filepath: (fingerprint, description)
+                for filepath, fingerprint, description in db.execute(
+                    "SELECT filepath, fingerprint, description FROM outputs WHERE filepath IN ({})".format(
+                        ",".join("?" * len(self._output_names))
+                    ),
+                    self._output_names,
+                )
+            }
+
+    def is_up_to_date(self) -> bool:
+        if not all(os.path.exists(fp) for fp in self.output_filepaths):
+            return False
+        recorded_fingerprints = {
+            filepath: recorded[0] for filepath, recorded in self._get_recorded().items()
+        }
+        if len(recorded_fingerprints) < len(self._output_names):
+            # Made before the manifest existed, so check it the old way, and only hash the inputs if it's up-to-date.
+            if self.input_filepaths and max(
+                os.stat(fp).st_mtime for fp in self.input_filepaths
+            ) > min(os.stat(fp).st_mtime for fp in self.output_filepaths):
+                return False
+            self.record()
+            return True
+        fingerprint = self.get_fingerprint()
+        if all(
+            recorded_fingerprint == fingerprint
+            for recorded_fingerprint in recorded_fingerprints.values()
+        ):
+            return True
+        if any(
+            self.was_made_from_fewer_lines_of(fp) for fp in self.lookup_input_filepaths
+        ):
+            self.record()
+            return True
+        return False
+
+    def was_made_from_fewer_lines_of(self, input_filepath: str) -> bool:
+        """
+        Returns True if the outputs were made from the current versions of every input except `input_filepath`,
+        and from an older version of `input_filepath` that the current version only added variants to.
+        """
+        if not all(os.path.exists(fp) for fp in self.output_filepaths):
+            return False
+        recorded = self._get_recorded()
+        recorded_fingerprints = set(fingerprint for fingerprint, _ in recorded.values())
+        if len(recorded) < len(self._output_names) or len(recorded_fingerprints) != 1:
+            return False
+        return any(
+            self.get_fingerprint({input_filepath: old_hash}) in recorded_fingerprints
+            for old_hash in _get_versions_with_fewer_lines(input_filepath)
+        )
+
+    def get_added_input_filepaths(self) -> Optional[List[str]]:
+        """
+        If the outputs were made from some of the current inputs (with the same contents and config), returns the inputs that have been added since then.
+        Otherwise, returns None.
+        """
+        if not all(os.path.exists(fp) for fp in self.output_filepaths):
+            return None
+        recorded = self._get_recorded()
+        descriptions = set(description for _, description in recorded.values())
+        if len(recorded) < len(self._output_names) or len(descriptions) != 1:
+            return None
+        recorded_description = json.loads(descriptions.pop() or "null")
+        if recorded_description is None:
+            return None
+        current_description = json.loads(self._get_description())
+        if recorded_description["config"] != current_description["config"]:
+            return None
+        remaining_inputs = collections.Counter(
+            tuple(name_and_hash) for name_and_hash in recorded_description["inputs"]
+        )
+        added_input_filepaths = []
+        for fp, h in zip(self.input_filepaths, self._get_input_hashes()):
+            name_and_hash = (_get_relpath(fp) or "", h)
+            if remaining_inputs[name_and_hash] > 0:
+                remaining_inputs[name_and_hash] -= 1
+            else:
+                added_input_filepaths.append(fp)
+        if sum(remaining_inputs.values()) > 0:
+            return None  # Some inputs were removed or changed.
+        return added_input_filepaths
+
+    def record(self) -> None:
+        """Remember that the outputs were made from the current inputs."""
+        description = self._get_description()
+        fingerprint = self.get_fingerprint()
+        with _connect() as db, db:
+            db.executemany(
+                "INSERT OR REPLACE INTO outputs (filepath, fingerprint, description) VALUES (?,?,?)",
+                [(name, fingerprint, description) for name in self._output_names],
+            )
@@ -17,6 +17,6 @@ ffibuilder.set_source(
 )
 ffibuilder.cdef(
     """
-const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath);
+const char* cffi_make_matrix_chrom(const char *sites_filepath, const char **pheno_filepaths, const uint64_t *pheno_virtual_offsets, size_t n_phenos, const char *chrom, const char *matrix_part_filepath, int write_header);
 """
 )
@@ -12,7 +12,6 @@ compile with:
 #include <sstream>
 #include <vector>
 #include <string>
-#include <glob.h>
 #include <stdlib.h>
 #include <sys/resource.h> // setrlimit
 #include <stdio.h>
@@ -20,6 +19,8 @@ compile with:
 #include <iomanip> // setprecision
 #include <zlib.h>
 #include <fcntl.h> // O_WRONLY &c
+#include <unistd.h> // lseek
+#include <stdint.h> // uint64_t
 #include <exception> // do I need this?
 
 
@@ -30,9 +31,11 @@ class BgzipWriter {
 // This is adapted from <https://github.com/samtools/htslib/blob/master/bgzf.c>,
 // also referencing <http://github.com/samtools/htslib/blob/master/bgzip.c>
 public:
-    BgzipWriter(std::string filepath) {
+    // If `write_eof_block` is false, the file can be concatenated with others, and the last of them must end with an EOF block.
+    BgzipWriter(std::string filepath, bool write_eof_block = true) {
         if (compressBound(BGZF_BLOCK_SIZE) > BGZF_MAX_BLOCK_SIZE) { throw std::runtime_error("[BGZF_MAX_BLOCK_SIZE is too small to hold compressed random data]"); }
         _filepath = filepath;
+        _write_eof_block = write_eof_block;
         _file.open(filepath.c_str(), std::ios::out | std::ios::binary);
         _uncompressed_block = new uint8_t[2*BGZF_MAX_BLOCK_SIZE];
         _compressed_block = _uncompressed_block + BGZF_MAX_BLOCK_SIZE;
@@ -62,9 +65,10 @@ public:
         write(src_string.c_str(), src_string.length());
     }
     void close() {
-        // Make one empty block at the end to indicate EOF (as per samtools unofficial spec)
         if (_uncompressed_block_size) flush_uncompressed();
-        flush_uncompressed();
+        // Make one empty block at the end to indicate EOF (as per samtools unofficial spec)
+        if (_write_eof_block) flush_uncompressed();
+        _file.close();
     }
 private:
      static inline void packInt16(uint8_t *buffer, uint16_t value) {
@@ -150,6 +154,7 @@ private:
         _uncompressed_block_size = 0;
     }
     std::string _filepath;
+    bool _write_eof_block;
     std::ofstream _file;
     uint8_t *_uncompressed_block; // 64KiB
     uint8_t *_compressed_block; // 64KiB
@@ -191,6 +196,7 @@ public:
     }
     int is_open() { return opened; }
     gzstreambuf* open( const char* name, int open_mode);
+    gzstreambuf* open_at_virtual_offset( const char* name, uint64_t virtual_offset);
     gzstreambuf* close();
     ~gzstreambuf() { close(); }
     virtual int     overflow( int c = EOF);
@@ -217,6 +223,10 @@ public:
     void open( const char* name, int open_mode = std::ios::in) {
         gzstreambase::open( name, open_mode);
     }
+    void open_at_virtual_offset( const char* name, uint64_t virtual_offset) {
+        if ( ! buf.open_at_virtual_offset( name, virtual_offset))
+            clear( rdstate() | std::ios::badbit);
+    }
 };
 gzstreambuf* gzstreambuf::open( const char* name, int open_mode) {
     if ( is_open())
@@ -240,6 +250,31 @@ gzstreambuf* gzstreambuf::open( const char* name, int open_mode) {
     opened = 1;
     return this;
 }
+// Opens a bgzip file for reading at a virtual offset (from a tabix index), ie `(block_offset << 16) | offset_within_block`.
+gzstreambuf* gzstreambuf::open_at_virtual_offset( const char* name, uint64_t virtual_offset) {
+    if ( is_open())
+        return (gzstreambuf*)0;
+    mode = std::ios::in;
+    int fd = ::open(name, O_RDONLY);
+    if (fd < 0)
+        return (gzstreambuf*)0;
+    if (lseek(fd, (off_t)(virtual_offset >> 16), SEEK_SET) < 0) {
+        ::close(fd);
+        return (gzstreambuf*)0;
+    }
+    // Every bgzip block is a complete gzip member, so zlib can start reading at any block.
+    file = gzdopen(fd, "rb");
+    if (file == 0) {
+        ::close(fd);
+        return (gzstreambuf*)0;
+    }
+    if (gzseek(file, (z_off_t)(virtual_offset & 0xffff), SEEK_CUR) < 0) {
+        gzclose(file);
+        return (gzstreambuf*)0;
+    }
+    opened = 1;
+    return this;
+}
 gzstreambuf * gzstreambuf::close() {
     if ( is_open()) {
         sync();
@@ -322,20 +357,36 @@ void gzstreambase::close() {
 
 
 // ------
-// Line-by-line file-reader that can handle plaintext or gzip files
-class LineReader {
+// Line-by-line reader for `make_matrix_chrom()` that can handle plaintext or gzip files.
+// `has_line` stays true until `line` is no longer a real line, so the last line of a file is used like the others.
+class ChromLineReader {
 public:
-    inline void attach(const std::string& filepath) { // immediately reads the first line
+    inline void attach(const std::string& filepath) {
         stream.open(filepath.c_str());
+        if (!stream.good()) throw_open_error(filepath);
+        next();
+    }
+    inline void attach_at_virtual_offset(const std::string& filepath, uint64_t virtual_offset) {
+        stream.open_at_virtual_offset(filepath.c_str(), virtual_offset);
+        if (!stream.good()) throw_open_error(filepath);
         next();
     }
     inline void next() {
-        std::getline(stream, line); // drops the \n
-        if (!line.empty() && line[line.size() - 1] == '\r') line.erase(line.size() - 1); // CR remover from <http://stackoverflow.com/a/2529011/1166306>
+        has_line = (bool)std::getline(stream, line);
+        if (!line.empty() && line[line.size() - 1] == '\r') line.erase(line.size() - 1);
+    }
+    inline bool is_on_chrom(const std::string& chrom_and_tab) const {
+        return has_line && 0 == line.compare(0, chrom_and_tab.size(), chrom_and_tab);
     }
-    inline bool eof() { return stream.peek() == std::ifstream::traits_type::eof(); } // tells whether `next()` will work.
+    bool has_line = false;
     std::string line;
     igzstream stream;
+private:
+    static void throw_open_error(const std::string& filepath) {
+        std::ostringstream errstream;
+        errstream << "[failed to open " << filepath << "]";
+        throw std::runtime_error(errstream.str().c_str());
+    }
 };
 
 
@@ -358,18 +409,6 @@ static inline void set_ulimit_num_files(unsigned num_files) {
   }
 }
 
-static inline std::vector<std::string> glob(const std::string& pat) {
-  // From <http://stackoverflow.com/a/8615450/1166306>
-  glob_t glob_result;
-  glob(pat.c_str(),GLOB_TILDE,NULL,&glob_result);
-  std::vector<std::string> ret;
-  for(unsigned int i=0;i<glob_result.gl_pathc;++i){
-    ret.push_back(std::string(glob_result.gl_pathv[i]));
-  }
-  globfree(&glob_result);
-  return ret;
-}
-
 static inline size_t pos_after_n_of_char(std::string str, size_t n, char c) {
     // return the position AFTER `n` instances of the char `c`
     size_t i = 0;
@@ -397,21 +436,32 @@ bool endsWith (std::string const &str, std::string const &suffix) {
 // ------
 // main
 
-int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
-    BgzipWriter writer(matrix_filepath);
+// Makes the part of matrix.tsv.gz for the variants on one chromosome.
+// Each pheno file is read starting at its virtual offset for this chromosome (from its tabix index),
+// or skipped if its offset is `NO_VIRTUAL_OFFSET` because it has no variants on this chromosome.
+// The output has no EOF block, so that the parts for all chromosomes can be concatenated.
+static const uint64_t NO_VIRTUAL_OFFSET = UINT64_MAX;
+int make_matrix_chrom(const char *sites_filepath, const char **pheno_filepaths, const uint64_t *pheno_virtual_offsets, size_t N_phenos, const char *chrom, const char *matrix_part_filepath, int write_header) {
+    BgzipWriter writer(matrix_part_filepath, false);
+    const std::string chrom_and_tab = std::string(chrom) + "\t";
 
-    LineReader sites_reader;
+    ChromLineReader sites_reader;
     sites_reader.attach(sites_filepath);
 
-    std::vector<std::string> aug_filepaths = glob(augmented_pheno_glob);
-    size_t N_phenos = aug_filepaths.size();
-    std::vector<LineReader> aug_readers(N_phenos);
+    std::vector<ChromLineReader> aug_readers(N_phenos);
     std::vector<std::string> aug_phenocodes(N_phenos);
     std::vector<unsigned> aug_n_per_assoc_fields(N_phenos); // initialized to 0s.
-    set_ulimit_num_files(N_phenos + 100); // are python files still open?
+    set_ulimit_num_files(N_phenos + 100);
+
+    // Headers:
+    static const std::string cpra_header = "chrom\tpos\tref\talt\t";
+    if(!sites_reader.has_line || 0 != sites_reader.line.compare(0, cpra_header.size(), cpra_header)) { throw std::runtime_error("[sites.tsv header doesn't begin with \"chrom\tpos\tref\talt\t\"]"); }
+    if (write_header) {
+        writer.write("#"); // tabix needs the header commented.
+        writer.write(sites_reader.line); // no trailing \t or \n
+    }
     for (size_t i = 0; i < N_phenos; i++) {
-        aug_readers[i].attach(aug_filepaths[i]);
-        aug_phenocodes[i] = aug_filepaths[i];
+        aug_phenocodes[i] = pheno_filepaths[i];
         size_t last_slash_idx = aug_phenocodes[i].find_last_of("/");
         if (std::string::npos != last_slash_idx) {
             aug_phenocodes[i].erase(0, last_slash_idx + 1);
@@ -419,58 +469,53 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
         if (endsWith(aug_phenocodes[i], ".gz")) {
             aug_phenocodes[i] = aug_phenocodes[i].erase(aug_phenocodes[i].length() - 3);
         }
-    }
-
-    // Headers:
-    // sites.tsv's header must begin with "chrom pos ref alt ".
-    // Every file's header must begin with the header of sites.tsv
-    // All fields after the ones in sites.tsv will be written as "<field>@<pheno>"
-    static const std::string cpra_header = "chrom\tpos\tref\talt\t";
-    if(0 != sites_reader.line.compare(0, cpra_header.size(), cpra_header)) { throw std::runtime_error("[sites.tsv header doesn't begin with \"chrom\tpos\tref\talt\t\"]"); }
-    for (size_t i=0; i < N_phenos; i++) {
-        if(0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
+        std::string pheno_header;
+        {
+            ChromLineReader header_reader;
+            header_reader.attach(pheno_filepaths[i]);
+            pheno_header = header_reader.line;
+        }
+        if(0 != pheno_header.compare(0, sites_reader.line.size(), sites_reader.line)) {
             std::ostringstream errstream;
             errstream << "[One of the pheno files has a header that doesn't begin with the header of sites.tsv (or it failed to read).]";
             errstream << "[bad phenocode = " << aug_phenocodes[i] << "]";
-            errstream << "[bad pheno file = " << aug_filepaths[i] << "]";
-            errstream << "[bad pheno header = " << aug_readers[i].line << "]";
+            errstream << "[bad pheno file = " << pheno_filepaths[i] << "]";
+            errstream << "[bad pheno header = " << pheno_header << "]";
             errstream << "[sites.tsv header = " << sites_reader.line << "]";
             throw std::runtime_error(errstream.str().c_str());
         }
-    }
-    writer.write("#"); // tabix needs the header commented.
-    writer.write(sites_reader.line); // no trailing \t or \n
-    for (size_t i=0; i < N_phenos; i++) {
-        std::string per_assoc_fields = aug_readers[i].line.substr(sites_reader.line.size(), std::string::npos);
+        std::string per_assoc_fields = pheno_header.substr(sites_reader.line.size(), std::string::npos);
         std::istringstream line_stream(per_assoc_fields);
         std::string field;
         std::getline(line_stream, field, '\t'); // consume first tab.
         while(std::getline(line_stream, field, '\t')) {
-            writer.write("\t");
-            writer.write(field);
-            writer.write("@");
-            writer.write(aug_phenocodes[i]);
+            if (write_header) {
+                writer.write("\t");
+                writer.write(field);
+                writer.write("@");
+                writer.write(aug_phenocodes[i]);
+            }
             aug_n_per_assoc_fields[i]++;
         }
+        if (pheno_virtual_offsets[i] != NO_VIRTUAL_OFFSET) {
+            aug_readers[i].attach_at_virtual_offset(pheno_filepaths[i], pheno_virtual_offsets[i]);
+        }
     }
-    writer.write("\n");
+    if (write_header) writer.write("\n");
     const size_t n_per_variant_fields = n_fields(sites_reader.line);
-    // advance every file to its 1st data-line
+
+    // Skip to our chromosome in sites.tsv.  It's not bgzipped, so we can't seek.
     sites_reader.next();
-    for (size_t i=0; i<N_phenos; i++) aug_readers[i].next();
+    while (sites_reader.has_line && !sites_reader.is_on_chrom(chrom_and_tab)) sites_reader.next();
 
     // Data:
-    // Every aug_pheno is a subsequence of sites.tsv.
-    // If a line in an aug_pheno has the same chrom-pos-ref-alt as sites.tsv, then it must have the sites.tsv line as its prefix.
-    //    (ie, it must have the same per-variant fields, in the same order.)
-    // So, we iterate over sites.tsv, printing and advancing any aug_pheno that matches CPRA, and printing '' for every field in non-matching aug_phenos.
-    while(1) {
+    for (; sites_reader.is_on_chrom(chrom_and_tab); sites_reader.next()) {
         writer.write(sites_reader.line);
 
         size_t pos_after_cpra = pos_after_n_of_char(sites_reader.line, 4, '\t');
 
         for (size_t i=0; i<N_phenos; i++) {
-            if (!aug_readers[i].eof() && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
+            if (aug_readers[i].has_line && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
                 if (0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
                     std::ostringstream errstream;
                     errstream << "[There's a variant in a pheno file that has different information from that same variant in sites.tsv.]";
@@ -497,9 +542,6 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
             }
         }
         writer.write("\n");
-
-        if (sites_reader.eof()) break;
-        sites_reader.next();
     }
 
     writer.close();
@@ -512,33 +554,21 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
 // ------
 // entry points
 
-const char* make_matrix_and_return_string(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
+const char* make_matrix_chrom_and_return_string(const char *sites_filepath, const char **pheno_filepaths, const uint64_t *pheno_virtual_offsets, size_t N_phenos, const char *chrom, const char *matrix_part_filepath, int write_header) {
   try {
-    make_matrix(sites_filepath, augmented_pheno_glob, matrix_filepath);
+    make_matrix_chrom(sites_filepath, pheno_filepaths, pheno_virtual_offsets, N_phenos, chrom, matrix_part_filepath, write_header);
     return "ok";
   } catch (const std::exception &exc) {
-    return exc.what();
+    static std::string message;
+    message = exc.what();
+    return message.c_str();
   } catch (...) {
     return "[something broke]";
   }
 }
 
 extern "C" { // we need C because C++ mangles names supposedly
-  extern const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
-    return make_matrix_and_return_string(sites_filepath, augmented_pheno_glob, matrix_filepath);
-  }
-}
-
-// for use when compiling directly (for debugging)
-int main(int argc, char **argv) {
-  if (argc == 4) {
-    const char* ret = make_matrix_and_return_string(argv[1], argv[2], argv[3]);
-    std::cerr << ret << std::endl;
-    std::string good_output = "ok";
-    return (0 == good_output.compare(ret)) ? 0 : 1;
+  extern const char* cffi_make_matrix_chrom(const char *sites_filepath, const char **pheno_filepaths, const uint64_t *pheno_virtual_offsets, size_t n_phenos, const char *chrom, const char *matrix_part_filepath, int write_header) {
+    return make_matrix_chrom_and_return_string(sites_filepath, pheno_filepaths, pheno_virtual_offsets, n_phenos, chrom, matrix_part_filepath, write_header);
   }
-  std::cout << "Usage:\n"
-            << " ./x /path/to/sites.tsv \"/path/to/pheno/*\" /path/to/matrix.tsv.gz"
-            << std::endl;
-  return 1;
 }
@@ -55,38 +55,36 @@ def run(argv: List[str]) -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--engine", choices=["slurm", "sge", "uge"], required=True)
     parser.add_argument(
-        "--step", choices=["parse", "augment-phenos", "manhattan", "qq"], required=True
+        "--step",
+        choices=["parse", "augment-phenos", "manhattan", "qq", "summarize"],
+        required=True,
     )
     parser.add_argument("--N_per_job", default=5)
     args = parser.parse_args(argv)
 
     def should_process(pheno: Dict[str, Any]) -> bool:
         if args.step == "parse":
-            from . import parse_input_files
-
-            get_input_filepaths = parse_input_files.get_input_filepaths
-            get_output_filepaths = parse_input_files.get_output_filepaths
+            from . import parse_input_files as step_module
         elif args.step == "augment-phenos":
-            from . import augment_phenos
-
-            get_input_filepaths = augment_phenos.get_input_filepaths
-            get_output_filepaths = augment_phenos.get_output_filepaths
+            from . import augment_phenos as step_module
         elif args.step == "manhattan":
-            from . import manhattan
-
-            get_input_filepaths = manhattan.get_input_filepaths
-            get_output_filepaths = manhattan.get_output_filepaths
+            from . import manhattan as step_module
         elif args.step == "qq":
-            from . import qq
+            from . import qq as step_module
+        elif args.step == "summarize":
+            from . import summarize
 
-            get_input_filepaths = qq.get_input_filepaths
-            get_output_filepaths = qq.get_output_filepaths
+            return bool(summarize.get_stale_steps(pheno))
         else:
             raise Exception("No implementation for step {}".format(args.step))
         return PerPhenoParallelizer().should_process_pheno(
             pheno,
-            get_input_filepaths=get_input_filepaths,
-            get_output_filepaths=get_output_filepaths,
+            get_input_filepaths=step_module.get_input_filepaths,  # type: ignore
+            get_output_filepaths=step_module.get_output_filepaths,  # type: ignore
+            get_config=getattr(step_module, "get_config", None),
+            get_lookup_input_filepaths=getattr(
+                step_module, "get_lookup_input_filepaths", None
+            ),
         )
 
     idxs = [i for i, pheno in enumerate(get_phenolist()) if should_process(pheno)]
@@ -3,16 +3,28 @@ This avoids reading any variant more than once.
  The sum of unpadded lengths of all 20k genes is 1400Mbases.
  The sum of the padded lengths is 5400Mbases.
  The total number of bases in the padded genes (without double-counting overlaps) is 2100Mbases (40%) (in 16k intervals)
+
+Each chromosome is a task.  It reads the variants of `matrix.tsv.gz` in the padded genes of that chromosome in order, once,
+and sweeps through the padded genes alongside them (see `BestAssocsSweep`), so it never has to look up which genes contain a variant.
+Variants are handled in segments that are inside the same genes, and only their pvals are parsed, into a numpy array,
+so each gene's best pval for each phenotype is updated with a few numpy operations per segment.
+
+`best-phenos-by-gene.sqlite3` has two tables:
+- `best_phenos_for_each_gene` has the json of each gene's best associations, which the server sends without parsing it.
+- `best_assocs` has one row per association, with a column for each per-association field.
+  It's indexed by gene and by phenocode, so finding the genes where a phenotype has hits is an index scan.
 """
 
 from ..utils import get_padded_gene_tuples
 from ..file_utils import MatrixReader, get_filepath, get_tmp_path
+from .. import parse_utils
 from .load_utils import Parallelizer
+from .build_manifest import BuildTarget
 
-import sqlite3, json, traceback, functools
+import sqlite3, json, heapq, operator
+import numpy as np
 from pathlib import Path
-from intervaltree import IntervalTree, Interval
-from typing import List, Any, Dict, Tuple
+from typing import List, Any, Dict, Tuple, Set
 
 
 def run(argv: List[str]) -> None:
@@ -23,10 +35,12 @@ def run(argv: List[str]) -> None:
     # Check whether we're already up-to-date.
     out_filepath = Path(get_filepath("best-phenos-by-gene-sqlite3", must_exist=False))
     matrix_filepath = Path(get_filepath("matrix"))
-    if (
-        out_filepath.exists()
-        and matrix_filepath.stat().st_mtime < out_filepath.stat().st_mtime
-    ):
+    target = BuildTarget(
+        [str(out_filepath)],
+        [str(matrix_filepath), get_filepath("genes")],
+        config={"tables": ["best_phenos_for_each_gene", "best_assocs"]},
+    )
+    if target.is_up_to_date():
         print("{} is up-to-date!".format(str(out_filepath)))
         return
 
@@ -41,48 +55,87 @@ def run(argv: List[str]) -> None:
             data = json.load(f)
 
     else:
-        regions_on_chrom = get_regions_on_chrom()
-        regions: List[Tuple[str, int, int]] = [
-            (chrom, start, end)
-            for chrom, regions in regions_on_chrom.items()
-            for (start, end) in regions
+        genes_on_chrom: Dict[str, List[Tuple[int, int, str]]] = {}
+        for chrom, start, end, genename in get_padded_gene_tuples():
+            genes_on_chrom.setdefault(chrom, []).append((start, end, genename))
+        tasks = [
+            {"chrom": chrom, "genes": genes} for chrom, genes in genes_on_chrom.items()
         ]
-        task_results = Parallelizer().run_multiple_tasks(
-            tasks=regions,
-            do_multiple_tasks=process_regions,
-            cmd="gather-pvalues-for-each-gene",
-        )
         best_phenos_for_gene: Dict[str, List[Dict[str, Any]]] = {}
-        for task_result in task_results:
-            assert task_result["type"] == "result"
-            partial_best_phenos_for_gene = task_result["value"]
-            for genename, best_phenos in partial_best_phenos_for_gene.items():
+        for ret in Parallelizer().run_single_tasks(
+            tasks,
+            get_best_phenos_for_genes_on_chrom,
+            cmd="gather-pvalues-for-each-gene",
+        ):
+            for genename, best_phenos in ret["value"].items():
                 assert genename not in best_phenos_for_gene
                 best_phenos_for_gene[genename] = best_phenos
         data = best_phenos_for_gene
 
     out_tmp_filepath = Path(get_tmp_path(out_filepath))
-    db = sqlite3.connect(str(out_tmp_filepath))
-    with db:
-        db.execute(
-            "CREATE TABLE best_phenos_for_each_gene (gene TEXT PRIMARY KEY, json TEXT)"
-        )
-        db.executemany(
-            "INSERT INTO best_phenos_for_each_gene (gene, json) VALUES (?,?)",
-            ((k, json.dumps(v)) for k, v in data.items()),
-        )
+    if out_tmp_filepath.exists():
+        out_tmp_filepath.unlink()
+    make_best_phenos_by_gene_sqlite3(data, str(out_tmp_filepath))
     out_tmp_filepath.replace(out_filepath)
+    target.record()
     print("Done making best-pheno-for-each-gene at {}".format(str(out_filepath)))
 
 
-def get_regions_on_chrom() -> Dict[str, List[Tuple[int, int]]]:
-    gene_ranges_on_chrom: Dict[str, List[Tuple[int, int]]] = {}
-    for chrom, start, end, _ in get_padded_gene_tuples():
-        gene_ranges_on_chrom.setdefault(chrom, []).append((start, end))
-    return {
-        chrom: merged_intervals(gene_ranges)
-        for chrom, gene_ranges in gene_ranges_on_chrom.items()
-    }
+sql_type_for_type = {
+    str: "TEXT",
+    int: "INT",
+    parse_utils.scientific_int: "INT",
+    float: "REAL",
+}
+
+
+def make_best_phenos_by_gene_sqlite3(
+    best_phenos_for_gene: Dict[str, List[Dict[str, Any]]], out_filepath: str
+) -> None:
+    variant_fields = ["chrom", "pos", "ref", "alt"]
+    assoc_fields = list(parse_utils.per_assoc_fields)
+    db = sqlite3.connect(out_filepath)
+    try:
+        with db:
+            db.execute(
+                "CREATE TABLE best_phenos_for_each_gene (gene TEXT PRIMARY KEY, json TEXT)"
+            )
+            db.executemany(
+                "INSERT INTO best_phenos_for_each_gene (gene, json) VALUES (?,?)",
+                ((k, json.dumps(v)) for k, v in best_phenos_for_gene.items()),
+            )
+            # Quote the columns, since `or` is a field.
+            db.execute(
+                "CREATE TABLE best_assocs (gene TEXT, rank INT, phenocode TEXT, {})".format(
+                    ", ".join(
+                        '"{}" {}'.format(
+                            field, sql_type_for_type[parse_utils.fields[field]["type"]]
+                        )
+                        for field in variant_fields + assoc_fields
+                    )
+                )
+            )
+            db.executemany(
+                "INSERT INTO best_assocs VALUES ({})".format(
+                    ",".join("?" * (3 + len(variant_fields) + len(assoc_fields)))
+                ),
+                (
+                    (genename, rank, assoc["phenocode"])
+                    # Missing values are NULL, and so are values that are empty strings (see `Field.read()`).
+                    + tuple(
+                        None if assoc.get(field, "") == "" else assoc[field]
+                        for field in variant_fields + assoc_fields
+                    )
+                    for genename, assocs in best_phenos_for_gene.items()
+                    for rank, assoc in enumerate(assocs)
+                ),
+            )
+            db.execute("CREATE INDEX best_assocs_gene_idx ON best_assocs (gene, rank)")
+            db.execute(
+                "CREATE INDEX best_assocs_phenocode_idx ON best_assocs (phenocode, pval)"
+            )
+    finally:
+        db.close()
 
 
 def merged_intervals(intervals: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
@@ -99,88 +152,203 @@ def merged_intervals(intervals: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
 assert merged_intervals([(1, 2), (2, 4), (5, 7)]) == [(1, 4), (5, 7)]
 
 
-def process_regions(taskq, retq, parent_overrides) -> None:
-    try:
-        from .. import conf
+def get_best_phenos_for_genes_on_chrom(
+    task: Dict[str, Any],
+) -> Dict[str, List[Dict[str, Any]]]:
+    """`task` is like `{"chrom": "1", "genes": [(<padded_start>, <padded_end>, <genename>), ...]}`"""
+    matrix = MatrixReader()
+    phenocodes = matrix.get_phenocodes()
+    with matrix.context(fields=["pval"]) as matrix_reader:
+        sweep = BestAssocsSweep(matrix_reader, phenocodes, task["genes"])
+        for start, end in merged_intervals([(g[0], g[1]) for g in task["genes"]]):
+            for variant_row in matrix_reader.get_region_rows(
+                task["chrom"], start, end + 1
+            ):
+                sweep.add_variant_row(variant_row)
+        return sweep.finish()
+
+
+class BestAssocsSweep:
+    """
+    Finds the best association of each phenotype in each gene, for the variants of one chromosome in order.
+
+    A gene is pushed onto a heap when the variants pass its start and popped when they reach its end.
+    Consecutive variants inside the same genes make up a segment, and when the set of genes changes (or the segment is big), the segment is flushed:
+    its pvals are parsed into an array with one column per phenotype, and each gene's arrays of best pvals (and the rows they're from) are updated from the column minima.
+    The rows that hold a best pval are kept, so that each gene's best phenotypes can be fully parsed once the variants have passed it.
 
-        assert not conf.overrides or conf.overrides == parent_overrides, (
-            conf.overrides,
-            parent_overrides,
+    For each gene the phenotypes are ordered by pval, and ties are ordered by which phenotype was seen in the gene first (and then by column),
+    which is the order that comes from checking the variants one at a time.
+    """
+
+    def __init__(
+        self, matrix_reader, phenocodes: List[str], genes: List[Tuple[int, int, str]]
+    ):
+        self._matrix_reader = matrix_reader
+        self._phenocodes = phenocodes
+        self._pos_colidx = matrix_reader.get_colidx("pos")
+        self._variant_colidxs = [
+            (field, matrix_reader.get_colidx(field))
+            for field in ["chrom", "pos", "ref", "alt"]
+        ]
+        pval_colidxs = [matrix_reader.get_colidx("pval", p) for p in phenocodes]
+        self._get_pvals = (
+            operator.itemgetter(*pval_colidxs)
+            if len(pval_colidxs) > 1
+            else lambda row: tuple(row[colidx] for colidx in pval_colidxs)
         )
-        conf.overrides.update(parent_overrides)
-    except Exception as exc:
-        retq.put(
-            {
-                "type": "exception",
-                "task": None,
-                "exception_str": str(exc),
-                "exception_tb": traceback.format_exc(),
-            }
+        self._max_segment_size = max(1, 2**20 // max(1, len(phenocodes)))
+        self._genes = sorted(genes)
+        self._num_genes_started = 0
+        self._genes_heap: List[Tuple[int, str]] = []
+        # A gene can have several intervals.  It's active while any of them contains the position, and it's done once they've all ended.
+        self._num_active_intervals: Dict[str, int] = {}
+        self._num_unfinished_intervals: Dict[str, int] = {}
+        for _, _, genename in genes:
+            self._num_unfinished_intervals[genename] = (
+                self._num_unfinished_intervals.get(genename, 0) + 1
+            )
+        # Maps genename -> (best pvals, rowidx of each best pval, rowidx where each phenotype was first seen), with -1 for unseen phenotypes.
+        self._best_for_gene: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        self._segment: List[List[str]] = []
+        self._num_rows = 0
+        self._rows: Dict[int, List[str]] = {}
+        self._num_rows_after_pruning = 0
+        self._best_phenos_for_gene: Dict[str, List[Dict[str, Any]]] = {}
+
+    def add_variant_row(self, variant_row: List[str]) -> None:
+        pos = int(variant_row[self._pos_colidx])
+        genes, heap = self._genes, self._genes_heap
+        if (
+            self._num_genes_started < len(genes)
+            and genes[self._num_genes_started][0] <= pos
+        ) or (heap and heap[0][0] <= pos):
+            self._flush_segment()
+            while (
+                self._num_genes_started < len(genes)
+                and genes[self._num_genes_started][0] <= pos
+            ):
+                _, end, genename = genes[self._num_genes_started]
+                heapq.heappush(heap, (end, genename))
+                self._num_active_intervals[genename] = (
+                    self._num_active_intervals.get(genename, 0) + 1
+                )
+                self._num_genes_started += 1
+            while heap and heap[0][0] <= pos:
+                self._end_interval(heapq.heappop(heap)[1])
+            self._prune_rows()
+        if self._num_active_intervals:
+            self._segment.append(variant_row)
+            self._num_rows += 1
+            if len(self._segment) >= self._max_segment_size:
+                self._flush_segment()
+
+    def finish(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Returns a dictionary like `{<genename>: [<assoc>, ...]}` for every gene with any associations"""
+        self._flush_segment()
+        while self._genes_heap:
+            self._end_interval(heapq.heappop(self._genes_heap)[1])
+        return self._best_phenos_for_gene
+
+    def _end_interval(self, genename: str) -> None:
+        self._num_active_intervals[genename] -= 1
+        if self._num_active_intervals[genename] == 0:
+            del self._num_active_intervals[genename]
+        self._num_unfinished_intervals[genename] -= 1
+        if self._num_unfinished_intervals[genename] == 0:
+            self._finish_gene(genename)
+
+    def _flush_segment(self) -> None:
+        if not self._segment:
+            return
+        pvals = np.array(
+            [
+                [float(pval) if pval else np.nan for pval in self._get_pvals(row)]
+                for row in self._segment
+            ]
         )
-        raise
-    tree_for_chrom = get_gene_intervaltree_for_chrom()
-    with MatrixReader().context() as matrix_reader:
-        f = functools.partial(get_region_info, matrix_reader, tree_for_chrom)
-        Parallelizer._make_multiple_tasks_doer(f)(taskq, retq, parent_overrides)
+        is_present = ~np.isnan(pvals)
+        is_present_anywhere = is_present.any(axis=0)
+        first_present_idxs = is_present.argmax(axis=0)
+        pvals[~is_present] = np.inf
+        min_idxs = pvals.argmin(axis=0)  # the first of equal pvals
+        min_pvals = pvals[min_idxs, np.arange(pvals.shape[1])]
+        first_rowidx = self._num_rows - len(self._segment)
 
+        kept_idxs: Set[int] = set()
+        for genename in self._num_active_intervals:
+            if genename not in self._best_for_gene:
+                self._best_for_gene[genename] = (
+                    np.full(len(self._phenocodes), np.inf),
+                    np.full(len(self._phenocodes), -1, dtype=np.int64),
+                    np.full(len(self._phenocodes), -1, dtype=np.int64),
+                )
+            best_pvals, best_rowidxs, first_rowidxs = self._best_for_gene[genename]
+            is_better = min_pvals < best_pvals
+            best_pvals[is_better] = min_pvals[is_better]
+            best_rowidxs[is_better] = first_rowidx + min_idxs[is_better]
+            is_new = is_present_anywhere & (first_rowidxs == -1)
+            first_rowidxs[is_new] = first_rowidx + first_present_idxs[is_new]
+            kept_idxs.update(min_idxs[is_better].tolist())
+        for idx in kept_idxs:
+            self._rows[first_rowidx + idx] = self._segment[idx]
+        self._segment = []
 
-def get_region_info(
-    matrix_reader, tree_for_chrom: Dict[str, IntervalTree], region: Tuple[str, int, int]
-) -> Dict[str, List[Dict[str, Any]]]:
-    chrom, start, end = region
-    best_assoc_for_pheno_gene_pair: Dict[Tuple[str, str], Dict[str, Any]] = {}
-    # best_assoc_for_pheno_gene_pair is like:
-    # { ('<phenocode>', '<genename>'): {'ac': 35, ... all per_pheno and per_assoc fields} }
-
-    for variant in matrix_reader.get_region(chrom, start, end + 1):
-        genenames: List[str] = [
-            iv.data for iv in tree_for_chrom[variant["chrom"]].at(variant["pos"])
-        ]
+    def _prune_rows(self) -> None:
+        # Drop the rows that are no longer the best for any unfinished gene.
+        if len(self._rows) <= 2 * self._num_rows_after_pruning + 1000:
+            return
+        used_rowidxs: Set[int] = set()
+        for _, best_rowidxs, _ in self._best_for_gene.values():
+            used_rowidxs.update(np.unique(best_rowidxs).tolist())
+        self._rows = {
+            rowidx: row for rowidx, row in self._rows.items() if rowidx in used_rowidxs
+        }
+        self._num_rows_after_pruning = len(self._rows)
 
-        for phenocode, pheno in variant["phenos"].items():
-            assert isinstance(pheno["pval"], float)
-            for genename in genenames:
-                pheno_gene_pair = (phenocode, genename)
-                if (
-                    pheno_gene_pair not in best_assoc_for_pheno_gene_pair
-                    or pheno["pval"]
-                    < best_assoc_for_pheno_gene_pair[pheno_gene_pair]["pval"]
-                ):
-                    best_assoc_for_pheno_gene_pair[pheno_gene_pair] = pheno
-
-    phenos_in_gene: Dict[str, List[Dict[str, Any]]] = {}
-    for (phenocode, genename), assoc in best_assoc_for_pheno_gene_pair.items():
-        assoc["phenocode"] = phenocode
-        phenos_in_gene.setdefault(genename, []).append(assoc)
-    for genename in phenos_in_gene:
-        phenos_in_gene[genename] = order_and_truncate_phenos(phenos_in_gene[genename])
-    return phenos_in_gene
-
-
-@functools.lru_cache(None)
-def get_gene_intervaltree_for_chrom() -> Dict[str, IntervalTree]:
-    tree_for_chrom = {}
-    for chrom, start, end, genename in get_padded_gene_tuples():
-        if chrom not in tree_for_chrom:
-            tree_for_chrom[chrom] = IntervalTree()
-        tree_for_chrom[chrom].add(Interval(start, end, genename))
-    return tree_for_chrom
+    def _finish_gene(self, genename: str) -> None:
+        if genename not in self._best_for_gene:
+            return
+        best_pvals, best_rowidxs, first_rowidxs = self._best_for_gene.pop(genename)
+        phenoidxs = np.flatnonzero(first_rowidxs != -1)
+        if len(phenoidxs) == 0:
+            return
+        phenoidxs = phenoidxs[
+            np.lexsort((phenoidxs, first_rowidxs[phenoidxs], best_pvals[phenoidxs]))
+        ]
+        num_phenos = get_num_phenos_to_show(best_pvals[phenoidxs].tolist())
+        assocs = []
+        for phenoidx in phenoidxs[:num_phenos].tolist():
+            phenocode = self._phenocodes[phenoidx]
+            variant_row = self._rows[int(best_rowidxs[phenoidx])]
+            assoc: Dict[str, Any] = {
+                field: variant_row[colidx] for field, colidx in self._variant_colidxs
+            }
+            assoc["pos"] = int(assoc["pos"])
+            assoc.update(self._matrix_reader.parse_pheno(variant_row, phenocode))
+            assoc["phenocode"] = phenocode
+            assocs.append(assoc)
+        self._best_phenos_for_gene[genename] = assocs
 
 
 def order_and_truncate_phenos(phenos: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    phenos.sort(key=lambda a: a["pval"])
+    return phenos[: get_num_phenos_to_show([a["pval"] for a in phenos])]
+
+
+def get_num_phenos_to_show(sorted_pvals: List[float]) -> int:
     # Decide how many phenotypes to show.
     #  - Always show all significant phenotypes (with pvalue < 5e-8).
     #  - Always show the three strongest phenotypes (even if none are significant).
     #  - Look at the p-values of the 4th to 10th strongest phenotypes to decide how many of them to show.
-    phenos.sort(key=lambda a: a["pval"])
     biggest_idx_to_include = 2
-    for idx in range(biggest_idx_to_include, len(phenos)):
-        if phenos[idx]["pval"] < 5e-8:
+    for idx in range(biggest_idx_to_include, len(sorted_pvals)):
+        if sorted_pvals[idx] < 5e-8:
             biggest_idx_to_include = idx
-        elif idx < 10 and phenos[idx]["pval"] < 10 ** (
+        elif idx < 10 and sorted_pvals[idx] < 10 ** (
             -4 - idx // 2
         ):  # formula is arbitrary
             biggest_idx_to_include = idx
         else:
             break
-    return phenos[: biggest_idx_to_include + 1]
+    return biggest_idx_to_include + 1
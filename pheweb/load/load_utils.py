@@ -1,9 +1,13 @@
-from ..utils import round_sig, get_phenolist, PheWebError, fmt_seconds
+from ..utils import round_sig, get_phenolist, PheWebError, fmt_seconds, chrom_order
 from .. import conf
 from .. import parse_utils
-from ..file_utils import get_dated_tmp_path
+from ..file_utils import get_dated_tmp_path, VariantFileReader, VariantFileWriter
 
 import functools
+import collections
+import contextlib
+import io
+import pickle
 import traceback
 import time
 import os
@@ -14,7 +18,7 @@ import sys
 import heapq
 from pathlib import Path
 from types import GeneratorType
-from typing import List, Set, Dict, Optional, Any, Callable, Union
+from typing import List, Set, Dict, Optional, Any, Callable, Union, Iterator
 import re
 
 
@@ -46,7 +50,7 @@ def get_maf(variant: Dict[str, Any], pheno: Dict[str, Any]) -> Optional[float]:
                     variant, pheno, mafs
                 )
             )
-        maf_sigfigs = parse_utils.fields["maf"]["sigfigs"]  # type:ignore
+        maf_sigfigs = parse_utils.fields["maf"]["sigfigs"]  # type: ignore
         if not isinstance(maf_sigfigs, int):
             raise Exception()
         return round_sig(sum(mafs) / len(mafs), maf_sigfigs)
@@ -142,12 +146,31 @@ def set_loading_nice() -> None:
 set_loading_nice()
 
 
+def set_ulimit_num_files(num_files: int) -> int:
+    """
+    Raise the soft limit on open files to `num_files` (but not past the hard limit).
+    Returns the new soft limit, which might be less than `num_files`.
+    """
+    import resource
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= num_files:
+        return num_files
+    new_soft = num_files if hard == resource.RLIM_INFINITY else min(num_files, hard)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+    except (ValueError, OSError):
+        return soft
+    return new_soft
+
+
 class MaxPriorityQueue:
     # TODO: check if this is slower than blist-based MaxPriorityQueue, for ~500 items
     # Note: `ComparesFalse()` is used to prevent `heapq` from comparing `item`s to eachother.
     #       Even if two priorities are equal, `ComparesFalse() <= ComparesFalse()` will be `False`, so `item`s won't be compared.
     """
     `.pop()` returns the item with the largest priority.
+    `.peek_priority()` returns the largest priority.
     `.popall()` iteratively `.pop()`s until empty.
     priorities must be comparable.
     `item` can be anything.
@@ -183,6 +206,10 @@ class MaxPriorityQueue:
         _, _, item = heapq.heappop(self._q)
         return item
 
+    def peek_priority(self):
+        """Returns the largest priority, without popping its item."""
+        return -self._q[0][0]
+
     def __len__(self):
         return len(self._q)
 
@@ -191,21 +218,70 @@ class MaxPriorityQueue:
             yield self.pop()
 
 
+def get_task_batches(
+    tasks: List[Any], costs: List[float], n_procs: int
+) -> List[List[Any]]:
+    """
+    Orders `tasks` from most to least costly, so that the biggest tasks don't start last and leave the other processes idle,
+    and groups the cheapest tasks into batches, so that they don't each take a trip through the task queue.
+    Each batch costs about 1/4 of the average work per process, unless a single task costs more than that.
+    """
+    order = sorted(range(len(tasks)), key=lambda i: -costs[i])
+    batch_cost_target = sum(costs) / (4 * n_procs)
+    batches: List[List[Any]] = []
+    batch_cost = 0.0
+    for i in order:
+        if not batches or batch_cost >= batch_cost_target:
+            batches.append([])
+            batch_cost = 0.0
+        batches[-1].append(tasks[i])
+        batch_cost += costs[i]
+    return batches
+
+
+assert get_task_batches(list("abcdef"), [1, 8, 1, 1, 2, 3], 2) == [
+    ["b"],
+    ["f"],
+    ["e"],
+    ["a", "c"],
+    ["d"],
+]
+
+
+NUM_SLOWEST_TASKS_TO_SHOW = 5
+
+
+def describe_task(task: Any) -> str:
+    """Names a `Parallelizer` task in messages, by its phenocode, chromosome or filepath."""
+    if isinstance(task, dict):
+        if "phenocode" in task:
+            return task["phenocode"]
+        if "chrom" in task:
+            return "chr{}".format(task["chrom"])
+        if "out_filepath" in task:
+            return os.path.basename(task["out_filepath"])
+    if isinstance(task, str):
+        return task
+    return repr(task)
+
+
 class Parallelizer:
-    def run_multiple_tasks(self, tasks, do_multiple_tasks, cmd=None):
+    def run_multiple_tasks(self, tasks, do_multiple_tasks, cmd=None, get_cost=None):
         """
         Make a task queue and a return queue.
-        Spawn child processes `do_multiple_tasks(taskq, retq, overrides)` to pop taskq and push retq.
+        Spawn child processes `do_multiple_tasks(taskq, retq, overrides)` to pop batches (lists) of tasks from taskq and push retq.
         We manually pass `overrides` down to the child, because otherwise multiprocessing won't pickle it and pass it down.
         Watch for results, exceptions, and task-completion in retq.
         Yields things like: {type:"result", ...}
+        If `get_cost(task)` is given (eg, the size of the task's input files), the costliest tasks are started first and cheap tasks are batched.
+        Otherwise, tasks are started in order, one at a time.
         """
         if not tasks:
             return
-        n_procs = min(conf.get_num_procs(cmd), len(tasks))
+        n_procs, batches = self._get_batches(tasks, cmd, get_cost)
         taskq = multiprocessing.Queue()
-        for task in tasks:
-            taskq.put(task)
+        for batch in batches:
+            taskq.put(batch)
         for _ in range(n_procs):
             taskq.put({"exit": True})
         retq = multiprocessing.Queue()
@@ -219,6 +295,7 @@ class Parallelizer:
         ]
         for p in procs:
             p.start()
+        task_timings = []  # (task, seconds) for each completed task
         with ProgressBar() as progressbar:
             n_tasks_complete = 0
             self._update_progressbar(progressbar, n_tasks_complete, n_procs, len(tasks))
@@ -238,6 +315,7 @@ class Parallelizer:
                     yield ret
                 elif ret["type"] == "task-completion":
                     n_tasks_complete += 1
+                    task_timings.append((ret["task"], ret["seconds"]))
                     self._update_progressbar(
                         progressbar, n_tasks_complete, n_procs, len(tasks)
                     )
@@ -245,21 +323,7 @@ class Parallelizer:
                     for p in procs:
                         if p.is_alive():
                             p.terminate()
-                    exc_filepath = get_dated_tmp_path("exception")
-                    with open(exc_filepath, "wt") as f:
-                        f.write(
-                            "Child process had exception:\n"
-                            + indent(ret["exception_str"])
-                            + "\n"
-                            + "Traceback:\n"
-                            + indent(ret["exception_tb"])
-                            + "\n"
-                        )
-                    raise PheWebError(
-                        "Child process had exception, info dumped to {}".format(
-                            exc_filepath
-                        )
-                    )
+                    self._raise_child_exception(ret)
                 elif ret["type"] == "exit":
                     n_procs -= 1
                     self._update_progressbar(
@@ -269,7 +333,11 @@ class Parallelizer:
                         p.is_alive()  # This cleans up zombies
                     if n_procs == 0:
                         self._update_progressbar(
-                            progressbar, n_tasks_complete, n_procs, len(tasks)
+                            progressbar,
+                            n_tasks_complete,
+                            n_procs,
+                            len(tasks),
+                            [seconds for _, seconds in task_timings],
                         )
                         for p in procs:
                             p.join()
@@ -279,21 +347,92 @@ class Parallelizer:
                                         p.exitcode
                                     )
                                 )
-                        return
+                        break
                 else:
                     raise PheWebError("Unknown type of ret: {}".format(ret))
+        self._print_slowest_tasks(task_timings)
 
-    def run_single_tasks(self, tasks, do_single_task, cmd=None):
+    def run_single_tasks(self, tasks, do_single_task, cmd=None, get_cost=None):
+        """
+        Runs `do_single_task(task)` for each task in child processes, like `run_multiple_tasks()`.
+        Inside `pheweb process`, the tasks go to the workers that every step shares (see `WorkerPool`), unless `do_single_task` can't be pickled.
+        """
+        pool = _get_worker_pool()
+        if pool is not None and tasks and _is_picklable(do_single_task):
+            yield from self._run_single_tasks_in_pool(
+                pool, tasks, do_single_task, cmd, get_cost
+            )
+            return
         do_multiple_tasks = self._make_multiple_tasks_doer(do_single_task)
-        for ret in self.run_multiple_tasks(tasks, do_multiple_tasks, cmd=cmd):
+        for ret in self.run_multiple_tasks(
+            tasks, do_multiple_tasks, cmd=cmd, get_cost=get_cost
+        ):
             yield ret
 
-    def _update_progressbar(self, progressbar, n_tasks_complete, n_procs, num_tasks):
+    def _run_single_tasks_in_pool(self, pool, tasks, do_single_task, cmd, get_cost):
+        # Only `n_procs` batches are queued at a time, so that `conf.get_num_procs(cmd)` still limits how many of this step's tasks run at once.
+        n_procs, batches = self._get_batches(tasks, cmd, get_cost)
+        pending_batches = collections.deque(batches)
+        n_running = 0
+        task_timings = []
+        with ProgressBar() as progressbar:
+            n_tasks_complete = 0
+            while True:
+                while pending_batches and n_running < n_procs:
+                    pool.submit(do_single_task, pending_batches.popleft())
+                    n_running += 1
+                self._update_progressbar(
+                    progressbar, n_tasks_complete, n_running, len(tasks)
+                )
+                if n_running == 0:
+                    break
+                # `pheweb process` stops every step if a worker dies, so there's no need for a timeout here.
+                ret = pool.get()
+                if ret["type"] == "result":
+                    yield ret
+                elif ret["type"] == "task-completion":
+                    n_tasks_complete += 1
+                    task_timings.append((ret["task"], ret["seconds"]))
+                elif ret["type"] == "output":
+                    sys.stdout.write(ret["text"])
+                elif ret["type"] == "exception":
+                    self._raise_child_exception(ret)
+                elif ret["type"] == "batch-completion":
+                    n_running -= 1
+                else:
+                    raise PheWebError("Unknown type of ret: {}".format(ret))
+            self._update_progressbar(
+                progressbar,
+                n_tasks_complete,
+                0,
+                len(tasks),
+                [seconds for _, seconds in task_timings],
+            )
+        self._print_slowest_tasks(task_timings)
+
+    @staticmethod
+    def _get_batches(tasks, cmd, get_cost):
+        n_procs = min(conf.get_num_procs(cmd), len(tasks))
+        if get_cost is None:
+            batches = [[task] for task in tasks]
+        else:
+            batches = get_task_batches(
+                tasks, [get_cost(task) for task in tasks], n_procs
+            )
+        return min(n_procs, len(batches)), batches
+
+    def _update_progressbar(
+        self, progressbar, n_tasks_complete, n_procs, num_tasks, task_seconds=None
+    ):
         # If everything is finished, show a completion message.
         if n_procs == 0 and num_tasks == n_tasks_complete:
+            # Comparing the work to the elapsed time shows how well the processes were kept busy.
             progressbar.set_message(
-                "Completed {:4} tasks in {}".format(
-                    n_tasks_complete, progressbar.fmt_elapsed()
+                "Completed {:4} tasks in {} ({} of work, slowest task took {})".format(
+                    n_tasks_complete,
+                    progressbar.fmt_elapsed(),
+                    fmt_seconds(sum(task_seconds or [0])),
+                    fmt_seconds(max(task_seconds or [0])),
                 )
             )
         else:
@@ -310,6 +449,39 @@ class Parallelizer:
                 )
             )
 
+    @staticmethod
+    def _raise_child_exception(ret) -> None:
+        exc_filepath = get_dated_tmp_path("exception")
+        with open(exc_filepath, "wt") as f:
+            f.write(
+                "Child process had exception:\n"
+                + indent(ret["exception_str"])
+                + "\n"
+                + "Traceback:\n"
+                + indent(ret["exception_tb"])
+                + "\n"
+            )
+        raise PheWebError(
+            "Child process had exception, info dumped to {}".format(exc_filepath)
+        )
+
+    @staticmethod
+    def _print_slowest_tasks(task_timings) -> None:
+        # Shows which tasks a step's elapsed time is waiting on, eg, a huge phenotype.
+        if len(task_timings) < 2:
+            return
+        slowest = sorted(task_timings, key=lambda timing: -timing[1])[
+            :NUM_SLOWEST_TASKS_TO_SHOW
+        ]
+        print(
+            "Slowest tasks: {}".format(
+                ", ".join(
+                    "{} ({:.1f} seconds)".format(describe_task(task), seconds)
+                    for task, seconds in slowest
+                )
+            )
+        )
+
     @staticmethod
     def _make_multiple_tasks_doer(do_single_task):
         # Use `functools.partial` so that our resulting function will be `pickle`able (for multiprocessing).
@@ -334,8 +506,17 @@ class Parallelizer:
             )
             raise Exception(err)
         conf.overrides.update(parent_overrides)
-        for task in iter(taskq.get, {"exit": True}):
+        for batch in iter(taskq.get, {"exit": True}):
+            if not Parallelizer._do_batch(do_single_task, batch, retq):
+                return
+        retq.put({"type": "exit"})
+
+    @staticmethod
+    def _do_batch(do_single_task, batch, retq) -> bool:
+        """Runs each task in `batch`, sending its results and timing to `retq`.  Returns False if a task raised an exception."""
+        for task in batch:
             try:
+                start_time = time.time()
                 x = do_single_task(task)
                 for ret in (
                     x if isinstance(x, GeneratorType) else [x]
@@ -351,6 +532,7 @@ class Parallelizer:
                     {
                         "type": "task-completion",
                         "task": task,
+                        "seconds": time.time() - start_time,
                     }
                 )
             except (Exception, KeyboardInterrupt) as exc:
@@ -362,8 +544,89 @@ class Parallelizer:
                         "exception_tb": traceback.format_exc(),
                     }
                 )
-                return
-        retq.put({"type": "exit"})
+                return False
+        return True
+
+
+class WorkerPool:
+    """
+    Worker processes that the steps of `pheweb process` share, so that each step doesn't fork its own.
+    Make the pool before forking the steps, and call `use_worker_pool(pool, step_idx)` in each step, so that `Parallelizer.run_single_tasks()` uses it.
+    Each step gets its results from its own queue.  The workers are forked before any step runs,
+    so tasks only get the state that's pickled with them and `conf.overrides`, which is sent with each batch.
+    """
+
+    def __init__(self, num_procs: int, num_steps: int):
+        self._taskq = multiprocessing.Queue()
+        self._retqs = [multiprocessing.Queue() for _ in range(num_steps)]
+        self._step_idx: Optional[int] = None
+        self.procs = [
+            multiprocessing.Process(
+                target=WorkerPool._work, args=(self._taskq, self._retqs), daemon=True
+            )
+            for _ in range(num_procs)
+        ]
+        for p in self.procs:
+            p.start()
+
+    def submit(self, do_single_task: Callable, batch: List[Any]) -> None:
+        self._taskq.put((self._step_idx, do_single_task, batch, dict(conf.overrides)))
+
+    def get(self) -> Dict[str, Any]:
+        return self._retqs[self._step_idx].get()
+
+    def close(self) -> None:
+        for _ in self.procs:
+            self._taskq.put(None)
+        for p in self.procs:
+            p.join()
+
+    def terminate(self) -> None:
+        for p in self.procs:
+            if p.is_alive():
+                p.terminate()
+        for p in self.procs:
+            p.join()
+
+    @staticmethod
+    def _work(taskq, retqs) -> None:
+        for retq in retqs:
+            # If a step fails, nothing reads the results of its remaining batches, so don't wait to flush them when exiting.
+            retq.cancel_join_thread()
+        for step_idx, do_single_task, batch, overrides in iter(taskq.get, None):
+            retq = retqs[step_idx]
+            conf.overrides.clear()
+            conf.overrides.update(overrides)
+            # Send output to the step, so that it's printed with the step's name in front.
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                Parallelizer._do_batch(do_single_task, batch, retq)
+            if output.getvalue():
+                retq.put({"type": "output", "text": output.getvalue()})
+            retq.put({"type": "batch-completion"})
+
+
+_worker_pool: Optional[WorkerPool] = None
+_worker_pool_pid: Optional[int] = None
+
+
+def use_worker_pool(pool: WorkerPool, step_idx: int) -> None:
+    """Makes `Parallelizer`s in this process (but not in processes forked from it) send their tasks to `pool`."""
+    global _worker_pool, _worker_pool_pid
+    pool._step_idx = step_idx
+    _worker_pool, _worker_pool_pid = pool, os.getpid()
+
+
+def _get_worker_pool() -> Optional[WorkerPool]:
+    return _worker_pool if _worker_pool_pid == os.getpid() else None
+
+
+def _is_picklable(obj: Any) -> bool:
+    try:
+        pickle.dumps(obj)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
 
 
 class PerPhenoParallelizer(Parallelizer):
@@ -374,21 +637,27 @@ class PerPhenoParallelizer(Parallelizer):
         convert,
         *,
         cmd=None,
-        phenos=None
+        phenos=None,
+        get_config=None,
+        get_lookup_input_filepaths=None
     ):
+        """
+        Runs `convert(pheno)` on each pheno whose outputs aren't up-to-date according to the build manifest.
+        `get_config()` returns the config values that affect the outputs, so that changing them re-makes the outputs.
+        `get_lookup_input_filepaths(pheno)` returns the inputs that are only used to look up the pheno's variants (see `BuildTarget`).
+        """
         if phenos is None:
             phenos = get_phenolist()
-        tasks = [
-            pheno
-            for pheno in phenos
-            if self.should_process_pheno(
-                pheno, get_input_filepaths, get_output_filepaths
-            )
-        ]
+        tasks = self._get_phenos_to_process(
+            phenos,
+            cmd,
+            get_input_filepaths,
+            get_output_filepaths,
+            get_config,
+            get_lookup_input_filepaths,
+        )
         if not tasks:
-            print(
-                "Output files are all newer than input files, so there's nothing to do."
-            )
+            print("Output files are all up-to-date, so there's nothing to do.")
             return {}
         if len(phenos) == len(tasks):
             print("Processing {} phenos".format(len(tasks)))
@@ -398,8 +667,21 @@ class PerPhenoParallelizer(Parallelizer):
                     len(tasks), len(phenos) - len(tasks)
                 )
             )
+        convert_and_record = functools.partial(
+            self._convert_and_record,
+            convert,
+            get_input_filepaths,
+            get_output_filepaths,
+            get_config,
+            get_lookup_input_filepaths,
+        )
         pheno_results = {}
-        for ret in self.run_single_tasks(tasks, convert, cmd=cmd):
+        for ret in self.run_single_tasks(
+            tasks,
+            convert_and_record,
+            cmd=cmd,
+            get_cost=functools.partial(self._get_input_size, get_input_filepaths),
+        ):
             pc = ret["task"]["phenocode"]
             v = ret["value"]
             if isinstance(v, dict) and v.get("type", "") == "warning":
@@ -408,7 +690,108 @@ class PerPhenoParallelizer(Parallelizer):
             pheno_results[pc] = v
         return pheno_results
 
-    def should_process_pheno(self, pheno, get_input_filepaths, get_output_filepaths):
+    def should_process_pheno(
+        self,
+        pheno,
+        get_input_filepaths,
+        get_output_filepaths,
+        get_config=None,
+        get_lookup_input_filepaths=None,
+    ):
+        return not self._get_build_target(
+            pheno,
+            get_input_filepaths,
+            get_output_filepaths,
+            get_config,
+            get_lookup_input_filepaths,
+        ).is_up_to_date()
+
+    def _get_phenos_to_process(
+        self, phenos, cmd, get_input_filepaths, get_output_filepaths, *args
+    ):
+        """
+        Returns the phenos that `should_process_pheno()` says aren't up-to-date.
+        Checking a pheno hashes its inputs unless their hashes are cached, which they aren't on the first run with the build manifest or after the files are copied,
+        so those phenos are checked in parallel.  Inputs that several phenos share (like `sites.tsv`) are hashed first, so that they're only read once.
+        """
+        from .build_manifest import get_file_hash, get_unhashed_size
+
+        input_filepaths = [
+            self._get_filepaths(get_input_filepaths, pheno) for pheno in phenos
+        ]
+        num_phenos_using_filepath = collections.Counter(
+            fp for fps in input_filepaths for fp in set(fps)
+        )
+        for fp, count in num_phenos_using_filepath.items():
+            if count > 1 and os.path.exists(fp):
+                get_file_hash(fp)
+        # Phenos with missing outputs aren't up-to-date, and finding that out doesn't hash anything.
+        costs = [
+            (
+                sum(get_unhashed_size(fp) for fp in fps if os.path.exists(fp))
+                if all(
+                    os.path.exists(fp)
+                    for fp in self._get_filepaths(get_output_filepaths, pheno)
+                )
+                else 0
+            )
+            for pheno, fps in zip(phenos, input_filepaths)
+        ]
+        cost_by_phenocode = {
+            pheno["phenocode"]: cost for pheno, cost in zip(phenos, costs)
+        }
+        check_args = (get_input_filepaths, get_output_filepaths) + args
+        should_process = {}
+        unhashed_phenos = [pheno for pheno, cost in zip(phenos, costs) if cost > 0]
+        if len(unhashed_phenos) > 1:
+            print(
+                "Hashing the inputs of {} phenos to check whether they're up-to-date".format(
+                    len(unhashed_phenos)
+                )
+            )
+            for ret in self.run_single_tasks(
+                unhashed_phenos,
+                functools.partial(self._should_process_pheno_task, check_args),
+                cmd=cmd,
+                get_cost=lambda pheno: cost_by_phenocode[pheno["phenocode"]],
+            ):
+                should_process[ret["task"]["phenocode"]] = ret["value"]
+        return [
+            pheno
+            for pheno in phenos
+            if should_process.get(pheno["phenocode"])
+            or (
+                pheno["phenocode"] not in should_process
+                and self.should_process_pheno(pheno, *check_args)
+            )
+        ]
+
+    def _should_process_pheno_task(self, check_args, pheno):
+        return self.should_process_pheno(pheno, *check_args)
+
+    @staticmethod
+    def _get_filepaths(get_filepaths, pheno):
+        filepaths = get_filepaths(pheno)
+        if isinstance(filepaths, str):
+            filepaths = [filepaths]
+        return filepaths
+
+    @classmethod
+    def _get_input_size(cls, get_input_filepaths, pheno):
+        return sum(
+            os.stat(fp).st_size for fp in cls._get_filepaths(get_input_filepaths, pheno)
+        )
+
+    @staticmethod
+    def _get_build_target(
+        pheno,
+        get_input_filepaths,
+        get_output_filepaths,
+        get_config=None,
+        get_lookup_input_filepaths=None,
+    ):
+        from .build_manifest import BuildTarget
+
         input_filepaths = get_input_filepaths(pheno)
         output_filepaths = get_output_filepaths(pheno)
         if isinstance(input_filepaths, str):
@@ -422,19 +805,112 @@ class PerPhenoParallelizer(Parallelizer):
                         " or ".join(output_filepaths), fp
                     )
                 )
-        return any(not os.path.exists(fp) for fp in output_filepaths) or max(
-            map(mtime, input_filepaths)
-        ) > min(map(mtime, output_filepaths))
+        return BuildTarget(
+            output_filepaths,
+            input_filepaths,
+            config=get_config() if get_config is not None else None,
+            lookup_input_filepaths=(
+                get_lookup_input_filepaths(pheno)
+                if get_lookup_input_filepaths is not None
+                else ()
+            ),
+        )
+
+    @classmethod
+    def _convert_and_record(
+        cls,
+        convert,
+        get_input_filepaths,
+        get_output_filepaths,
+        get_config,
+        get_lookup_input_filepaths,
+        pheno,
+    ):
+        # Hash the inputs before converting, in case they change while we work.
+        target = cls._get_build_target(
+            pheno,
+            get_input_filepaths,
+            get_output_filepaths,
+            get_config,
+            get_lookup_input_filepaths,
+        )
+        target.get_fingerprint()
+        succeeded = True
+        rets = convert(pheno)
+        for ret in rets if isinstance(rets, GeneratorType) else [rets]:
+            if isinstance(ret, dict) and ret.get("succeeded", True) is False:
+                succeeded = False
+            yield ret
+        if succeeded:
+            target.record()
 
 
 def parallelize_per_pheno(
-    get_input_filepaths, get_output_filepaths, convert, *, cmd=None, phenos=None
+    get_input_filepaths,
+    get_output_filepaths,
+    convert,
+    *,
+    cmd=None,
+    phenos=None,
+    get_config=None,
+    get_lookup_input_filepaths=None
 ):
     return PerPhenoParallelizer().run_on_each_pheno(
-        get_input_filepaths, get_output_filepaths, convert, cmd=cmd, phenos=phenos
+        get_input_filepaths,
+        get_output_filepaths,
+        convert,
+        cmd=cmd,
+        phenos=phenos,
+        get_config=get_config,
+        get_lookup_input_filepaths=get_lookup_input_filepaths,
     )
 
 
+def update_annotated_variant_file(
+    in_filepath: str,
+    out_filepath: str,
+    annotate: Callable[[Iterator[Dict[str, Any]]], Iterator[Dict[str, Any]]],
+) -> int:
+    """
+    Re-makes `out_filepath` after variants were added to `in_filepath`, by copying the variants that are already in `out_filepath`
+    and running `annotate(variants)` on only the new ones.
+    Both files must be sorted, and every variant in `out_filepath` must be in `in_filepath`.
+    Returns the number of new variants.
+    """
+
+    def key(v: Dict[str, Any]) -> tuple:
+        return (chrom_order[v["chrom"]], v["pos"], v["ref"], v["alt"])
+
+    num_new_variants = 0
+
+    def get_new_variants(
+        in_reader: Iterator[Dict[str, Any]], old_reader: Iterator[Dict[str, Any]]
+    ) -> Iterator[Dict[str, Any]]:
+        nonlocal num_new_variants
+        old_v = next(old_reader, None)
+        for v in in_reader:
+            if old_v is not None and key(old_v) == key(v):
+                old_v = next(old_reader, None)
+            else:
+                num_new_variants += 1
+                yield v
+        if old_v is not None:
+            raise PheWebError(
+                "{} contains the variant {} which isn't in {}".format(
+                    out_filepath, old_v, in_filepath
+                )
+            )
+
+    with VariantFileReader(in_filepath) as in_reader, VariantFileReader(
+        out_filepath
+    ) as old_reader, VariantFileReader(out_filepath) as old_variants, VariantFileWriter(
+        out_filepath
+    ) as writer:
+        new_variants = annotate(get_new_variants(iter(in_reader), iter(old_reader)))
+        writer.write_all(heapq.merge(old_variants, new_variants, key=key))
+    return num_new_variants
+
+
 def get_phenos_subset(pheno_subset_str: str) -> List[Dict[str, Any]]:
     phenos = get_phenolist()
     idxs_to_include = _get_idxs_from_subset_str(pheno_subset_str)
@@ -0,0 +1,78 @@
+"""
+This script makes `sites/autocomplete/`, which the server memory-maps to autocomplete variants and rsids without a database query per keystroke.
+
+It contains:
+- `variants/`: a columnar file (see `file_utils.ColumnarVariantFileReader`) with `chrom`, `pos`, `ref`, `alt` and `rsids` of every variant in `sites.tsv`, in the same order.
+  Since variants are sorted by position, the variants whose position starts with some digits are a few contiguous ranges.
+- `rsid_nums.npy` and `rsid_variant_idxs.npy`: the number of every rsid like `rs123` (sorted), and the index of its variant.
+  The rsids that start with some digits and have at most two more digits are three contiguous ranges.
+"""
+
+from ..file_utils import (
+    VariantFileReader,
+    ColumnarVariantFileWriter,
+    get_filepath,
+    get_tmp_path,
+)
+from .build_manifest import BuildTarget
+
+import os
+import re
+import array
+import shutil
+import numpy as np
+from typing import List
+
+rsid_regex = re.compile(r"^rs[1-9][0-9]*$")
+
+
+def run(argv: List[str]) -> None:
+    if "-h" in argv or "--help" in argv:
+        print("Make the index that the server uses to autocomplete variants and rsids")
+        exit(1)
+
+    sites_filepath = get_filepath("sites")
+    out_dirpath = get_filepath("autocomplete-index", must_exist=False)
+    target = BuildTarget([out_dirpath], [sites_filepath])
+    if target.is_up_to_date():
+        print("The autocomplete index is up-to-date!")
+        return
+
+    tmp_dirpath = get_tmp_path(out_dirpath)
+    os.makedirs(tmp_dirpath)
+    try:
+        make_autocomplete_index(sites_filepath, tmp_dirpath)
+    except BaseException:
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+        raise
+    if os.path.exists(out_dirpath):
+        shutil.rmtree(out_dirpath)
+    os.rename(tmp_dirpath, out_dirpath)
+    target.record()
+    print("Done making the autocomplete index at {}".format(out_dirpath))
+
+
+def make_autocomplete_index(sites_filepath: str, out_dirpath: str) -> None:
+    rsid_nums = array.array("Q")
+    rsid_variant_idxs = array.array("Q")
+    with VariantFileReader(sites_filepath) as reader, ColumnarVariantFileWriter(
+        os.path.join(out_dirpath, "variants")
+    ) as writer:
+        for variant_idx, v in enumerate(reader):
+            writer.write(
+                {field: v[field] for field in ["chrom", "pos", "ref", "alt", "rsids"]}
+            )
+            if v["rsids"]:
+                for rsid in v["rsids"].split(","):
+                    # Other rsids can't be autocompleted, but they'd never be typed anyways.
+                    if rsid_regex.match(rsid):
+                        rsid_nums.append(int(rsid[2:]))
+                        rsid_variant_idxs.append(variant_idx)
+    nums = np.frombuffer(rsid_nums, dtype=np.uint64)
+    idxs = np.frombuffer(rsid_variant_idxs, dtype=np.uint64)
+    order = np.lexsort((idxs, nums))
+    # Most datasets fit in uint32, which halves the size.
+    for name, values in [("rsid_nums", nums), ("rsid_variant_idxs", idxs)]:
+        if len(values) == 0 or values.max() < 2**32:
+            values = values.astype(np.uint32)
+        np.save(os.path.join(out_dirpath, name + ".npy"), values[order])
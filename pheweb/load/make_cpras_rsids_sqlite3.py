@@ -1,5 +1,20 @@
-from ..file_utils import VariantFileReader, get_filepath, get_tmp_path
+"""
+This script makes `cpras-rsids-sqlite3`, which the server uses to autocomplete variants and rsids if `sites/autocomplete/` doesn't exist.
 
+Each row of `cpras_rsids` is a variant and one of its rsids (or NULL), in the same order as `sites.tsv`.
+`chrom_idx` and `pos` are indexed, so the variants whose position starts with some digits are a few range queries
+(`LIKE` is case-insensitive, so it can't use an index on `cpra`), and `rsid` is indexed too.
+
+Since `sites.tsv` is already sorted by (chrom_idx, pos), rows are inserted in the order of that index, which keeps its pages in order and makes building it cheap.
+The file is written with journaling and syncing turned off, because a crash leaves the tmp file behind and it just gets remade.
+"""
+
+from ..file_utils import read_maybe_gzip, get_filepath, get_tmp_path
+from ..utils import chrom_order
+from .build_manifest import BuildTarget
+
+import csv
+import operator
 import sqlite3
 from pathlib import Path
 from typing import List, Iterator, Tuple, Optional
@@ -14,37 +29,59 @@ def run(argv: List[str]) -> None:
     sites_filepath = Path(get_filepath("sites"))
     cpras_rsids_filepath = Path(get_filepath("cpras-rsids-sqlite3", must_exist=False))
 
-    if (
-        cpras_rsids_filepath.exists()
-        and cpras_rsids_filepath.stat().st_mtime >= sites_filepath.stat().st_mtime
-    ):
+    target = BuildTarget([str(cpras_rsids_filepath)], [str(sites_filepath)])
+    if target.is_up_to_date():
         print("cpras-rsids-sqlite3 is up-to-date!")
 
     else:
-
-        def get_cpra_rsid_pairs() -> Iterator[Tuple[str, Optional[str]]]:
-            with VariantFileReader(sites_filepath) as reader:
-                for v in reader:
-                    cpra = "{chrom}-{pos}-{ref}-{alt}".format(**v)
-                    if v["rsids"]:
-                        for rsid in v["rsids"].split(","):
-                            yield (cpra, rsid)
-                    else:
-                        yield (cpra, None)
-
         if cpras_rsids_filepath.exists():
             cpras_rsids_filepath.unlink()
         cpras_rsids_tmp_filepath = Path(get_tmp_path(cpras_rsids_filepath))
         if cpras_rsids_tmp_filepath.exists():
             cpras_rsids_tmp_filepath.unlink()
-        db_conn = sqlite3.connect(str(cpras_rsids_tmp_filepath))
+        make_cpras_rsids_sqlite3(str(sites_filepath), str(cpras_rsids_tmp_filepath))
+        cpras_rsids_tmp_filepath.rename(cpras_rsids_filepath)
+        target.record()
+        print("Done making cpras-rsids sqlite3 at {}".format(str(cpras_rsids_filepath)))
+
+
+def get_cpra_rsid_rows(
+    sites_filepath: str,
+) -> Iterator[Tuple[str, Optional[str], int, int]]:
+    # Only these columns are needed, so take them from each row as strings instead of parsing every field.
+    with read_maybe_gzip(sites_filepath) as f:
+        reader = csv.reader(f, dialect="pheweb-internal-dialect")
+        fields = next(reader)
+        get_columns = operator.itemgetter(
+            *[fields.index(field) for field in ["chrom", "pos", "ref", "alt", "rsids"]]
+        )
+        for row in reader:
+            chrom, pos, ref, alt, rsids = get_columns(row)
+            cpra = "-".join((chrom, pos, ref, alt))
+            chrom_idx, pos_int = chrom_order[chrom], int(pos)
+            if rsids:
+                for rsid in rsids.split(","):
+                    yield (cpra, rsid, chrom_idx, pos_int)
+            else:
+                yield (cpra, None, chrom_idx, pos_int)
+
+
+def make_cpras_rsids_sqlite3(sites_filepath: str, out_filepath: str) -> None:
+    db_conn = sqlite3.connect(out_filepath)
+    try:
+        db_conn.execute("PRAGMA journal_mode = OFF")
+        db_conn.execute("PRAGMA synchronous = OFF")
+        db_conn.execute("PRAGMA locking_mode = EXCLUSIVE")
+        db_conn.execute("PRAGMA cache_size = -500000")  # 500MB
         with db_conn:
-            db_conn.execute("CREATE TABLE cpras_rsids (cpra TEXT, rsid TEXT)")
+            db_conn.execute(
+                "CREATE TABLE cpras_rsids (cpra TEXT, rsid TEXT, chrom_idx INT, pos INT)"
+            )
             db_conn.executemany(
-                "INSERT INTO cpras_rsids (cpra, rsid) VALUES (?,?)",
-                get_cpra_rsid_pairs(),
+                "INSERT INTO cpras_rsids (cpra, rsid, chrom_idx, pos) VALUES (?,?,?,?)",
+                get_cpra_rsid_rows(sites_filepath),
             )
+            db_conn.execute("CREATE INDEX pos_idx ON cpras_rsids (chrom_idx, pos)")
             db_conn.execute("CREATE INDEX rsid_idx ON cpras_rsids (rsid)")
-
-        cpras_rsids_tmp_filepath.rename(cpras_rsids_filepath)
-        print("Done making cpras-rsids sqlite3 at {}".format(str(cpras_rsids_filepath)))
+    finally:
+        db_conn.close()
@@ -0,0 +1,271 @@
+"""
+This script converts `resources/rsids-*.tsv.gz` into `rsids-*.blocks`, a binary file that `add-rsids` can read without parsing text.
+It only has to be made once for each version of dbSNP and genome build, so if `cache_dir` is set it's written there and shared by every dataset.
+
+The file is a sequence of zlib-compressed blocks, followed by an index of the blocks:
+- Each block holds up to `BLOCK_NUM_RECORDS` records from one chromosome, sorted by position like the text file, with one record per alt.
+  Its uncompressed layout is `pos` (uint32 per record), `rsid` (the number of each `rs123`, uint64 per record),
+  and then every `ref` followed by every `alt`, each joined with `\\n`.
+  All the records at a position are in the same block.
+- The index is a numpy structured array (`INDEX_DTYPE`) with the chromosome, first and last position, and byte range of each block,
+  so a reader can seek straight to the blocks of a chromosome and skip blocks that none of its variants fall in.
+- The file ends with the byte offset and length of the index, the size, mtime and hash of the rsids file that it was made from, and `MAGIC`.
+  If the rsids file is replaced (eg, re-downloaded or edited), the blocks file no longer matches it and is re-made.
+
+Chromosomes are converted in parallel and then concatenated.
+"""
+
+from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
+from ..file_utils import get_filepath, get_tmp_path, read_lines_on_chrom
+from .. import conf
+from .load_utils import Parallelizer
+from .build_manifest import get_file_hash
+
+import os
+import re
+import zlib
+import struct
+import shutil
+import argparse
+import numpy as np
+from typing import List, Dict, Any, Tuple, Optional
+
+MAGIC = b"PWRSIDB2"
+BLOCK_NUM_RECORDS = 2**16
+INDEX_DTYPE = np.dtype(
+    [
+        ("chrom_idx", "<u1"),
+        ("first_pos", "<u4"),
+        ("last_pos", "<u4"),
+        ("num_records", "<u4"),
+        ("refs_nbytes", "<u8"),
+        ("offset", "<u8"),
+        ("nbytes", "<u8"),
+    ]
+)
+_TRAILER = struct.Struct("<QQQQ40s8s")
+rsid_regex = re.compile(r"^rs[1-9][0-9]*$")
+
+
+def get_rsids_blocks_filepath() -> str:
+    filepath = get_filepath("rsids-blocks", must_exist=False)
+    cache_dir = conf.get_cache_dir()
+    if cache_dir:
+        return os.path.join(cache_dir, os.path.basename(filepath))
+    return filepath
+
+
+def get_rsids_blocks_source(blocks_filepath: str) -> Optional[Tuple[int, int, str]]:
+    """Returns the (size, mtime_ns, hash) of the rsids file that `blocks_filepath` was made from, or None if it isn't a complete blocks file."""
+    try:
+        with open(blocks_filepath, "rb") as f:
+            f.seek(-_TRAILER.size, os.SEEK_END)
+            _, _, size, mtime_ns, file_hash, magic = _TRAILER.unpack(
+                f.read(_TRAILER.size)
+            )
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC:
+        return None
+    return (size, mtime_ns, file_hash.decode())
+
+
+def is_rsids_blocks_file_up_to_date(blocks_filepath: str, rsids_filepath: str) -> bool:
+    source = get_rsids_blocks_source(blocks_filepath)
+    if source is None:
+        return False
+    st = os.stat(rsids_filepath)
+    if source[:2] == (st.st_size, st.st_mtime_ns):
+        return True
+    # The rsids file might just have been touched or copied, so check its contents.
+    return source[0] == st.st_size and source[2] == get_file_hash(rsids_filepath)
+
+
+def _encode_block(records: List[Tuple[int, str, str, int]]) -> Tuple[bytes, int]:
+    positions = np.array([r[0] for r in records], dtype=np.uint32)
+    rsids = np.array([r[3] for r in records], dtype=np.uint64)
+    refs = "\n".join(r[1] for r in records).encode()
+    alts = "\n".join(r[2] for r in records).encode()
+    return (
+        zlib.compress(positions.tobytes() + rsids.tobytes() + refs + alts, 6),
+        len(refs),
+    )
+
+
+def convert_chrom(
+    task: Dict[str, Any],
+) -> List[Tuple[int, int, int, int, int, int, int]]:
+    """Writes the blocks of one chromosome to `task["out_filepath"]` and returns their index rows, with offsets from the start of that file."""
+    # Import here to avoid a circular import, since `add_rsids` reads these files.
+    from .add_rsids import get_rsid_reader, get_one_chr_pos_at_a_time
+
+    chrom = task["chrom"]
+    chrom_names = [chrom] + [
+        alias for alias, canonical in chrom_aliases.items() if canonical == chrom
+    ]
+    index_rows = []
+    offset = 0
+    with read_lines_on_chrom(task["rsids_filepath"], chrom_names) as lines, open(
+        task["out_filepath"], "wb"
+    ) as f:
+
+        def write_block(records: List[Tuple[int, str, str, int]]) -> None:
+            nonlocal offset
+            data, refs_nbytes = _encode_block(records)
+            f.write(data)
+            index_rows.append(
+                (
+                    chrom_order[chrom],
+                    records[0][0],
+                    records[-1][0],
+                    len(records),
+                    refs_nbytes,
+                    offset,
+                    len(data),
+                )
+            )
+            offset += len(data)
+
+        records: List[Tuple[int, str, str, int]] = []
+        for group in get_one_chr_pos_at_a_time(
+            get_rsid_reader(lines, task["rsids_filepath"])
+        ):
+            if len(records) + len(group) > BLOCK_NUM_RECORDS and records:
+                write_block(records)
+                records = []
+            for r in group:
+                if not rsid_regex.match(r["rsid"]):
+                    raise PheWebError(
+                        "The rsids file, {!r}, has the rsid {!r}, which isn't like `rs123`.".format(
+                            task["rsids_filepath"], r["rsid"]
+                        )
+                    )
+                records.append((r["pos"], r["ref"], r["alt"], int(r["rsid"][2:])))
+        if records:
+            write_block(records)
+    return index_rows
+
+
+def make_rsids_blocks(rsids_filepath: str, out_filepath: str) -> None:
+    # Get the hash before converting, in case the rsids file changes while we work.
+    st = os.stat(rsids_filepath)
+    rsids_file_hash = get_file_hash(rsids_filepath)
+    tasks = [
+        {
+            "rsids_filepath": rsids_filepath,
+            "chrom": chrom,
+            "out_filepath": get_tmp_path("rsids-blocks-chr{}".format(chrom)),
+        }
+        for chrom in chrom_order_list
+    ]
+    index_rows_by_chrom = {}
+    for ret in Parallelizer().run_single_tasks(
+        tasks, convert_chrom, cmd="make-rsids-blocks"
+    ):
+        index_rows_by_chrom[ret["task"]["chrom"]] = ret["value"]
+
+    # Datasets that share `cache_dir` might be making this file at the same time, so each writes its own tmp file.
+    tmp_filepath = "{}.{}".format(get_tmp_path(out_filepath), os.getpid())
+    index = []
+    with open(tmp_filepath, "wb") as f:
+        for task in tasks:
+            base_offset = f.tell()
+            for row in index_rows_by_chrom[task["chrom"]]:
+                index.append(row[:5] + (row[5] + base_offset, row[6]))
+            with open(task["out_filepath"], "rb") as f_part:
+                shutil.copyfileobj(f_part, f)
+            os.remove(task["out_filepath"])
+        index_bytes = np.array(index, dtype=INDEX_DTYPE).tobytes()
+        index_offset = f.tell()
+        f.write(index_bytes)
+        f.write(
+            _TRAILER.pack(
+                index_offset,
+                len(index_bytes),
+                st.st_size,
+                st.st_mtime_ns,
+                rsids_file_hash.encode(),
+                MAGIC,
+            )
+        )
+    os.replace(tmp_filepath, out_filepath)
+
+
+class RsidBlocksReader:
+    """
+    Reads a file made by `make_rsids_blocks()`.
+
+        with RsidBlocksReader(filepath) as reader:
+            for block_num, (first_pos, last_pos) in enumerate(reader.get_block_ranges('1')):
+                positions, refs, alts, rsid_nums = reader.read_block('1', block_num)
+    """
+
+    def __init__(self, filepath: str):
+        self._filepath = filepath
+        self._f = open(filepath, "rb")
+        self._f.seek(-_TRAILER.size, os.SEEK_END)
+        index_offset, index_nbytes, _, _, _, magic = _TRAILER.unpack(
+            self._f.read(_TRAILER.size)
+        )
+        if magic != MAGIC:
+            raise PheWebError(
+                "{!r} isn't an rsids file made by this version of `pheweb make-rsids-blocks`.  Try `pheweb make-rsids-blocks -f`.".format(
+                    filepath
+                )
+            )
+        self._f.seek(index_offset)
+        index = np.frombuffer(self._f.read(index_nbytes), dtype=INDEX_DTYPE)
+        self._index_by_chrom = {
+            chrom: index[index["chrom_idx"] == chrom_idx]
+            for chrom_idx, chrom in enumerate(chrom_order_list)
+        }
+
+    def __enter__(self) -> "RsidBlocksReader":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._f.close()
+
+    def get_block_ranges(self, chrom: str) -> List[Tuple[int, int]]:
+        """Returns the (first_pos, last_pos) of each block of `chrom`, in order"""
+        rows = self._index_by_chrom[chrom]
+        return list(zip(rows["first_pos"].tolist(), rows["last_pos"].tolist()))
+
+    def read_block(
+        self, chrom: str, block_num: int
+    ) -> Tuple[List[int], List[str], List[str], List[int]]:
+        """Returns the positions, refs, alts and rsid numbers of the records in a block of `chrom`"""
+        row = self._index_by_chrom[chrom][block_num]
+        self._f.seek(int(row["offset"]))
+        data = zlib.decompress(self._f.read(int(row["nbytes"])))
+        n, refs_nbytes = int(row["num_records"]), int(row["refs_nbytes"])
+        positions = np.frombuffer(data, dtype=np.uint32, count=n).tolist()
+        rsids = np.frombuffer(data, dtype=np.uint64, count=n, offset=4 * n).tolist()
+        refs = data[12 * n : 12 * n + refs_nbytes].decode().split("\n")
+        alts = data[12 * n + refs_nbytes :].decode().split("\n")
+        return (positions, refs, alts, rsids)
+
+
+def run(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert the rsids file into a binary file that `pheweb add-rsids` reads much faster.  This only happens once for each version of dbSNP and genome build, and is shared through `cache_dir` if it's set."
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Re-make the file even if it's up-to-date",
+    )
+    args = parser.parse_args(argv)
+
+    rsids_filepath = get_filepath("rsids", must_exist=False)
+    if not os.path.exists(rsids_filepath):
+        from . import download_rsids
+
+        download_rsids.run([])
+    out_filepath = get_rsids_blocks_filepath()
+    if is_rsids_blocks_file_up_to_date(out_filepath, rsids_filepath) and not args.force:
+        print("{} is up-to-date!".format(out_filepath))
+        return
+    print("Converting {} -> {}".format(rsids_filepath, out_filepath))
+    make_rsids_blocks(rsids_filepath, out_filepath)
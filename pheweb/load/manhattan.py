@@ -11,9 +11,14 @@ This script creates json files which can be used to render Manhattan plots.
 
 # TODO: keep 10 variants unbinned from each chrom
 
-from ..utils import chrom_order
+from ..utils import chrom_order, chrom_order_list
 from .. import conf
-from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
+from ..file_utils import (
+    VariantFileReader,
+    ColumnarVariantFileReader,
+    write_json,
+    get_pheno_filepath,
+)
 from .load_utils import (
     MaxPriorityQueue,
     parallelize_per_pheno,
@@ -22,7 +27,8 @@ from .load_utils import (
 )
 
 import math, argparse
-from typing import List, Dict, Any, Tuple
+import numpy as np
+from typing import List, Dict, Any, Tuple, Callable
 
 Variant = Dict[str, Any]
 
@@ -47,10 +53,13 @@ def run(argv: List[str]) -> None:
         convert=make_manhattan_json_file,
         cmd="manhattan",
         phenos=phenos,
+        get_config=get_config,
     )
 
 
 def get_input_filepaths(pheno: dict) -> List[str]:
+    if conf.get_manhattan_binner() == "numpy":
+        return [get_pheno_filepath("pheno_columns", pheno["phenocode"])]
     return [get_pheno_filepath("pheno_gz", pheno["phenocode"])]
 
 
@@ -58,7 +67,23 @@ def get_output_filepaths(pheno: dict) -> List[str]:
     return [get_pheno_filepath("manhattan", pheno["phenocode"], must_exist=False)]
 
 
+def get_config() -> Dict[str, Any]:
+    return {
+        "manhattan_num_unbinned": conf.get_manhattan_num_unbinned(),
+        "manhattan_peak_max_count": conf.get_manhattan_peak_max_count(),
+        "manhattan_peak_pval_threshold": conf.get_manhattan_peak_pval_threshold(),
+        "manhattan_peak_sprawl_dist": conf.get_manhattan_peak_sprawl_dist(),
+        "manhattan_peak_variant_counting_pval_threshold": conf.get_manhattan_peak_variant_counting_pval_threshold(),
+    }
+
+
 def make_manhattan_json_file(pheno: Dict[str, Any]) -> None:
+    if conf.get_manhattan_binner() == "numpy":
+        make_manhattan_json_file_from_columns(
+            get_pheno_filepath("pheno_columns", pheno["phenocode"]),
+            get_pheno_filepath("manhattan", pheno["phenocode"], must_exist=False),
+        )
+        return
     make_manhattan_json_file_explicit(
         get_pheno_filepath("pheno_gz", pheno["phenocode"]),
         get_pheno_filepath("manhattan", pheno["phenocode"], must_exist=False),
@@ -74,6 +99,19 @@ def make_manhattan_json_file_explicit(in_filepath: str, out_filepath: str) -> No
     write_json(filepath=out_filepath, data=data)
 
 
+def make_manhattan_json_file_from_columns(in_dirpath: str, out_filepath: str) -> None:
+    binner = ArrayBinner()
+    with ColumnarVariantFileReader(in_dirpath) as reader:
+        binner.process_arrays(
+            reader.get_column("chrom_idx"),
+            reader.get_column("pos"),
+            reader.get_column("pval"),
+            reader.get_variant,
+        )
+        data = binner.get_result()
+    write_json(filepath=out_filepath, data=data)
+
+
 class Binner:
     def __init__(self):
         self._peak_best_variant = None
@@ -106,13 +144,7 @@ class Binner:
         """
 
         if variant["pval"] != 0:
-            qval = -math.log10(variant["pval"])
-            if qval > 40:
-                self._qval_bin_size = 0.2  # this makes 200 bins for a y-axis extending past 40 (but folded so that the lower half is 0-20)
-            elif qval > 20:
-                self._qval_bin_size = (
-                    0.1  # this makes 200-400 bins for a y-axis extending up to 20-40.
-                )
+            self._update_qval_bin_size(-math.log10(variant["pval"]))
 
         if variant["pval"] < conf.get_manhattan_peak_pval_threshold():  # part of a peak
             if self._peak_best_variant is None:  # open a new peak
@@ -156,6 +188,14 @@ class Binner:
         else:
             self._maybe_bin_variant(variant)
 
+    def _update_qval_bin_size(self, qval: float) -> None:
+        if qval > 40:
+            self._qval_bin_size = 0.2  # this makes 200 bins for a y-axis extending past 40 (but folded so that the lower half is 0-20)
+        elif qval > 20:
+            self._qval_bin_size = (
+                0.1  # this makes 200-400 bins for a y-axis extending up to 20-40.
+            )
+
     def _maybe_peak_variant(self, variant: Variant) -> None:
         self._peak_pq.add_and_keep_size(
             variant,
@@ -173,21 +213,24 @@ class Binner:
         )
 
     def _bin_variant(self, variant: Variant) -> None:
-        chrom_idx = chrom_order[variant["chrom"]]
+        qval = (
+            math.inf
+            if variant["pval"] == 0
+            else self._rounded(-math.log10(variant["pval"]))
+        )
+        self._add_qval_to_bin(
+            chrom_order[variant["chrom"]], variant["pos"] // BIN_LENGTH, qval
+        )
+
+    def _add_qval_to_bin(self, chrom_idx: int, pos_bin_id: int, qval: float) -> None:
         if chrom_idx not in self._bins:
             self._bins[chrom_idx] = {}
-        pos_bin_id = variant["pos"] // BIN_LENGTH
         if pos_bin_id not in self._bins[chrom_idx]:
             self._bins[chrom_idx][pos_bin_id] = {
-                "chrom": variant["chrom"],
+                "chrom": chrom_order_list[chrom_idx],
                 "startpos": pos_bin_id * BIN_LENGTH,
                 "qvals": set(),
             }
-        qval = (
-            math.inf
-            if variant["pval"] == 0
-            else self._rounded(-math.log10(variant["pval"]))
-        )
         self._bins[chrom_idx][pos_bin_id]["qvals"].add(qval)
 
     def get_result(self) -> Dict[str, List[Variant]]:
@@ -252,3 +295,124 @@ class Binner:
             else:
                 rv_qval_extents.append((start, end))
         return (rv_qvals, rv_qval_extents)
+
+
+class ArrayBinner(Binner):
+    """
+    Gives exactly the same result as `Binner`, but takes whole columns (eg, from `ColumnarVariantFileReader`) instead of one variant at a time.
+
+    Once `unbinned_variant_pq` is full, most variants are too weak to be unbinned and too weak to be in a peak, so `Binner` just bins them.
+    Those variants are binned here with numpy, a chunk at a time.
+    The rest go through `Binner.process_variant()` in order, so peaks and `unbinned_variant_pq` end up exactly the same.
+    """
+
+    _chunk_size = 2**16
+    # `unbinned_variant_pq` gets stronger quickly at first, so start with small chunks.  This matters for short inputs like best_of_pheno/*.
+    _first_chunk_size = 2**10
+
+    def process_arrays(
+        self,
+        chrom_idxs: np.ndarray,
+        positions: np.ndarray,
+        pvals: np.ndarray,
+        get_variant: Callable[[int], Variant],
+    ) -> None:
+        """`get_variant(i)` must return the full variant at index `i`.  It's only called for unbinned variants."""
+        self._get_variant = get_variant
+        pvals = np.asarray(pvals, dtype=np.float64)
+        # Use `math.log10()` so that qvals match `Binner` exactly.  There are few unique pvals, because they're rounded.
+        unique_pvals, pval_inverse = np.unique(pvals, return_inverse=True)
+        unique_qvals = np.array(
+            [math.inf if p == 0 else -math.log10(p) for p in unique_pvals.tolist()],
+            dtype=np.float64,
+        )
+        qvals = unique_qvals[pval_inverse.reshape(-1)]
+        # Variants in peaks and variants that change `_qval_bin_size` must always go through `process_variant()`.
+        must_process = (pvals < conf.get_manhattan_peak_pval_threshold()) | (
+            (qvals > 20) & (pvals != 0)
+        )
+
+        num_unbinned = conf.get_manhattan_num_unbinned()
+        i, n = 0, len(pvals)
+        chunk_size = min(self._first_chunk_size, self._chunk_size)
+        while i < n:
+            if len(self._unbinned_variant_pq) < num_unbinned:
+                self._process_index(i, chrom_idxs, positions, pvals)
+                i += 1
+                continue
+            end = min(i + chunk_size, n)
+            chunk_size = min(chunk_size * 2, self._chunk_size)
+            # The weakest pval in the full `unbinned_variant_pq` only gets stronger, so anything at least this weak gets binned right away.
+            weakest_unbinned_pval = self._unbinned_variant_pq.peek_priority()
+            is_processed = must_process[i:end] | (pvals[i:end] < weakest_unbinned_pval)
+            processed_idxs = np.flatnonzero(is_processed) + i
+            qval_bin_sizes = [self._qval_bin_size]
+            for idx in processed_idxs.tolist():
+                self._process_index(idx, chrom_idxs, positions, pvals)
+                qval_bin_sizes.append(self._qval_bin_size)
+            binned_idxs = np.flatnonzero(~is_processed) + i
+            if len(binned_idxs):
+                # Each variant is binned with the `_qval_bin_size` left by the last processed variant before it.
+                num_processed_before = np.searchsorted(processed_idxs, binned_idxs)
+                self._bin_arrays(
+                    np.asarray(chrom_idxs[binned_idxs], dtype=np.int64),
+                    np.asarray(positions[binned_idxs], dtype=np.int64),
+                    qvals[binned_idxs],
+                    np.array(qval_bin_sizes)[num_processed_before],
+                )
+            i = end
+
+    def _process_index(
+        self,
+        idx: int,
+        chrom_idxs: np.ndarray,
+        positions: np.ndarray,
+        pvals: np.ndarray,
+    ) -> None:
+        self.process_variant(
+            {
+                "chrom": chrom_order_list[chrom_idxs[idx]],
+                "pos": int(positions[idx]),
+                "pval": float(pvals[idx]),
+                "_idx": idx,
+            }
+        )
+
+    def _bin_arrays(
+        self,
+        chrom_idxs: np.ndarray,
+        positions: np.ndarray,
+        qvals: np.ndarray,
+        qval_bin_sizes: np.ndarray,
+    ) -> None:
+        # Same arithmetic as `_rounded()`, except for the final `round()` which must be python's.
+        xs = (
+            np.floor_divide(qvals, qval_bin_sizes) * qval_bin_sizes + qval_bin_sizes / 2
+        )
+        xs[np.isinf(qvals)] = math.inf
+        unique_xs, x_idxs = np.unique(xs, return_inverse=True)
+        unique_xs = [x if math.isinf(x) else round(x, 3) for x in unique_xs.tolist()]
+        # pack (chrom_idx, pos_bin_id, x_idx) into one int so that np.unique() is fast.  Chunks are < 2**24 variants.
+        keys = np.unique(
+            (chrom_idxs << 40)
+            | ((positions // BIN_LENGTH) << 24)
+            | x_idxs.reshape(-1).astype(np.int64)
+        )
+        for key in keys.tolist():
+            self._add_qval_to_bin(
+                key >> 40, (key >> 24) & 0xFFFF, unique_xs[key & 0xFFFFFF]
+            )
+
+    def get_result(self) -> Dict[str, List[Variant]]:
+        result = super().get_result()
+        result["unbinned_variants"] = [
+            self._get_full_variant(v) for v in result["unbinned_variants"]
+        ]
+        return result
+
+    def _get_full_variant(self, variant: Variant) -> Variant:
+        full_variant = dict(self._get_variant(variant["_idx"]))
+        for key, value in variant.items():  # eg, "num_significant_in_peak" and "peak"
+            if key not in full_variant and key != "_idx":
+                full_variant[key] = value
+        return full_variant
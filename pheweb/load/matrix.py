@@ -1,20 +1,30 @@
-# TODO: Parallelize by chromosome.
-#  Spawn a pheweb process to do each chromosome.  Each one must do:
-#  + For every `pheno_gz/*.gz` and `sites/sites.tsv`, find the byte offset to the block that begins our chromosome.
-#  + Now cffi down into a function just like our normal one, but which starts at that offset, discards variants until it hits the target chromosome, merges, and then exits.
-#  + Don't append an empty block in `BgzipWriter:close()`.
-#  When all the child processes are done, the main thread needs to concatenate all the single-chrom matrix files and then append an empty bgzip block to signal EOF.
-
-
-from ..utils import get_phenolist, PheWebError
-from ..file_utils import MatrixReader, get_tmp_path, get_filepath, get_pheno_filepath
-from .load_utils import mtime
+# The matrix is made one chromosome at a time, in parallel:
+#  + For every `pheno_gz/*.gz`, find the virtual offset of the block that begins each chromosome from its `.tbi`.
+#  + For each chromosome, cffi down into `make_matrix_chrom()`, which starts reading each pheno at that offset,
+#    skips through `sites/sites.tsv` (which isn't bgzipped) to that chromosome, merges, and writes a bgzip file without an EOF block.
+#  + Concatenate the single-chrom matrix files in order and then append an empty bgzip block to signal EOF.
+
+
+from ..utils import get_phenolist, chrom_order, PheWebError
+from ..file_utils import (
+    MatrixReader,
+    get_tmp_path,
+    get_filepath,
+    get_pheno_filepath,
+    get_tabix_chrom_virtual_offsets,
+    BGZF_EOF_BLOCK,
+)
+from .load_utils import Parallelizer
+from .build_manifest import BuildTarget
 from .cffi._x import ffi, lib
 
 import os
 import glob
+import shutil
 import pysam
-from typing import List
+from typing import List, Dict, Any
+
+NO_VIRTUAL_OFFSET = 2**64 - 1  # must match `NO_VIRTUAL_OFFSET` in x.cpp
 
 
 def clear_out_junk() -> None:
@@ -27,8 +37,14 @@ def clear_out_junk() -> None:
             os.remove(filepath)
 
 
+def get_build_target() -> BuildTarget:
+    input_filepaths = [
+        get_pheno_filepath("pheno_gz", pheno["phenocode"]) for pheno in get_phenolist()
+    ] + [get_filepath("sites")]
+    return BuildTarget([get_filepath("matrix", must_exist=False)], input_filepaths)
+
+
 def should_run() -> bool:
-    sites_filepath = get_filepath("sites")
     matrix_gz_filepath = get_filepath("matrix", must_exist=False)
 
     if not os.path.exists(matrix_gz_filepath):
@@ -52,18 +68,77 @@ def should_run() -> bool:
         )
         return True
 
-    # If pheno_gz or sites.tsv are newer than matrix, rebuild.
-    infilepaths = [
-        get_pheno_filepath("pheno_gz", phenocode) for phenocode in cur_phenocodes
-    ] + [sites_filepath]
-    infile_modtime = max(mtime(filepath) for filepath in infilepaths)
-    if infile_modtime > mtime(matrix_gz_filepath):
-        print("rerunning because some input files are newer than matrix.tsv.gz")
+    # If pheno_gz or sites.tsv changed since the matrix was made, rebuild.
+    if not get_build_target().is_up_to_date():
+        print("rerunning because some input files changed since matrix.tsv.gz was made")
         return True
 
     return False
 
 
+def make_matrix(out_filepath: str) -> None:
+    sites_filepath = get_filepath("sites")
+    # Sort, so that the phenotypes' columns are in the same order as the `glob()` in C that used to list them.
+    pheno_gz_filepaths = sorted(glob.glob(get_filepath("pheno_gz") + "/*.gz"))
+    offsets_by_pheno = [
+        get_tabix_chrom_virtual_offsets(filepath + ".tbi")
+        for filepath in pheno_gz_filepaths
+    ]
+    chroms = sorted(
+        set(chrom for offsets in offsets_by_pheno for chrom in offsets),
+        key=lambda chrom: chrom_order[chrom],
+    )
+    if not chroms:
+        raise PheWebError("None of the files in pheno_gz/ have any variants.")
+
+    tasks = [
+        {
+            "sites_filepath": sites_filepath,
+            "pheno_gz_filepaths": pheno_gz_filepaths,
+            "virtual_offsets": [
+                offsets.get(chrom, NO_VIRTUAL_OFFSET) for offsets in offsets_by_pheno
+            ],
+            "chrom": chrom,
+            "out_filepath": get_tmp_path("matrix-chr{}.tsv.gz".format(chrom)),
+            "write_header": i == 0,
+        }
+        for i, chrom in enumerate(chroms)
+    ]
+    for _ in Parallelizer().run_single_tasks(tasks, make_matrix_chrom, cmd="matrix"):
+        pass
+
+    with open(out_filepath, "wb") as f:
+        for task in tasks:
+            with open(task["out_filepath"], "rb") as f_part:
+                shutil.copyfileobj(f_part, f)
+            os.remove(task["out_filepath"])
+        f.write(BGZF_EOF_BLOCK)
+
+
+def make_matrix_chrom(task: Dict[str, Any]) -> None:
+    # Keep references to the `char[]`s so that they aren't freed before the call.
+    pheno_gz_filepaths = [
+        ffi.new("char[]", filepath.encode("utf8"))
+        for filepath in task["pheno_gz_filepaths"]
+    ]
+    ret = lib.cffi_make_matrix_chrom(
+        task["sites_filepath"].encode("utf8"),
+        ffi.new("const char *[]", pheno_gz_filepaths),
+        ffi.new("uint64_t[]", task["virtual_offsets"]),
+        len(pheno_gz_filepaths),
+        task["chrom"].encode("utf8"),
+        task["out_filepath"].encode("utf8"),
+        1 if task["write_header"] else 0,
+    )
+    ret_bytes = ffi.string(ret, maxlen=1000)
+    if ret_bytes != b"ok":
+        raise PheWebError(
+            "The portion of `pheweb matrix` written in c++/cffi failed on chromosome {} with the message {!r}".format(
+                task["chrom"], ret_bytes
+            )
+        )
+
+
 def run(argv: List[str]) -> None:
 
     if "-h" in argv or "--help" in argv:
@@ -74,30 +149,17 @@ def run(argv: List[str]) -> None:
     if should_run():
         clear_out_junk()
 
-        sites_filepath = get_filepath("sites")
-        pheno_gz_glob = get_filepath("pheno_gz") + "/*.gz"
+        target = get_build_target()
         matrix_gz_tmp_filepath = get_tmp_path(matrix_gz_filepath)
-
-        # we don't need `ffi.new('char[]', ...)` because args are `const`
-        ret = lib.cffi_make_matrix(
-            sites_filepath.encode("utf8"),
-            pheno_gz_glob.encode("utf8"),
-            matrix_gz_tmp_filepath.encode("utf8"),
-        )
-        ret_bytes = ffi.string(ret, maxlen=1000)
-        if ret_bytes != b"ok":
-            raise PheWebError(
-                "The portion of `pheweb matrix` written in c++/cffi failed with the message "
-                + repr(ret_bytes)
-            )
+        make_matrix(matrix_gz_tmp_filepath)
         os.rename(matrix_gz_tmp_filepath, matrix_gz_filepath)
+        target.record()
     else:
         print("matrix is up-to-date!")
 
     matrix_tbi_filepath = matrix_gz_filepath + ".tbi"
-    if not os.path.exists(matrix_tbi_filepath) or mtime(matrix_tbi_filepath) < mtime(
-        matrix_gz_filepath
-    ):
+    tbi_target = BuildTarget([matrix_tbi_filepath], [matrix_gz_filepath])
+    if not tbi_target.is_up_to_date():
         print("tabixing matrix")
         pysam.tabix_index(
             filename=matrix_gz_filepath,
@@ -106,5 +168,6 @@ def run(argv: List[str]) -> None:
             start_col=1,
             end_col=1,  # note: column indexes start at 0, whereas `/usr/bin/tabix` starts at 1
         )
+        tbi_target.record()
     else:
         print("matrix.tbi is up-to-date!")
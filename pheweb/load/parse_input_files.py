@@ -13,16 +13,19 @@ from typing import List,Dict,Any,Iterator
 def run(argv:List[str]) -> None:
     parser = argparse.ArgumentParser(description="import input files into a nice format")
     parser.add_argument('--phenos', help="Can be like '4,5,6,12' or '4-6,12' to run on only the phenos at those positions (0-indexed) in pheno-list.json (and only if they need to run)")
+    parser.add_argument('--engine', choices=['python', 'chunked'], help="How to parse input files (default: the `assoc_parse_engine` option, which defaults to 'python')")
     args = parser.parse_args(argv)
+    if args.engine: conf.set_override('assoc_parse_engine', args.engine)
 
     phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
 
     results_by_phenocode = parallelize_per_pheno(
-        get_input_filepaths = lambda pheno: pheno['assoc_files'],
-        get_output_filepaths = lambda pheno: get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False),
+        get_input_filepaths = get_input_filepaths,
+        get_output_filepaths = get_output_filepaths,
         convert = convert,
         cmd = 'parse-input-files',
         phenos = phenos,
+        get_config = get_config,
     )
 
     failed_results = {phenocode:value for phenocode,value in results_by_phenocode.items() if not value['succeeded']}
@@ -51,6 +54,21 @@ def run(argv:List[str]) -> None:
             )
 
 
+def get_input_filepaths(pheno:Dict[str,Any]) -> List[str]:
+    return pheno['assoc_files']
+
+def get_output_filepaths(pheno:Dict[str,Any]) -> List[str]:
+    return [get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False)]
+
+def get_config() -> Dict[str,Any]:
+    return {
+        'assoc_min_maf': conf.get_assoc_min_maf(),
+        'pval_is_neglog10': conf.pval_is_neglog10(),
+        'field_aliases': conf.get_field_aliases(),
+        'debugging_limit_num_variants': conf.get_debugging_limit_num_variants(),
+    }
+
+
 def write_failures(filepath:str, failed_results:Dict[str,Any]):
     with open(filepath, 'w') as f:
         for phenocode,d in failed_results.items():
@@ -5,9 +5,10 @@ from ..file_utils import (
     get_pheno_filepath,
     write_heterogenous_variantfile,
 )
+from .build_manifest import BuildTarget
 
 import json
-from pathlib import Path
+import os
 from typing import Iterator, Dict, Any, List
 
 
@@ -62,22 +63,22 @@ def get_phenotypes_including_top_variants() -> Iterator[Dict[str, Any]]:
         yield ret
 
 
-def should_run() -> bool:
+def get_build_target() -> BuildTarget:
     output_filepaths = [
-        Path(get_filepath(name, must_exist=False))
+        get_filepath(name, must_exist=False)
         for name in ["phenotypes_summary", "phenotypes_summary_tsv"]
     ]
-    if not all(fp.exists() for fp in output_filepaths):
-        return True
-    oldest_output_mtime = min(fp.stat().st_mtime for fp in output_filepaths)
-    input_filepaths = [
-        Path(get_pheno_filepath("manhattan", pheno["phenocode"]))
-        for pheno in get_phenolist()
-    ]
-    newest_input_mtime = max(fp.stat().st_mtime for fp in input_filepaths)
-    if newest_input_mtime > oldest_output_mtime:
-        return True
-    return False
+    input_filepaths = [get_filepath("phenolist")]
+    for pheno in get_phenolist():
+        input_filepaths.append(get_pheno_filepath("manhattan", pheno["phenocode"]))
+        qq_filepath = get_pheno_filepath("qq", pheno["phenocode"], must_exist=False)
+        if os.path.exists(qq_filepath):
+            input_filepaths.append(qq_filepath)
+    return BuildTarget(output_filepaths, input_filepaths)
+
+
+def should_run() -> bool:
+    return not get_build_target().is_up_to_date()
 
 
 def run(argv: List[str]) -> None:
@@ -87,7 +88,8 @@ def run(argv: List[str]) -> None:
         )
         exit(1)
 
-    if not should_run():
+    target = get_build_target()
+    if target.is_up_to_date():
         print("Already up-to-date!")
         return
 
@@ -100,3 +102,4 @@ def run(argv: List[str]) -> None:
     out_filepath_tsv = get_filepath("phenotypes_summary_tsv", must_exist=False)
     write_heterogenous_variantfile(out_filepath_tsv, data, use_gzip=False)
     print("wrote {} phenotypes to {}".format(len(data), out_filepath_tsv))
+    target.record()
@@ -0,0 +1,103 @@
+"""
+This script writes compressed copies of the big JSON files that the server sends as-is, like `manhattan/<pheno>.json.gz` and `manhattan/<pheno>.json.br`.
+The server sends these to clients that accept them (see `serve.server_utils.send_generated_file()`), so it never has to compress those files itself.
+They're compressed as much as possible, since that only happens once.
+
+A copy is only re-made if it's older than its original.  Brotli copies are skipped if the `brotli` package isn't installed.
+"""
+
+from ..utils import get_phenolist
+from ..file_utils import (
+    get_filepath,
+    get_pheno_filepath,
+    get_tmp_path,
+    precompressed_suffix_for_encoding,
+)
+from .load_utils import Parallelizer
+
+import io
+import os
+import gzip
+import argparse
+from typing import List, Callable, Dict
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None  # type: ignore
+
+
+def _gzip_compress(data: bytes) -> bytes:
+    # Use mtime=0 so that the same file always gets the same copy.
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _brotli_compress(data: bytes) -> bytes:
+    return brotli.compress(data, quality=11, mode=brotli.MODE_TEXT)
+
+
+def get_compressors() -> Dict[str, Callable[[bytes], bytes]]:
+    compressors = {"gzip": _gzip_compress}
+    if brotli is not None:
+        compressors["br"] = _brotli_compress
+    return compressors
+
+
+def get_filepaths_to_precompress() -> List[str]:
+    filepaths = [
+        get_filepath("top-hits-1k", must_exist=False),
+        get_filepath("phenotypes_summary", must_exist=False),
+    ]
+    for pheno in get_phenolist():
+        for kind in ["manhattan", "qq"]:
+            filepaths.append(
+                get_pheno_filepath(kind, pheno["phenocode"], must_exist=False)
+            )
+    return [fp for fp in filepaths if os.path.exists(fp)]
+
+
+def get_stale_encodings(filepath: str) -> List[str]:
+    mtime = os.stat(filepath).st_mtime
+    stale_encodings = []
+    for encoding in get_compressors():
+        copy_filepath = filepath + precompressed_suffix_for_encoding[encoding]
+        if not os.path.exists(copy_filepath) or os.stat(copy_filepath).st_mtime < mtime:
+            stale_encodings.append(encoding)
+    return stale_encodings
+
+
+def precompress_file(filepath: str) -> None:
+    with open(filepath, "rb") as f:
+        data = f.read()
+    compressors = get_compressors()
+    for encoding in get_stale_encodings(filepath):
+        copy_filepath = filepath + precompressed_suffix_for_encoding[encoding]
+        tmp_filepath = get_tmp_path(copy_filepath)
+        with open(tmp_filepath, "wb") as f:
+            f.write(compressors[encoding](data))
+        os.replace(tmp_filepath, copy_filepath)
+
+
+def run(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Write gzip and brotli copies of the generated JSON files that the server sends, so that it doesn't have to compress them."
+    )
+    parser.parse_args(argv)
+
+    if brotli is None:
+        print(
+            "The python package `brotli` isn't installed, so only gzip copies will be made."
+        )
+    filepaths = [fp for fp in get_filepaths_to_precompress() if get_stale_encodings(fp)]
+    if not filepaths:
+        print("Compressed copies are all up-to-date, so there's nothing to do.")
+        return
+    # Start with the biggest files, so that one doesn't run alone at the end.
+    filepaths.sort(key=lambda fp: -os.stat(fp).st_size)
+    for _ in Parallelizer().run_single_tasks(
+        filepaths, precompress_file, cmd="precompress"
+    ):
+        pass
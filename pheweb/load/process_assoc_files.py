@@ -1,11 +1,26 @@
 # TODO: color lines with ==> using `colorama`
 # TODO: add a step to verify that the genome build is correct using detect_ref (once on first 10k of each input file, and again on `sites`)
 
-from ..utils import fmt_seconds
+"""
+`pheweb process` runs each step as soon as the steps whose outputs it reads have finished, so independent steps
+(eg, `make-gene-aliases-sqlite3` and `sites`) run at the same time.
+Each step runs in a child process, and its output is printed with its name in front.
+A step that runs tasks in parallel counts as `conf.get_num_procs(cmd)` processes, and other steps count as one,
+so that no more than `conf.get_num_procs()` processes are busy at once (unless a single step wants more).
+The steps send their parallel tasks to one `WorkerPool`, which is forked once for the whole run.
+"""
 
+from ..utils import fmt_seconds, PheWebError
+from .. import conf
+from .load_utils import WorkerPool, use_worker_pool
+
+import os
+import sys
 import time
+import selectors
 import importlib
-from typing import List
+import multiprocessing
+from typing import List, Dict, Optional
 
 scripts = """
 phenolist verify
@@ -15,19 +30,242 @@ make_gene_aliases_sqlite3
 add_rsids
 add_genes
 make_cpras_rsids_sqlite3
+make_autocomplete_index
 augment_phenos
 matrix
 gather_pvalues_for_each_gene
-manhattan
+summarize
 top_hits
-qq
 phenotypes
 pheno_correlation
-""".split(
-    "\n"
-)
+precompress
+""".split("\n")
 scripts = [script for script in scripts if script]
 
+# Maps each script to the scripts that make the files it reads.  Every script also runs after `phenolist verify` (see `get_plan()`).
+# `add_genes` and `gather_pvalues_for_each_gene` wait for `make_gene_aliases_sqlite3` because it downloads the genes file.
+dependencies: Dict[str, List[str]] = {
+    "phenolist verify": [],
+    "parse_input_files": [],
+    "sites": ["parse_input_files"],
+    "make_gene_aliases_sqlite3": [],
+    "add_rsids": ["sites"],
+    "add_genes": ["add_rsids", "make_gene_aliases_sqlite3"],
+    "make_cpras_rsids_sqlite3": ["add_genes"],
+    "make_autocomplete_index": ["add_genes"],
+    "augment_phenos": ["parse_input_files", "add_genes"],
+    "matrix": ["augment_phenos"],
+    "gather_pvalues_for_each_gene": ["matrix", "make_gene_aliases_sqlite3"],
+    "summarize": ["augment_phenos"],
+    "top_hits": ["summarize"],
+    "phenotypes": ["summarize"],
+    "pheno_correlation": [],
+    "precompress": ["summarize", "top_hits", "phenotypes"],
+}
+
+# Maps the scripts that use `Parallelizer` to the `cmd` they pass to `conf.get_num_procs()`.
+parallel_cmds: Dict[str, Optional[str]] = {
+    "parse_input_files": None,
+    "sites": "sites",
+    "add_rsids": "add-rsids",
+    "augment_phenos": "augment-pheno",
+    "matrix": "matrix",
+    "gather_pvalues_for_each_gene": "gather-pvalues-for-each-gene",
+    "summarize": "summarize",
+    "precompress": "precompress",
+}
+
+
+def fmt_script(script: str) -> str:
+    return "`pheweb {}`".format(script.replace("_", "-"))
+
+
+def get_plan(myscripts: List[str]) -> Dict[str, List[str]]:
+    """Maps each of `myscripts` to the scripts in `myscripts` that it has to wait for, skipping over scripts that aren't run."""
+
+    def get_deps(script: str) -> List[str]:
+        deps = []
+        for dep in dependencies[script]:
+            for d in [dep] if dep in myscripts else get_deps(dep):
+                if d not in deps:
+                    deps.append(d)
+        return deps
+
+    plan = {}
+    for script in myscripts:
+        deps = get_deps(script)
+        if (
+            not deps
+            and script != "phenolist verify"
+            and "phenolist verify" in myscripts
+        ):
+            deps = ["phenolist verify"]
+        plan[script] = [dep for dep in myscripts if dep in deps]
+    return plan
+
+
+def get_num_procs_for_script(script: str) -> int:
+    if script in parallel_cmds:
+        return conf.get_num_procs(parallel_cmds[script])
+    return 1
+
+
+def print_plan(plan: Dict[str, List[str]]) -> None:
+    print(
+        "With up to {} processes at a time, `pheweb process` would run:".format(
+            conf.get_num_procs()
+        )
+    )
+    for script, deps in plan.items():
+        notes = []
+        if deps:
+            notes.append("after {}".format(", ".join(fmt_script(dep) for dep in deps)))
+        if script in parallel_cmds:
+            notes.append("using {} processes".format(get_num_procs_for_script(script)))
+        print(
+            "    {}{}".format(
+                fmt_script(script), "  ({})".format("; ".join(notes)) if notes else ""
+            )
+        )
+
+
+def _run_script_in_child(script: str, out_fd: int) -> None:
+    # Send all output through the pipe, including from subprocesses, and flush each line so that it's printed promptly.
+    os.dup2(out_fd, 1)
+    os.dup2(out_fd, 2)
+    os.close(out_fd)
+    sys.stdout = sys.stderr = open(1, "w", buffering=1, closefd=False)
+    script_parts = script.split()
+    module = importlib.import_module(".{}".format(script_parts[0]), __package__)
+    module_run = getattr(module, "run", None)  # appeases mypy
+    if not callable(module_run):
+        raise Exception(
+            "module.run ({!r}) isn't callable for module {!r} for script {!r}".format(
+                module_run, module, script
+            )
+        )
+    module_run(script_parts[1:])
+
+
+def _start_script_in_child(
+    script: str, out_fd: int, pool: Optional[WorkerPool], step_idx: int
+) -> None:
+    if pool is not None:
+        use_worker_pool(pool, step_idx)
+    _run_script_in_child(script, out_fd)
+
+
+def run_scripts(plan: Dict[str, List[str]]) -> None:
+    """Runs each script in `plan` once the scripts it depends on have succeeded, printing each line of output with the script's name in front"""
+    num_procs = conf.get_num_procs()
+    pool = (
+        WorkerPool(num_procs, len(plan))
+        if any(script in parallel_cmds for script in plan)
+        else None
+    )
+    try:
+        _run_scripts(plan, num_procs, pool)
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+
+
+def _run_scripts(
+    plan: Dict[str, List[str]], num_procs: int, pool: Optional[WorkerPool]
+) -> None:
+    pending = list(plan)
+    finished: List[str] = []
+    failed: List[str] = []
+    running: Dict[str, Dict] = {}  # maps script -> {"proc", "start_time"}
+    sel = selectors.DefaultSelector()
+    partial_lines: Dict[int, bytes] = {}
+    worker_died = False
+    if pool is not None:
+        # A worker only exits early if it crashed, and then its step would wait forever.
+        for p in pool.procs:
+            sel.register(p.sentinel, selectors.EVENT_READ, None)
+
+    def start(script: str) -> None:
+        print("==> Starting {}".format(fmt_script(script)))
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Fork, so that the child inherits `write_fd` and `conf.overrides`.
+        proc = multiprocessing.get_context("fork").Process(
+            target=_start_script_in_child,
+            args=(script, write_fd, pool, list(plan).index(script)),
+        )
+        proc.start()
+        os.close(write_fd)
+        running[script] = {"proc": proc, "start_time": time.time()}
+        partial_lines[read_fd] = b""
+        sel.register(read_fd, selectors.EVENT_READ, script)
+
+    def print_lines(script: str, data: bytes) -> None:
+        for line in data.decode("utf8", errors="replace").split("\n"):
+            print("[{}] {}".format(script.replace("_", "-"), line.rstrip("\r")))
+
+    while pending or running:
+        if not failed and not worker_died:
+            num_procs_used = sum(get_num_procs_for_script(s) for s in running)
+            for script in list(pending):
+                if not all(dep in finished for dep in plan[script]):
+                    continue
+                n = get_num_procs_for_script(script)
+                if running and num_procs_used + n > num_procs:
+                    continue
+                pending.remove(script)
+                start(script)
+                num_procs_used += n
+        if not running:
+            break
+        for key, _ in sel.select():
+            fd, script = key.fd, key.data
+            if script is None:
+                sel.unregister(fd)
+                if not worker_died:
+                    worker_died = True
+                    print("==> A worker process died, so stopping every step")
+                    for info in running.values():
+                        info["proc"].terminate()
+                continue
+            data = os.read(fd, 65536)
+            if data:
+                # Only print complete lines, unless the output has ended.
+                lines, newline, partial_lines[fd] = (
+                    partial_lines[fd] + data
+                ).rpartition(b"\n")
+                if newline:
+                    print_lines(script, lines)
+                continue
+            if partial_lines[fd]:
+                print_lines(script, partial_lines[fd])
+            sel.unregister(fd)
+            os.close(fd)
+            del partial_lines[fd]
+            proc = running[script]["proc"]
+            proc.join()
+            elapsed = fmt_seconds(time.time() - running[script]["start_time"])
+            del running[script]
+            if proc.exitcode == 0 and not worker_died:
+                finished.append(script)
+                print("==> Completed {} in {}".format(fmt_script(script), elapsed))
+            else:
+                failed.append(script)
+                print("==> {} failed after {}".format(fmt_script(script), elapsed))
+    sel.close()
+    if failed or worker_died:
+        raise PheWebError(
+            "{} failed, so {} didn't run".format(
+                " and ".join(fmt_script(script) for script in failed)
+                or "A worker process",
+                ", ".join(fmt_script(script) for script in pending) or "nothing else",
+            )
+        )
+
 
 def run(argv: List[str]) -> None:
     if any(arg in ["-h", "--help"] for arg in argv):
@@ -41,35 +279,24 @@ def run(argv: List[str]) -> None:
             )
         )
         print("")
+        print(
+            "but steps that don't depend on eachother run at the same time, using up to `num_procs` processes."
+        )
         print(
             "Passing `--no-parse` will skip `pheweb parse-input-files` (so it won't error if input filepaths are missing)"
         )
+        print(
+            "Passing `--dry-run` will print the order of the steps and what each waits for, without running them"
+        )
         exit(1)
 
-    if argv == ["--no-parse"]:
+    if "--no-parse" in argv:
         myscripts = [s for s in scripts if s != "parse_input_files"]
     else:
         myscripts = scripts
 
-    for script in myscripts:
-        print("==> Starting `pheweb {}`".format(script.replace("_", "-")))
-        start_time = time.time()
-        script_parts = script.split()
-        module = importlib.import_module(".{}".format(script_parts[0]), __package__)
-        module_run = getattr(module, "run", None)  # appeases mypy
-        if not callable(module_run):
-            raise Exception(
-                "module.run ({!r}) isn't callable for module {!r} for script {!r}".format(
-                    module_run, module, script
-                )
-            )
-        try:
-            module_run(script_parts[1:])
-        except Exception:
-            print("==> failed after {}".format(fmt_seconds(time.time() - start_time)))
-            raise
-        else:
-            print(
-                "==> Completed in {}".format(fmt_seconds(time.time() - start_time)),
-                end="\n\n",
-            )
+    plan = get_plan(myscripts)
+    if "--dry-run" in argv:
+        print_plan(plan)
+        return
+    run_scripts(plan)
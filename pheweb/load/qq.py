@@ -2,7 +2,6 @@
 This script creates json files which can be used to render QQ plots.
 """
 
-# TODO: share the `VariantFileReader` with `manhattan.py`.
 # TODO: make gc_lambda for maf strata, and show them if they're >1.1?
 # TODO: copy some changes from <https://github.com/statgen/encore/blob/master/plot-epacts-output/make_qq_json.py>
 
@@ -16,8 +15,9 @@ from ..utils import round_sig, approx_equal, get_phenolist, PheWebError
 from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
 from .load_utils import get_maf, parallelize_per_pheno, get_phenos_subset
 
-from typing import Dict, Any, List, Iterator, Set, Tuple
+from typing import Dict, Any, List, Iterator, Set, Tuple, Optional
 import argparse, itertools
+import array
 import boltons.mathutils
 import boltons.iterutils
 import math
@@ -68,7 +68,12 @@ def make_json_file_explicit(
 ) -> None:
     # Load the variants (either with or without MAF)
     variants = get_variants_df(in_filepath, pheno)
+    write_qq_json_file(variants, out_filepath, pheno)
 
+
+def write_qq_json_file(
+    variants: np.ndarray, out_filepath: str, pheno: Dict[str, Any]
+) -> None:
     # Check for sufficient number of variants. Adjust the threshold as needed.
     if len(variants) < 2:
         print(
@@ -93,37 +98,53 @@ def make_json_file_explicit(
 
 
 def get_variants_df(in_filepath: str, pheno: Dict[str, Any]) -> np.ndarray:
-    # I'm making a dataframe with either the columns [qval maf] or just [qval], depending on whether we can calculate maf from the fields we have.
-    # I use float32 because I have no use for more precision, and I want to 100M variants in <1GB.  (ie, <10bytes/variant)
-    # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
-    # And anyways pd.DataFrame() allows passing in an iterator, but then it just calls list() on it, so it temporarily uses python's list overhead.
-    # Instead, I'm using np.fromiter() to make a "structured array".
+    collector = QQCollector(pheno)
     with VariantFileReader(in_filepath) as variant_dicts:
-        try:
-            first_variant = next(iter(variant_dicts))
-        except StopIteration:
-            raise PheWebError("No variants found in {}".format(in_filepath))
-    has_maf = get_maf(first_variant, pheno) is not None
-    if has_maf:
-        return np.fromiter(
-            get_maf_qval_pairs(in_filepath, pheno),
-            dtype=[("maf", np.float32), ("qval", np.float32)],
-        )
-    else:
-        return np.fromiter(
-            (qval for maf, qval in get_maf_qval_pairs(in_filepath, pheno)),
-            dtype=[("qval", np.float32)],
-        )
+        for v in variant_dicts:
+            collector.process_variant(v)
+    if collector.num_variants == 0:
+        raise PheWebError("No variants found in {}".format(in_filepath))
+    return collector.get_variants_df()
 
 
-def get_maf_qval_pairs(
-    in_filepath: str, pheno: Dict[str, Any]
-) -> Iterator[Tuple[float, float]]:
-    with VariantFileReader(in_filepath) as variant_dicts:
-        for v in variant_dicts:
-            maf: float = get_maf(v, pheno) or 0
-            qval: float = 1000 if v["pval"] == 0 else -math.log10(v["pval"])
-            yield (maf, qval)
+class QQCollector:
+    """
+    Collects the qval (and maf, if we can calculate it from the first variant) of each variant, so that `pheweb summarize` can share one `VariantFileReader`.
+    """
+
+    # I'm making a dataframe with either the columns [qval maf] or just [qval], depending on whether we can calculate maf from the fields we have.
+    # I use float32 because I have no use for more precision, and I want to 100M variants in <1GB.  (ie, <10bytes/variant)
+    # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
+    # Instead, I'm appending to `array.array`s and then wrapping them in a "structured array".
+
+    def __init__(self, pheno: Dict[str, Any]):
+        self._pheno = pheno
+        self._has_maf: Optional[bool] = None
+        self._mafs = array.array("f")
+        self._qvals = array.array("f")
+
+    @property
+    def num_variants(self) -> int:
+        return len(self._qvals)
+
+    def process_variant(self, v: Dict[str, Any]) -> None:
+        maf = get_maf(v, self._pheno)
+        if self._has_maf is None:
+            self._has_maf = maf is not None
+        if self._has_maf:
+            self._mafs.append(maf or 0)
+        self._qvals.append(1000 if v["pval"] == 0 else -math.log10(v["pval"]))
+
+    def get_variants_df(self) -> np.ndarray:
+        if self._has_maf:
+            variants = np.empty(
+                len(self._qvals), dtype=[("maf", np.float32), ("qval", np.float32)]
+            )
+            variants["maf"] = np.frombuffer(self._mafs, dtype=np.float32)
+        else:
+            variants = np.empty(len(self._qvals), dtype=[("qval", np.float32)])
+        variants["qval"] = np.frombuffer(self._qvals, dtype=np.float32)
+        return variants
 
 
 def make_qq_stratified(variants: np.ndarray) -> List[Dict[str, Any]]:
@@ -5,8 +5,12 @@ from .. import conf
 from ..file_utils import read_maybe_gzip
 from .load_utils import get_maf
 
+import collections
 import itertools
+import math
+import operator
 import re
+import numpy as np
 import boltons.iterutils
 
 
@@ -23,9 +27,10 @@ class PhenoReader:
         self.fields, self.filepaths = self._get_fields_and_filepaths(pheno['assoc_files'])
 
     def get_variants(self):
+        assoc_file_reader_class = ChunkedAssocFileReader if conf.get_assoc_parse_engine() == 'chunked' else AssocFileReader
         yield from self._order_refalt_lexicographically(
             itertools.chain.from_iterable(
-                AssocFileReader(filepath, self._pheno).get_variants(minimum_maf=self._minimum_maf) for filepath in self.filepaths))
+                assoc_file_reader_class(filepath, self._pheno).get_variants(minimum_maf=self._minimum_maf) for filepath in self.filepaths))
 
     def get_info(self):
         infos = [AssocFileReader(filepath, self._pheno).get_info() for filepath in self.filepaths]
@@ -88,6 +93,9 @@ class PhenoReader:
                 "zless my-input-file.tsv | perl -nale 'print if $. == 1 or m{^(1?[0-9]|2[0-2]|X|Y|MT?)\t}' | gzip > my-replacement-input-file.tsv.gz\n")
 
 
+_AssocFileHeader = collections.namedtuple('_AssocFileHeader', ['delimiter', 'colnames', 'colidx_for_field', 'marker_id_col'])
+
+
 class AssocFileReader:
     '''Has no concern for ordering, only in charge of parsing one associations file.'''
     # TODO: use `pandas.read_csv(src_filepath, usecols=[...], converters={...}, iterator=True, verbose=True, na_values='.', sep=None)
@@ -99,62 +107,66 @@ class AssocFileReader:
 
 
     def get_variants(self, minimum_maf=0, use_per_pheno_fields=False):
+        with read_maybe_gzip(self.filepath) as f:
+            header = self._read_header(f, use_per_pheno_fields)
+            if use_per_pheno_fields:
+                for line in f:
+                    values = line.rstrip('\n\r').split(header.delimiter)
+                    variant = self._parse_variant(values, header.colnames, header.colidx_for_field)
+                    yield variant
+            else:
+                yield from self._get_variants_from_lines(f, header, minimum_maf)
+
+    def _read_header(self, f, use_per_pheno_fields):
         if use_per_pheno_fields:
             fieldnames_to_check = [fieldname for fieldname,fieldval in parse_utils.per_pheno_fields.items() if fieldval['from_assoc_files']]
         else:
             fieldnames_to_check = [fieldname for fieldname,fieldval in itertools.chain(parse_utils.per_variant_fields.items(), parse_utils.per_assoc_fields.items()) if fieldval['from_assoc_files']]
 
-        with read_maybe_gzip(self.filepath) as f:
-
-            try:
-                header_line = next(f)
-            except Exception as exc:
-                raise PheWebError("Failed to read from file {} - is it empty?".format(self.filepath)) from exc
-
-            if header_line.count('\t') >= 4: delimiter = '\t'
-            elif header_line.count(' ') >= 4: delimiter = ' '
-            elif header_line.count(',') >= 4: delimiter = ','
-            else: raise PheWebError("Cannot guess what delimiter to use to parse the header line {!r} in file {!r}".format(header_line, self.filepath))
-
-            colnames = [colname.strip('"\' ').lower() for colname in header_line.rstrip('\n\r').split(delimiter)]
-            colidx_for_field = self._parse_header(colnames, fieldnames_to_check)
-            # Special case for `MARKER_ID`
-            if 'marker_id' not in colnames:
-                marker_id_col = None
-            else:
-                marker_id_col = colnames.index('marker_id')
-                colidx_for_field['ref'] = None # This is just to mark that we have 'ref', but it doesn't come from a column.
-                colidx_for_field['alt'] = None
-                # TODO: this sort of provides a mapping for chrom and pos, but those are usually doubled anyways.
-                # TODO: maybe we should allow multiple columns to map to each key, and then just assert that they all agree.
-            self._assert_all_fields_mapped(colnames, fieldnames_to_check, colidx_for_field)
-
-            if use_per_pheno_fields:
-                for line in f:
-                    values = line.rstrip('\n\r').split(delimiter)
-                    variant = self._parse_variant(values, colnames, colidx_for_field)
-                    yield variant
+        try:
+            header_line = next(f)
+        except Exception as exc:
+            raise PheWebError("Failed to read from file {} - is it empty?".format(self.filepath)) from exc
+
+        if header_line.count('\t') >= 4: delimiter = '\t'
+        elif header_line.count(' ') >= 4: delimiter = ' '
+        elif header_line.count(',') >= 4: delimiter = ','
+        else: raise PheWebError("Cannot guess what delimiter to use to parse the header line {!r} in file {!r}".format(header_line, self.filepath))
+
+        colnames = [colname.strip('"\' ').lower() for colname in header_line.rstrip('\n\r').split(delimiter)]
+        colidx_for_field = self._parse_header(colnames, fieldnames_to_check)
+        # Special case for `MARKER_ID`
+        if 'marker_id' not in colnames:
+            marker_id_col = None
+        else:
+            marker_id_col = colnames.index('marker_id')
+            colidx_for_field['ref'] = None # This is just to mark that we have 'ref', but it doesn't come from a column.
+            colidx_for_field['alt'] = None
+            # TODO: this sort of provides a mapping for chrom and pos, but those are usually doubled anyways.
+            # TODO: maybe we should allow multiple columns to map to each key, and then just assert that they all agree.
+        self._assert_all_fields_mapped(colnames, fieldnames_to_check, colidx_for_field)
+        return _AssocFileHeader(delimiter, colnames, colidx_for_field, marker_id_col)
 
-            else:
-                for line in f:
-                    values = line.rstrip('\n\r').split(delimiter)
-                    variant = self._parse_variant(values, colnames, colidx_for_field)
+    def _get_variants_from_lines(self, lines, header, minimum_maf):
+        for line in lines:
+            values = line.rstrip('\n\r').split(header.delimiter)
+            variant = self._parse_variant(values, header.colnames, header.colidx_for_field)
 
-                    if variant['pval'] == '': continue
+            if variant['pval'] == '': continue
 
-                    maf = get_maf(variant, self._pheno) # checks for agreement
-                    if maf is not None and maf < minimum_maf:
-                        continue
+            maf = get_maf(variant, self._pheno) # checks for agreement
+            if maf is not None and maf < minimum_maf:
+                continue
 
-                    if marker_id_col is not None:
-                        chrom2, pos2, variant['ref'], variant['alt'] = AssocFileReader.parse_marker_id(values[marker_id_col])
-                        assert variant['chrom'] == chrom2, (values, variant, chrom2)
-                        assert variant['pos'] == pos2, (values, variant, pos2)
+            if header.marker_id_col is not None:
+                chrom2, pos2, variant['ref'], variant['alt'] = AssocFileReader.parse_marker_id(values[header.marker_id_col])
+                assert variant['chrom'] == chrom2, (values, variant, chrom2)
+                assert variant['pos'] == pos2, (values, variant, pos2)
 
-                    if variant['chrom'] in chrom_aliases:
-                        variant['chrom'] = chrom_aliases[variant['chrom']]
+            if variant['chrom'] in chrom_aliases:
+                variant['chrom'] = chrom_aliases[variant['chrom']]
 
-                    yield variant
+            yield variant
 
     def get_info(self):
         infos = []
@@ -248,3 +260,154 @@ class AssocFileReader:
         chrom, pos, ref, alt = match.groups()
         return chrom, int(pos), ref, alt
     parse_marker_id_regex = re.compile(r'([^:]+):([0-9]+)_([-ATCG\.]+)/([-ATCG\.\*]+)')
+
+
+class ChunkedAssocFileReader(AssocFileReader):
+    '''
+    Gives the same variants as AssocFileReader, but parses `chunk_num_lines` lines at a time, one column at a time,
+    using numpy and `map()` over builtins instead of calling `Field.parse` for each value.
+    If anything in a chunk looks wrong, the chunk is re-parsed by AssocFileReader, so that errors (and the variants yielded before them) are the same.
+    '''
+    chunk_num_lines = 50_000
+
+    def _get_variants_from_lines(self, lines, header, minimum_maf):
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, self.chunk_num_lines))
+            if not chunk: return
+            try:
+                variants = self._parse_chunk(chunk, header, minimum_maf)
+            except Exception:
+                variants = AssocFileReader._get_variants_from_lines(self, chunk, header, minimum_maf)
+            yield from variants
+
+    def _parse_chunk(self, lines, header, minimum_maf):
+        rows = list(map(str.split, map(str.rstrip, lines, itertools.repeat('\n\r')), itertools.repeat(header.delimiter)))
+        if set(map(len, rows)) != {len(header.colnames)}:
+            raise _ChunkNeedsFallback()
+        columns = list(zip(*rows))
+
+        cols = {} # maps field -> list of parsed values, in the order that `_parse_variant` would add them
+        for field, colidx in header.colidx_for_field.items():
+            if colidx is not None:
+                cols[field] = _parse_column(field, columns[colidx])
+        marker_ids = columns[header.marker_id_col] if header.marker_id_col is not None else None
+
+        idxs = np.flatnonzero(np.fromiter(map(operator.ne, cols['pval'], itertools.repeat('')), dtype=bool, count=len(rows)))
+        if len(idxs) < len(rows):
+            cols, marker_ids = _take(cols, idxs), _take_one(marker_ids, idxs)
+
+        mafs = self._get_mafs(cols)
+        if mafs is not None:
+            idxs = np.flatnonzero(~(mafs < minimum_maf))
+            if len(idxs) < len(mafs):
+                cols, marker_ids = _take(cols, idxs), _take_one(marker_ids, idxs)
+
+        if marker_ids is not None:
+            chroms2, poss2, cols['ref'], cols['alt'] = (list(x) for x in zip(*map(AssocFileReader.parse_marker_id, marker_ids))) if marker_ids else ([], [], [], [])
+            if chroms2 != cols['chrom'] or poss2 != cols['pos']:
+                raise _ChunkNeedsFallback()
+
+        if not chrom_aliases.keys().isdisjoint(cols['chrom']):
+            cols['chrom'] = list(map(chrom_aliases.get, cols['chrom'], cols['chrom']))
+
+        return list(map(dict, map(zip, itertools.repeat(list(cols)), zip(*cols.values()))))
+
+    def _get_mafs(self, cols):
+        # Like `get_maf()` for every variant.
+        mafs = []
+        if 'maf' in cols:
+            mafs.append(np.array(cols['maf'], dtype=float))
+        if 'af' in cols:
+            af = np.array(cols['af'], dtype=float)
+            mafs.append(np.minimum(af, 1 - af))
+        if 'ac' in cols and 'num_samples' in self._pheno:
+            x = np.array(cols['ac'], dtype=float) / 2 / self._pheno['num_samples']
+            mafs.append(np.minimum(x, 1 - x))
+        if len(mafs) == 0:
+            return None
+        elif len(mafs) == 1:
+            return mafs[0]
+        else:
+            mafs_array = np.vstack(mafs)
+            if (mafs_array > 0.5).any() or (mafs_array.max(axis=0) - mafs_array.min(axis=0) > 0.05).any():
+                raise _ChunkNeedsFallback()
+            total = mafs[0]
+            for maf in mafs[1:]: total = total + maf
+            return np.array(_round_sig_all((total / len(mafs)).tolist(), parse_utils.fields['maf']['sigfigs']), dtype=float)
+
+
+class _ChunkNeedsFallback(Exception): pass
+
+_null_value_replacements = {null_value: '' for null_value in parse_utils.null_values}
+
+def _parse_column(field, values):
+    '''Like `[parse_utils.parser_for_field[field](value) for value in values]`, but raises _ChunkNeedsFallback instead of specific errors.'''
+    d = parse_utils.fields[field]
+    if d['type'] is str:
+        return list(map(_null_value_replacements.get, values, values)) if d['nullable'] else list(values)
+    if d['type'] not in (float, parse_utils.scientific_int):
+        return list(map(parse_utils.parser_for_field[field], values))
+    if d['nullable']:
+        is_null = np.fromiter(map(_null_value_replacements.__contains__, values), dtype=bool, count=len(values))
+        if is_null.any():
+            nonnull_idxs = np.flatnonzero(~is_null)
+            ret = np.full(len(values), '', dtype=object)
+            ret[nonnull_idxs] = _object_array(_parse_numbers(d, _take_one(values, nonnull_idxs)))
+            return ret.tolist()
+    return _parse_numbers(d, values)
+
+def _parse_numbers(d, values):
+    if d['type'] is float:
+        xs = list(map(float, values))
+    else:
+        try: xs = list(map(int, values))
+        except ValueError: xs = list(map(parse_utils.scientific_int, values))
+    if d.get('could_be_neglog10', False) and conf.pval_is_neglog10():
+        xs = list(map(pow, itertools.repeat(10), map(operator.neg, xs)))
+    if not xs:
+        return xs
+    if 'range' in d:
+        arr = np.array(xs, dtype=float)
+        if d['range'][0] is not None and not (arr >= d['range'][0]).all(): raise _ChunkNeedsFallback()
+        if d['range'][1] is not None and not (arr <= d['range'][1]).all(): raise _ChunkNeedsFallback()
+    if 'sigfigs' in d:
+        xs = _round_sig_all(xs, d['sigfigs'])
+    if 'proportion_sigfigs' in d:
+        arr = np.array(xs, dtype=float)
+        if not ((0 <= arr) & (arr <= 1)).all(): raise _ChunkNeedsFallback()
+        is_low = arr < 0.5
+        ret = np.empty(len(xs), dtype=object)
+        ret[is_low] = _object_array(_round_sig_all(arr[is_low].tolist(), d['proportion_sigfigs']))
+        ret[~is_low] = _object_array(list(map(operator.sub, itertools.repeat(1), _round_sig_all((1 - arr[~is_low]).tolist(), d['proportion_sigfigs']))))
+        xs = ret.tolist()
+    if 'decimals' in d:
+        xs = list(map(round, xs, itertools.repeat(d['decimals'])))
+    return xs
+
+def _round_sig_all(xs, digits):
+    '''Like `[round_sig(x, digits) for x in xs]`'''
+    arr = np.array(xs, dtype=float)
+    if not np.isfinite(arr).all(): raise _ChunkNeedsFallback()
+    is_zero = arr == 0
+    if is_zero.any():
+        ret = np.zeros(len(xs), dtype=object) # round_sig(0) is the int 0
+        nonzero_idxs = np.flatnonzero(~is_zero)
+        ret[nonzero_idxs] = _object_array(_round_sig_all(_take_one(xs, nonzero_idxs), digits))
+        return ret.tolist()
+    # Use `math.log10` and `round` instead of numpy so that we get exactly what `round_sig` gives.
+    logs = np.fromiter(map(math.log10, map(abs, xs)), dtype=float, count=len(xs))
+    ndigits = (digits - 1 - np.floor(logs).astype(np.int64)).tolist()
+    return list(map(round, xs, ndigits))
+
+def _object_array(values):
+    ret = np.empty(len(values), dtype=object)
+    ret[:] = values
+    return ret
+
+def _take_one(values, idxs):
+    if values is None: return None
+    return list(map(values.__getitem__, idxs.tolist()))
+
+def _take(cols, idxs):
+    return {field: _take_one(values, idxs) for field, values in cols.items()}
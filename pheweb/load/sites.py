@@ -9,15 +9,24 @@ from ..file_utils import (
     get_dated_tmp_path,
     get_tmp_path,
 )
-from .load_utils import get_maf, mtime, indent, ProgressBar
+from .load_utils import (
+    get_maf,
+    indent,
+    ProgressBar,
+    Parallelizer,
+    set_ulimit_num_files,
+)
+from .build_manifest import BuildTarget, get_file_hash, record_added_lines
 
 import contextlib
 import os
+import math
 import random
 import multiprocessing
 import bisect
+import heapq
 import traceback
-
+from typing import List, Dict, Any, Iterator, Optional
 
 MAX_NUM_FILES_TO_MERGE_AT_ONCE = (
     8  # I have no idea what's fastest.  Maybe #files / #cpus?
@@ -40,19 +49,177 @@ def run(argv):
             + "3. Write to {}\n\n".format(out_filepath)
             + "Usage:\n"
             "  -h   print this message\n"
-            + "  -f   run even if {} is up-to-date\n".format(
+            + "  -f   run even if {} is up-to-date, and merge every phenotype even if some were only added\n".format(
                 os.path.basename(out_filepath)
             )
         )
         exit(1)
 
-    manna = MergeManager()
+    input_filepaths = [
+        get_pheno_filepath("parsed", pheno["phenocode"]) for pheno in get_phenolist()
+    ]
+
+    # The input filepaths are part of the fingerprint, so removing a phenotype makes this out-of-date.
+    target = BuildTarget([out_filepath], input_filepaths)
+    if not force and target.is_up_to_date():
+        print("The list of sites is up-to-date!")
+        return
+
+    # If phenotypes were only added, merge their variants into the existing sites.
+    added_input_filepaths = None if force else target.get_added_input_filepaths()
+    if added_input_filepaths:
+        print(
+            "Adding the variants from {} new phenotypes to the existing sites".format(
+                len(added_input_filepaths)
+            )
+        )
+        old_hash = get_file_hash(out_filepath)
+        run_heap_merge(out_filepath, [out_filepath] + added_input_filepaths)
+    elif conf.get_sites_merge_engine() == "bisect":
+        run_bisect_merge(out_filepath)
+    else:
+        run_heap_merge(out_filepath)
+    target.record()
+    if added_input_filepaths:
+        record_added_lines(out_filepath, old_hash)
+
+
+def run_heap_merge(
+    out_filepath: str, input_filepaths: Optional[List[str]] = None
+) -> Dict[str, int]:
+    """
+    Merge all of the parsed files (or `input_filepaths`) with `heap_merge()`, up to `conf.get_sites_merge_fan_in()` at a time.
+    If there are too many files, merge groups of them in parallel into temporary files, and then merge those.
+    Returns the number of rounds and merges, for benchmarking.
+    """
+    fan_in = conf.get_sites_merge_fan_in()
+    fds_per_process = 32  # for python, stdin/out/err, multiprocessing, etc
+    fan_in = min(
+        fan_in, set_ulimit_num_files(fan_in + fds_per_process) - fds_per_process
+    )
+    if fan_in < 2:
+        raise PheWebError(
+            "The limit on open files is too low for `pheweb sites`.  Try `ulimit -n 1024`."
+        )
+
+    if input_filepaths is None:
+        input_filepaths = [
+            get_pheno_filepath("parsed", pheno["phenocode"])
+            for pheno in get_phenolist()
+        ]
+    files = [{"type": "input", "filepath": filepath} for filepath in input_filepaths]
+    num_rounds, num_merges = 0, 0
+    while len(files) > fan_in:
+        num_groups = math.ceil(len(files) / fan_in)
+        tasks = [
+            {
+                "files_to_merge": files[i::num_groups],
+                "out_filepath": get_tmp_path(
+                    "merging-{}".format(random.randrange(int(1e10)))
+                ),
+            }
+            for i in range(num_groups)
+        ]
+        print(
+            "Merging {} files into {} files, {} at a time".format(
+                len(files), num_groups, math.ceil(len(files) / num_groups)
+            )
+        )
+        for ret in Parallelizer().run_single_tasks(tasks, _do_merge_task, cmd="sites"):
+            print(ret["value"]["warning_str"])
+        files = [{"type": "merged", "filepath": task["out_filepath"]} for task in tasks]
+        num_rounds += 1
+        num_merges += num_groups
+
+    print("Merging {} files into {}".format(len(files), out_filepath))
+    for warning in heap_merge(files, out_filepath):
+        print(warning["warning_str"])
+    return {"num_rounds": num_rounds + 1, "num_merges": num_merges + 1}
+
+
+def _do_merge_task(task: Dict[str, Any]) -> Iterator[Dict[str, str]]:
+    # Temporary files are only read once, so don't spend time compressing them.
+    return heap_merge(task["files_to_merge"], task["out_filepath"], use_gzip=False)
 
-    # TODO: If a phenotype is removed, this still reports that the list of sites is up-to-date.  How to check that?
-    if os.path.exists(out_filepath) and not force:
-        if mtime(out_filepath) >= max(mtime(f["filepath"]) for f in manna.files):
-            print("The list of sites is up-to-date!")
-            return
+
+def heap_merge(
+    files_to_merge: List[Dict[str, Any]], out_filepath: str, use_gzip: bool = True
+) -> Iterator[Dict[str, str]]:
+    """
+    Writes the union of the variants in `files_to_merge` to `out_filepath`, using one heap entry per file.
+    Yields a warning for each file that's empty.
+    Removes files with type "merged" when done.
+    """
+    with contextlib.ExitStack() as exit_stack, VariantFileWriter(
+        out_filepath, use_gzip=use_gzip
+    ) as writer:
+        readers = []
+        # `heap` is like [(key, reader_id, variant), ...].  reader_ids are unique, so variants are never compared.
+        heap = []
+        for file_to_merge in files_to_merge:
+            reader = iter(
+                exit_stack.enter_context(
+                    VariantFileReader(
+                        file_to_merge["filepath"], only_per_variant_fields=True
+                    )
+                )
+            )
+            try:
+                v = next(reader)
+            except StopIteration:
+                yield {
+                    "type": "warning",
+                    "warning_str": "Warning: {!r} didnt even have ONE variant that passed the MAF thresholds.".format(
+                        file_to_merge["filepath"]
+                    ),
+                }
+                continue
+            heap.append((_key_from_variant(v), len(readers), v))
+            readers.append(reader)
+        heapq.heapify(heap)
+
+        while heap:
+            key, _, v = heap[0]
+            # Require that variants match exactly, because if "chrM:1234:A:T" equals "chrMT:1234:A:T" then the merged file won't match the original files.
+            variant = {
+                "chrom": v["chrom"],
+                "pos": v["pos"],
+                "ref": v["ref"],
+                "alt": v["alt"],
+            }
+            while heap and heap[0][0] == key:
+                _, reader_id, v = heap[0]
+                if v["chrom"] != variant["chrom"]:
+                    raise PheWebError(
+                        "trying to merge {!r} with {!r} which has the same chrom-pos-ref-alt".format(
+                            v, variant
+                        )
+                    )
+                try:
+                    new_v = next(readers[reader_id])
+                except StopIteration:
+                    heapq.heappop(heap)
+                else:
+                    heapq.heapreplace(
+                        heap, (_key_from_variant(new_v), reader_id, new_v)
+                    )
+            writer.write(variant)
+
+    for file_to_merge in files_to_merge:
+        if file_to_merge["type"] == "merged":
+            os.remove(file_to_merge["filepath"])
+
+
+def _key_from_variant(v: Dict[str, Any]) -> tuple:
+    return (chrom_order[v["chrom"]], v["pos"], v["ref"], v["alt"])
+
+
+def run_bisect_merge(out_filepath: str) -> Dict[str, int]:
+    """
+    Merge all of the parsed files `MAX_NUM_FILES_TO_MERGE_AT_ONCE` at a time, with `merge()`.
+    Returns the number of rounds and merges, for benchmarking.
+    """
+    manna = MergeManager()
 
     taskq = multiprocessing.Queue()
     retq = multiprocessing.Queue()
@@ -94,6 +261,7 @@ def run(argv):
         assert p.exitcode == 0
     make_basedir(out_filepath)
     os.rename(manna.files[0]["filepath"], out_filepath)
+    return {"num_rounds": manna.files[0]["round"], "num_merges": manna.num_merges}
 
 
 class MergeManager:
@@ -109,8 +277,10 @@ class MergeManager:
                     "type": "input",
                     "filepath": filepath,
                     "pheno": pheno,
+                    "round": 0,
                 }
             )
+        self.num_merges = 0
 
     def apply_ret(self, ret):
         if ret["type"] == "task-completion":
@@ -118,8 +288,10 @@ class MergeManager:
                 {
                     "type": "merged",
                     "filepath": ret["task"]["out_filepath"],
+                    "round": ret["task"]["round"],
                 }
             )
+            self.num_merges += 1
         elif ret["type"] == "exception":
             exc_filepath = get_dated_tmp_path("exception")
             with open(exc_filepath, "wt") as f:
@@ -164,6 +336,7 @@ class MergeManager:
                 {
                     "files_to_merge": files_to_merge,
                     "out_filepath": out_filepath,
+                    "round": 1 + max(f["round"] for f in files_to_merge),
                 }
             )
 
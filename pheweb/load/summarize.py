@@ -0,0 +1,136 @@
+"""
+This script makes manhattan/*, qq/* and best_of_pheno/* for each phenotype while reading its pheno_gz file only once.
+
+It's equivalent to running `pheweb manhattan && pheweb qq && pheweb best-of-pheno`,
+and each step's outputs are only remade if the build manifest says that they're out-of-date.
+"""
+
+from .. import conf
+from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
+from .load_utils import (
+    MaxPriorityQueue,
+    PerPhenoParallelizer,
+    get_phenos_subset,
+    get_phenolist,
+)
+from . import manhattan, qq, best_of_pheno
+from ..utils import PheWebError
+
+import argparse
+from typing import List, Dict, Any
+
+steps = [manhattan, qq, best_of_pheno]
+
+
+def run(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(
+        description="Make the Manhattan plot, QQ plot and best-of-pheno file for each phenotype in one pass."
+    )
+    parser.add_argument(
+        "--phenos",
+        help="Can be like '4,5,6,12' or '4-6,12' to run on only the phenos at those positions (0-indexed) in pheno-list.json (and only if they need to run)",
+    )
+    args = parser.parse_args(argv)
+
+    phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
+
+    _SummarizeParallelizer().run_on_each_pheno(
+        get_input_filepaths=get_input_filepaths,
+        get_output_filepaths=get_output_filepaths,
+        convert=summarize,
+        cmd="summarize",
+        phenos=phenos,
+    )
+
+
+class _SummarizeParallelizer(PerPhenoParallelizer):
+    # Each step's outputs are checked and recorded in the build manifest separately, so that they agree with `pheweb manhattan` &c.
+    def should_process_pheno(self, pheno, *args, **kwargs):
+        return bool(get_stale_steps(pheno))
+
+    @classmethod
+    def _convert_and_record(cls, convert, *args):
+        pheno = args[-1]
+        return convert(pheno)
+
+
+def get_build_target(step, pheno: dict):
+    return PerPhenoParallelizer._get_build_target(
+        pheno,
+        step.get_input_filepaths,
+        step.get_output_filepaths,
+        getattr(step, "get_config", None),
+    )
+
+
+def get_stale_steps(pheno: dict) -> list:
+    return [step for step in steps if not get_build_target(step, pheno).is_up_to_date()]
+
+
+def get_input_filepaths(pheno: dict) -> List[str]:
+    return sorted(
+        set(fp for step in steps for fp in step.get_input_filepaths(pheno))  # type: ignore
+    )
+
+
+def get_output_filepaths(pheno: dict) -> List[str]:
+    return [fp for step in steps for fp in step.get_output_filepaths(pheno)]  # type: ignore
+
+
+def summarize(pheno: Dict[str, Any]) -> None:
+    # Check each output separately, so that eg a missing best_of_pheno/* doesn't cause manhattan/* to be remade.
+    # Hash the inputs before making the outputs, in case they change while we work.
+    targets = {step: get_build_target(step, pheno) for step in steps}
+    stale_steps = [step for step in steps if not targets[step].is_up_to_date()]
+
+    if manhattan in stale_steps and conf.get_manhattan_binner() == "numpy":
+        # `ArrayBinner` reads pheno_columns/*, which is cheap, so it doesn't need to share our pass over pheno_gz/*.
+        manhattan.make_manhattan_json_file(pheno)
+        targets[manhattan].record()
+        stale_steps.remove(manhattan)
+    if not stale_steps:
+        return
+
+    binner = manhattan.Binner() if manhattan in stale_steps else None
+    qq_collector = qq.QQCollector(pheno) if qq in stale_steps else None
+    bestof_q = MaxPriorityQueue() if best_of_pheno in stale_steps else None
+
+    in_filepath = get_pheno_filepath("pheno_gz", pheno["phenocode"])
+    with VariantFileReader(in_filepath) as reader:
+        fields = reader.fields
+        for v in reader:
+            if binner is not None:
+                binner.process_variant(v)
+            if qq_collector is not None:
+                qq_collector.process_variant(v)
+            if bestof_q is not None:
+                bestof_q.add_and_keep_size(v, v["pval"], best_of_pheno.NUM_VARIANTS)
+
+    if binner is not None:
+        write_json(
+            filepath=get_pheno_filepath(
+                "manhattan", pheno["phenocode"], must_exist=False
+            ),
+            data=binner.get_result(),
+        )
+    if qq_collector is not None:
+        if qq_collector.num_variants == 0:
+            raise PheWebError("No variants found in {}".format(in_filepath))
+        qq.write_qq_json_file(
+            qq_collector.get_variants_df(),
+            get_pheno_filepath("qq", pheno["phenocode"], must_exist=False),
+            pheno,
+        )
+    if bestof_q is not None:
+        # `binner` adds "peak" and "num_significant_in_peak" to the variants it keeps, and those variants might be shared with `bestof_q`.
+        best_of_pheno.write_bestof_file(
+            bestof_q,
+            get_pheno_filepath("best_of_pheno", pheno["phenocode"], must_exist=False),
+            fields=fields,
+            facets_filepath=get_pheno_filepath(
+                "best_of_pheno_facets", pheno["phenocode"], must_exist=False
+            ),
+            pheno=pheno,
+        )
+    for step in stale_steps:
+        targets[step].record()
@@ -6,9 +6,9 @@ from ..file_utils import (
     get_filepath,
     get_pheno_filepath,
 )
+from .build_manifest import BuildTarget
 
 import json
-from pathlib import Path
 from typing import Dict, Any, List, Iterator
 
 # TODO: It'd be great if each peak also included a list of all the associations that it is masking, so that on-click we could display a variants-under-this-peak table.
@@ -41,22 +41,21 @@ def stringify_assocs(assocs: List[Dict[str, Any]]) -> None:
             a["nearest_genes"] = ",".join(a["nearest_genes"])
 
 
-def should_run() -> bool:
+def get_build_target() -> BuildTarget:
     output_filepaths = [
-        Path(get_filepath(name, must_exist=False))
+        get_filepath(name, must_exist=False)
         for name in ["top-hits", "top-hits-1k", "top-hits-tsv"]
     ]
-    if not all(fp.exists() for fp in output_filepaths):
-        return True
-    oldest_output_mtime = min(fp.stat().st_mtime for fp in output_filepaths)
+    # pheno-list.json is an input because `phenostring` and `category` are copied from it.
     input_filepaths = [
-        Path(get_pheno_filepath("manhattan", pheno["phenocode"]))
-        for pheno in get_phenolist()
-    ]
-    newest_input_mtime = max(fp.stat().st_mtime for fp in input_filepaths)
-    if newest_input_mtime > oldest_output_mtime:
-        return True
-    return False
+        get_pheno_filepath("manhattan", pheno["phenocode"]) for pheno in get_phenolist()
+    ] + [get_filepath("phenolist")]
+    config = {"top_hits_pval_cutoff": conf.get_top_hits_pval_cutoff()}
+    return BuildTarget(output_filepaths, input_filepaths, config=config)
+
+
+def should_run() -> bool:
+    return not get_build_target().is_up_to_date()
 
 
 def run(argv: List[str]) -> None:
@@ -91,7 +90,8 @@ just the top phenotype for each, use `pheweb top-loci`.
         )
         exit(1)
 
-    if not should_run():
+    target = get_build_target()
+    if target.is_up_to_date():
         print("Already up-to-date!")
         return
 
@@ -107,3 +107,4 @@ just the top phenotype for each, use `pheweb top-loci`.
         stringify_assocs(hits)
         write_heterogenous_variantfile(out_filepath_tsv, hits, use_gzip=False)
         print("wrote {} hits to {}".format(len(hits), out_filepath_tsv))
+    target.record()
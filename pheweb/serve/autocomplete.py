@@ -1,14 +1,19 @@
-from ..file_utils import get_filepath
+from ..file_utils import get_filepath, ColumnarVariantFileReader
+from ..utils import chrom_order, chrom_order_list
 from .server_utils import parse_variant
 
 from flask import url_for
 
 import urllib.parse
 import itertools
+import bisect
+import heapq
+import os
 import re
 import copy
 import sqlite3
-from typing import List, Dict, Any, Optional, Iterator
+import numpy as np
+from typing import List, Dict, Any, Optional, Iterator, Tuple
 
 # TODO: sort suggestions better.
 # - It's good that hitting enter sends you to the thing with the highest token-ratio.
@@ -29,6 +34,182 @@ def get_sqlite3_readonly_connection(filepath: str):
     )
 
 
+def get_pos_prefix_ranges(pos: int) -> Iterator[Tuple[int, int]]:
+    """
+    Yields the ranges `[lo, hi)` of positions that start with the digits of `pos`, in order.
+    ie, `[pos * 10**k, (pos + 1) * 10**k)` for each `k` that fits in a uint32.
+    """
+    for k in range(1 if pos == 0 else 10):
+        if pos * 10**k >= 2**32:
+            break
+        yield (pos * 10**k, (pos + 1) * 10**k)
+
+
+def get_chroms_with_prefix(chrom: str) -> List[str]:
+    # Like `cpra LIKE '1%'`, which matches chromosomes 1 and 10-19.
+    return [c for c in chrom_order_list if c.startswith(chrom)]
+
+
+def get_cpra_rsid_pairs_from_sqlite3(
+    db: sqlite3.Connection,
+    chrom: str,
+    pos: Optional[int],
+    key: str,
+    limit: int = 100,
+) -> List[Tuple[str, Optional[str]]]:
+    """Like `SELECT cpra,rsid FROM cpras_rsids WHERE cpra LIKE '<key>%' ORDER BY ROWID LIMIT 100`, but each query is a range of the index on (chrom_idx, pos)"""
+    if pos is None:
+        ranges = [(chrom_order[c], 0, 2**32) for c in get_chroms_with_prefix(chrom)]
+    elif chrom in chrom_order:
+        ranges = [(chrom_order[chrom], lo, hi) for lo, hi in get_pos_prefix_ranges(pos)]
+    else:
+        ranges = []
+    ret: List[Tuple[str, Optional[str]]] = []
+    for chrom_idx, lo, hi in ranges:
+        ret.extend(
+            (row[0], row[1])
+            for row in db.execute(
+                "SELECT cpra,rsid FROM cpras_rsids WHERE chrom_idx=? AND pos>=? AND pos<? AND cpra LIKE ? ORDER BY pos,ROWID LIMIT ?",
+                (chrom_idx, lo, hi, key + "%", limit - len(ret)),
+            )
+        )
+        if len(ret) == limit:
+            break
+    return ret
+
+
+class VariantIndex:
+    """
+    Looks up variants and rsids in `sites/autocomplete/` (see `load/make_autocomplete_index.py`) with a few binary searches each.
+    Results are in the same order as the queries on `cpras-rsids-sqlite3` that this replaces.
+    """
+
+    def __init__(self, dirpath: str):
+        # Columns are memory-mapped, and nothing is closed when the `with` exits, so we keep the reader.
+        with ColumnarVariantFileReader(os.path.join(dirpath, "variants")) as reader:
+            self._variants = reader
+        self._chrom_idxs = self._variants.get_column("chrom_idx")
+        self._positions = self._variants.get_column("pos")
+        self._refs = self._variants.get_column("ref")
+        self._alts = self._variants.get_column("alt")
+        self._rsids = self._variants.get_column("rsids")
+        self._rsid_nums = np.load(os.path.join(dirpath, "rsid_nums.npy"), mmap_mode="r")
+        self._rsid_variant_idxs = np.load(
+            os.path.join(dirpath, "rsid_variant_idxs.npy"), mmap_mode="r"
+        )
+        chrom_starts = np.searchsorted(
+            self._chrom_idxs, np.arange(len(chrom_order_list) + 1)
+        ).tolist()
+        self._chrom_ranges = {
+            chrom: (chrom_starts[i], chrom_starts[i + 1])
+            for i, chrom in enumerate(chrom_order_list)
+        }
+
+    def _get_cpra(self, idx: int) -> str:
+        return "{}-{}-{}-{}".format(
+            chrom_order_list[self._chrom_idxs[idx]],
+            self._positions[idx],
+            self._refs[idx],
+            self._alts[idx],
+        )
+
+    def _get_variant_idx_ranges(
+        self, chrom: str, pos: Optional[int]
+    ) -> Iterator[Tuple[int, int]]:
+        if pos is None:
+            for c in get_chroms_with_prefix(chrom):
+                yield self._chrom_ranges[c]
+            return
+        if chrom not in self._chrom_ranges:
+            return
+        start, end = self._chrom_ranges[chrom]
+        positions = self._positions[start:end]
+        for pos_range in get_pos_prefix_ranges(pos):
+            lo, hi = np.searchsorted(
+                positions, np.array(pos_range, dtype=np.int64)
+            ).tolist()
+            yield (start + lo, start + hi)
+            if hi == len(positions):
+                break
+
+    def get_cpra_rsid_pairs(
+        self,
+        chrom: str,
+        pos: Optional[int],
+        ref: Optional[str],
+        alt: Optional[str],
+        limit: int = 100,
+    ) -> List[Tuple[str, Optional[str]]]:
+        """Like `SELECT cpra,rsid FROM cpras_rsids WHERE cpra LIKE '<chrom>-<pos>-<ref>-<alt>%' ORDER BY ROWID LIMIT 100`"""
+        ret: List[Tuple[str, Optional[str]]] = []
+        for start, end in self._get_variant_idx_ranges(chrom, pos):
+            for idx in range(start, end):
+                if ref is not None and (
+                    self._positions[idx] != pos
+                    or self._refs[idx] != ref
+                    or not self._alts[idx].startswith(alt)
+                ):
+                    continue
+                cpra, rsids = self._get_cpra(idx), self._rsids[idx]
+                for rsid in rsids.split(",") if rsids else [None]:
+                    ret.append((cpra, rsid))
+                    if len(ret) == limit:
+                        return ret
+            if ref is not None:
+                break  # Only the exact position can match.
+        return ret
+
+    def get_rsid_cpra_pairs(self, rsid_prefix: str) -> Iterator[Tuple[str, str]]:
+        """Yields rsids that start with `rsid_prefix` and have up to two more digits, shortest first, and their variants"""
+        digits = rsid_prefix[2:]
+        if not rsid_prefix.startswith("rs") or not re.match(
+            r"^(?:[1-9][0-9]*)?$", digits
+        ):
+            return
+        for num_added_digits in [0, 1, 2]:
+            if digits:
+                lo = int(digits) * 10**num_added_digits
+                hi = lo + 10**num_added_digits
+            elif num_added_digits == 0:
+                continue
+            else:
+                lo, hi = 10 ** (num_added_digits - 1), 10**num_added_digits
+            i, j = np.searchsorted(
+                self._rsid_nums, np.array([lo, hi], dtype=np.uint64)
+            ).tolist()
+            for num, variant_idx in zip(
+                self._rsid_nums[i:j].tolist(), self._rsid_variant_idxs[i:j].tolist()
+            ):
+                yield ("rs{}".format(num), self._get_cpra(variant_idx))
+
+
+class _NgramIndex:
+    """Finds which of `strings` contain a query, by only checking the strings that contain its rarest trigram."""
+
+    def __init__(self, strings: List[str]):
+        self._strings = strings
+        self._postings: Dict[str, List[int]] = {}
+        for i, string in enumerate(strings):
+            for ngram in set(string[j : j + 3] for j in range(len(string) - 2)):
+                self._postings.setdefault(ngram, []).append(i)
+
+    def search(self, query: str) -> Iterator[int]:
+        """Yields the index of each string that contains `query`, in order"""
+        if len(query) < 3:
+            candidates: Any = range(len(self._strings))
+        else:
+            candidates = min(
+                (
+                    self._postings.get(query[j : j + 3], [])
+                    for j in range(len(query) - 2)
+                ),
+                key=len,
+            )
+        for i in candidates:
+            if query in self._strings[i]:
+                yield i
+
+
 class Autocompleter(object):
     def __init__(self, phenos: Dict[str, Dict[str, Any]]):
         self._phenos = copy.deepcopy(phenos)
@@ -38,10 +219,34 @@ class Autocompleter(object):
             get_filepath("cpras-rsids-sqlite3")
         )
         self._cpras_rsids_sqlite3.row_factory = sqlite3.Row
+        # Files made before `make-cpras-rsids-sqlite3` indexed positions can only be searched with `LIKE`.
+        self._cpras_rsids_has_pos_index = "pos" in [
+            row["name"]
+            for row in self._cpras_rsids_sqlite3.execute(
+                "PRAGMA table_info(cpras_rsids)"
+            )
+        ]
         self._gene_aliases_sqlite3 = get_sqlite3_readonly_connection(
             get_filepath("gene-aliases-sqlite3")
         )
         self._gene_aliases_sqlite3.row_factory = sqlite3.Row
+        # Datasets loaded before `pheweb make-autocomplete-index` existed use the sqlite3 files instead.
+        index_dirpath = get_filepath("autocomplete-index", must_exist=False)
+        self._variant_index = (
+            VariantIndex(index_dirpath) if os.path.exists(index_dirpath) else None
+        )
+        self._gene_aliases = sorted(
+            (
+                row["alias"].upper(),
+                len(row["alias"]),
+                row["alias"],
+                row["canonicals_comma"],
+            )
+            for row in self._gene_aliases_sqlite3.execute(
+                "SELECT alias,canonicals_comma FROM gene_aliases"
+            )
+        )
+        self._gene_alias_keys = [alias[0] for alias in self._gene_aliases]
 
         self._autocompleters = [
             self._autocomplete_rsid,  # Check rsid first, because it only runs if query.startswith('rs')
@@ -95,6 +300,19 @@ class Autocompleter(object):
                 pheno["--spaced--phenostring"] = self._process_string(
                     pheno["phenostring"]
                 )
+        self._phenocodes = list(self._phenos)
+        self._phenocode_index = _NgramIndex(
+            [self._phenos[p]["--spaced--phenocode"] for p in self._phenocodes]
+        )
+        self._phenocodes_with_phenostring = [
+            p for p in self._phenocodes if "phenostring" in self._phenos[p]
+        ]
+        self._phenostring_index = _NgramIndex(
+            [
+                self._phenos[p]["--spaced--phenostring"]
+                for p in self._phenocodes_with_phenostring
+            ]
+        )
 
     def _autocomplete_variant(self, query: str) -> Iterator[Dict[str, str]]:
         # chrom-pos-ref-alt format
@@ -104,23 +322,33 @@ class Autocompleter(object):
             key = "-".join(str(e) for e in [chrom, pos, ref, alt] if e is not None)
 
             # In Python's sort, chr1:23-A-T comes before chr1:23-A-TG, so this should always put exact matches first.
-            cpra_rsid_pairs = list(
-                self._cpras_rsids_sqlite3.execute(
-                    "SELECT cpra,rsid FROM cpras_rsids WHERE cpra LIKE ? ORDER BY ROWID LIMIT 100",  # Input was sorted by cpra, so ROWID will sort by cpra
-                    (key + "%",),
+            if self._variant_index is not None:
+                cpra_rsid_pairs = self._variant_index.get_cpra_rsid_pairs(
+                    chrom, pos, ref, alt
                 )
-            )
+            elif self._cpras_rsids_has_pos_index:
+                cpra_rsid_pairs = get_cpra_rsid_pairs_from_sqlite3(
+                    self._cpras_rsids_sqlite3, chrom, pos, key
+                )
+            else:
+                cpra_rsid_pairs = [
+                    (row["cpra"], row["rsid"])
+                    for row in self._cpras_rsids_sqlite3.execute(
+                        "SELECT cpra,rsid FROM cpras_rsids WHERE cpra LIKE ? ORDER BY ROWID LIMIT 100",  # Input was sorted by cpra, so ROWID will sort by cpra
+                        (key + "%",),
+                    )
+                ]
             if cpra_rsid_pairs:
                 for cpra, rows in itertools.groupby(
-                    cpra_rsid_pairs, key=lambda row: row["cpra"]
+                    cpra_rsid_pairs, key=lambda row: row[0]
                 ):
                     rowlist = list(rows)
                     cpra_display = cpra.replace("-", ":", 1)
-                    if len(rowlist) == 1 and rowlist[0]["rsid"] is None:
+                    if len(rowlist) == 1 and rowlist[0][1] is None:
                         display = cpra_display
                     else:
                         display = "{} ({})".format(
-                            cpra_display, ",".join(row["rsid"] for row in rowlist)
+                            cpra_display, ",".join(row[1] for row in rowlist)
                         )
                     yield {
                         "value": cpra_display,
@@ -130,7 +358,15 @@ class Autocompleter(object):
 
     def _autocomplete_rsid(self, query: str) -> Iterator[Dict[str, str]]:
         key = query.lower()
-        if query.startswith("rs"):
+        if query.startswith("rs") and self._variant_index is not None:
+            for rsid, cpra in self._variant_index.get_rsid_cpra_pairs(key):
+                cpra_display = cpra.replace("-", ":", 1)
+                yield {
+                    "value": cpra_display,
+                    "display": "{} ({})".format(rsid, cpra_display),
+                    "url": url_for(".variant_page", query=cpra_display),
+                }
+        elif query.startswith("rs"):
             ## <https://sqlite.org/np1queryprob.html> recommends doing lots of small queries, and it's fast:
             for suffix_length in [0, 1, 2]:
                 for suffix in (
@@ -154,42 +390,47 @@ class Autocompleter(object):
 
     def _autocomplete_phenocode(self, query: str) -> Iterator[Dict[str, str]]:
         query = self._process_string(query)
-        for phenocode, pheno in self._phenos.items():
-            if query in pheno["--spaced--phenocode"]:
-                yield {
-                    "value": phenocode,
-                    "display": (
-                        "{} ({})".format(phenocode, pheno["phenostring"])
-                        if "phenostring" in pheno
-                        else phenocode
-                    ),  # TODO: truncate phenostring intelligently
-                    "url": url_for(".pheno_page", phenocode=phenocode),
-                }
+        for i in self._phenocode_index.search(query):
+            phenocode = self._phenocodes[i]
+            pheno = self._phenos[phenocode]
+            yield {
+                "value": phenocode,
+                "display": (
+                    "{} ({})".format(phenocode, pheno["phenostring"])
+                    if "phenostring" in pheno
+                    else phenocode
+                ),  # TODO: truncate phenostring intelligently
+                "url": url_for(".pheno_page", phenocode=phenocode),
+            }
 
     def _autocomplete_phenostring(self, query: str) -> Iterator[Dict[str, str]]:
         query = self._process_string(query)
-        for phenocode, pheno in self._phenos.items():
-            if query in pheno["--spaced--phenostring"]:
-                yield {
-                    "value": phenocode,
-                    "display": "{} ({})".format(pheno["phenostring"], phenocode),
-                    "url": url_for(".pheno_page", phenocode=phenocode),
-                }
+        for i in self._phenostring_index.search(query):
+            phenocode = self._phenocodes_with_phenostring[i]
+            pheno = self._phenos[phenocode]
+            yield {
+                "value": phenocode,
+                "display": "{} ({})".format(pheno["phenostring"], phenocode),
+                "url": url_for(".pheno_page", phenocode=phenocode),
+            }
 
     def _autocomplete_gene(self, query: str) -> Iterator[Dict[str, str]]:
         key = query.upper()
         if len(key) >= 2:
 
-            alias_canonicals_pairs = list(
-                self._gene_aliases_sqlite3.execute(
-                    "SELECT alias,canonicals_comma FROM gene_aliases WHERE alias LIKE ? ORDER BY LENGTH(alias),alias LIMIT 10",
-                    (key + "%",),
-                )
-            )
-            for row in alias_canonicals_pairs:
-                alias, canonical_symbols = row["alias"], row["canonicals_comma"].split(
-                    ","
+            # Like `SELECT ... WHERE alias LIKE ? ORDER BY LENGTH(alias),alias LIMIT 10`, using `self._gene_aliases` sorted by uppercase alias.
+            start = bisect.bisect_left(self._gene_alias_keys, key)
+            end = bisect.bisect_left(self._gene_alias_keys, key + "\uffff", start)
+            alias_canonicals_pairs = [
+                (alias, canonicals_comma)
+                for _, _, alias, canonicals_comma in heapq.nsmallest(
+                    10,
+                    itertools.islice(self._gene_aliases, start, end),
+                    key=lambda row: row[1:3],
                 )
+            ]
+            for alias, canonicals_comma in alias_canonicals_pairs:
+                canonical_symbols = canonicals_comma.split(",")
                 if len(canonical_symbols) > 1:
                     yield {
                         "value": canonical_symbols[0],
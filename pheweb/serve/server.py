@@ -1,10 +1,8 @@
-from ..load.load_utils import get_maf
 from ..utils import (
     get_phenolist,
     get_gene_tuples,
     pad_gene,
     PheWebError,
-    vep_consqeuence_category,
 )
 from .. import conf
 from .. import parse_utils
@@ -14,6 +12,11 @@ from .server_utils import (
     get_random_page,
     get_pheno_region,
     relative_redirect,
+    json_response,
+    dumps_json,
+    get_best_assocs_for_pheno,
+    ResponseCache,
+    send_generated_file,
 )
 from .autocomplete import Autocompleter
 from .auth import GoogleSignIn
@@ -32,11 +35,13 @@ from flask import (
     session,
     url_for,
     Blueprint,
+    Response,
 )
 from flask_compress import Compress
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user
 
 import functools, math
+import numpy as np
 import re
 import traceback
 import json
@@ -52,7 +57,8 @@ import datetime
 bp = Blueprint("bp", __name__, template_folder="templates", static_folder="static")
 app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), "static"))
 Compress(app)
-app.config["COMPRESS_LEVEL"] = 2  # Since we don't cache, faster=better
+# Big generated files are precompressed by `pheweb precompress` (see `send_generated_file()`), so what's left is small or dynamic, and faster=better.
+app.config["COMPRESS_LEVEL"] = 2
 app.config["SECRET_KEY"] = conf.get_secret_key()
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 9
@@ -76,6 +82,12 @@ if conf.get_custom_templates_dir():
 
 phenos = {pheno["phenocode"]: pheno for pheno in get_phenolist()}
 
+filtered_manhattan_cache = ResponseCache(
+    "manhattan-filtered",
+    max_memory_bytes=int(conf.get_response_cache_max_memory_mb() * 1e6),
+    max_disk_bytes=int(conf.get_response_cache_max_disk_mb() * 1e6),
+)
+
 
 def email_is_allowed(user_email: Optional[str] = None) -> bool:
     if user_email is None:
@@ -385,7 +397,11 @@ def variant_page(query: str):
 @bp.route("/api/manhattan/pheno/<phenocode>.json")
 @check_auth
 def api_pheno(phenocode: str):
-    return send_from_directory(get_filepath("manhattan"), "{}.json".format(phenocode))
+    if phenocode not in phenos:
+        abort(404)
+    return send_generated_file(
+        get_pheno_filepath("manhattan", phenocode, must_exist=False)
+    )
 
 
 @bp.route("/api/manhattan-filtered/pheno/<phenocode>.json")
@@ -419,12 +435,6 @@ def api_pheno_filtered(phenocode):
             max_maf = float(request.args["max_maf"])
         except Exception:
             abort(404, description="Failed to parse GET parameter `max_maf=`.")
-    # Get variants according to filter
-    chosen_variants = (
-        []
-    )  # TODO: stream straight from VariantFileReader() -> Binner() without this intermediate list
-    weakest_pval_seen = 0
-    num_variants = 0
     try:
         filepath = get_pheno_filepath("best_of_pheno", phenocode)
     except Exception:
@@ -432,37 +442,82 @@ def api_pheno_filtered(phenocode):
             404,
             description="Failed to find a best_of_pheno file.  Perhaps `pheweb best-of-pheno` wasn't run.",
         )
+    from pheweb.load import manhattan
+
+    # The response only depends on these, so it's cached until best_of_pheno is rebuilt.
+    cache_key = [
+        phenocode,
+        indel,
+        consequence_category,
+        min_maf,
+        max_maf,
+        os.stat(filepath).st_mtime_ns,
+        manhattan.get_config(),
+    ]
+    body = filtered_manhattan_cache.get_or_make(
+        cache_key,
+        lambda: dumps_json(
+            get_filtered_manhattan_data(
+                filepath, pheno, indel, consequence_category, min_maf, max_maf
+            )
+        ),
+    )
+    return Response(body, mimetype="application/json")
+
+
+def get_filtered_manhattan_data(
+    filepath: str,
+    pheno: Dict[str, Any],
+    indel: str,
+    consequence_category: str,
+    min_maf: Optional[float],
+    max_maf: Optional[float],
+) -> Dict[str, Any]:
+    from pheweb.load import best_of_pheno
+    from pheweb.load.manhattan import Binner, ArrayBinner
+
+    facets_filepath = get_pheno_filepath(
+        "best_of_pheno_facets", pheno["phenocode"], must_exist=False
+    )
+    if (
+        os.path.exists(facets_filepath)
+        and os.stat(facets_filepath).st_mtime >= os.stat(filepath).st_mtime
+    ):
+        facets = best_of_pheno.read_facets_file(facets_filepath)
+        lines = best_of_pheno.BestOfPhenoLines(filepath)
+        if len(lines) == len(facets["pval"]):
+            idxs = np.flatnonzero(
+                best_of_pheno.get_facets_mask(
+                    facets, indel, consequence_category, min_maf, max_maf
+                )
+            )
+            array_binner = ArrayBinner()
+            array_binner.process_arrays(
+                facets["chrom_idx"][idxs],
+                facets["pos"][idxs],
+                facets["pval"][idxs],
+                lambda i: lines.get_variant(int(idxs[i])),
+            )
+            manhattan_data = array_binner.get_result()
+            manhattan_data["weakest_pval"] = (
+                float(facets["pval"].max()) if len(facets["pval"]) else 0
+            )
+            return manhattan_data
+        # Otherwise some field has a newline in it, so parse the whole file.
+
+    binner = Binner()
+    weakest_pval_seen = 0
     with VariantFileReader(filepath) as vfr:
         for v in vfr:
-            num_variants += 1
             if v["pval"] > weakest_pval_seen:
                 weakest_pval_seen = v["pval"]
-            if indel == "true" and len(v["ref"]) == 1 and len(v["alt"]) == 1:
-                continue
-            if indel == "false" and (len(v["ref"]) != 1 or len(v["alt"]) != 1):
-                continue
-            if min_maf is not None or max_maf is not None:
-                v_maf = get_maf(v, pheno)
-                if min_maf is not None and v_maf < min_maf:
-                    continue
-                if max_maf is not None and v_maf > max_maf:
-                    continue
-            if consequence_category:
-                csq = vep_consqeuence_category.get(v.get("consequence", ""), "")
-                if consequence_category == "lof" and csq != "lof":
-                    continue
-                if consequence_category == "nonsyn" and not csq:
-                    continue
-            chosen_variants.append(v)
-    from pheweb.load.manhattan import Binner
-
-    binner = Binner()
-    for variant in chosen_variants:
-        binner.process_variant(variant)
+            if best_of_pheno.keeps_variant(
+                v, pheno, indel, consequence_category, min_maf, max_maf
+            ):
+                binner.process_variant(v)
     manhattan_data = binner.get_result()
     manhattan_data["weakest_pval"] = weakest_pval_seen
-    # print(f'indel={indel} maf={min_maf}-{max_maf} #chosen={len(chosen_variants)} #bins={len(manhattan_data["variant_bins"])} #unbinned={len(manhattan_data["unbinned_variants"])} weakest_pval={weakest_pval_seen}')
-    return jsonify(manhattan_data)
+    return manhattan_data
 
 
 @bp.route("/top_hits")
@@ -474,7 +529,7 @@ def top_hits_page():
 @bp.route("/api/top_hits.json")
 @check_auth
 def api_top_hits():
-    return send_file(get_filepath("top-hits-1k"))
+    return send_generated_file(get_filepath("top-hits-1k", must_exist=False))
 
 
 @bp.route("/download/top_hits.tsv")
@@ -492,7 +547,7 @@ def phenotypes_page():
 @bp.route("/api/phenotypes.json")
 @check_auth
 def api_phenotypes():
-    return send_file(get_filepath("phenotypes_summary"))
+    return send_generated_file(get_filepath("phenotypes_summary", must_exist=False))
 
 
 @bp.route("/download/phenotypes.tsv")
@@ -504,7 +559,9 @@ def download_phenotypes():
 @bp.route("/api/qq/pheno/<phenocode>.json")
 @check_auth
 def api_pheno_qq(phenocode: str):
-    return send_from_directory(get_filepath("qq"), "{}.json".format(phenocode))
+    if phenocode not in phenos:
+        abort(404)
+    return send_generated_file(get_pheno_filepath("qq", phenocode, must_exist=False))
 
 
 @bp.route("/random")
@@ -588,7 +645,7 @@ def api_region(phenocode: str):
         abort(404)
     else:
         chrom, pos_start, pos_end = m.group(1), int(m.group(2)), int(m.group(3))
-        return jsonify(get_pheno_region(phenocode, chrom, pos_start, pos_end))
+        return json_response(get_pheno_region(phenocode, chrom, pos_start, pos_end))
 
 
 @bp.route("/api/pheno/<phenocode>/correlations/")
@@ -634,20 +691,87 @@ def get_gene_region_mapping() -> Dict[str, Tuple[str, int, int]]:
     }
 
 
-@functools.lru_cache(None)
+# Like (stat_key, db, has_best_assocs_table).  `pheweb gather-pvalues-for-each-gene` replaces the file, so it's re-opened when its mtime, size or inode changes.
+_best_phenos_by_gene_db: Optional[Tuple[Tuple[int, int, int], Any, bool]] = None
+
+
+def _get_best_phenos_by_gene_db_info() -> Tuple[Tuple[int, int, int], Any, bool]:
+    global _best_phenos_by_gene_db
+    filepath = get_filepath("best-phenos-by-gene-sqlite3")
+    st = os.stat(filepath)
+    stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    info = _best_phenos_by_gene_db
+    if info is None or info[0] != stat_key:
+        db = sqlite3.connect(filepath)
+        db.row_factory = sqlite3.Row
+        # Databases made by older versions of PheWeb only have `best_phenos_for_each_gene`.
+        has_best_assocs = bool(
+            db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='best_assocs'"
+            ).fetchall()
+        )
+        info = _best_phenos_by_gene_db = (stat_key, db, has_best_assocs)
+    return info
+
+
 def get_best_phenos_by_gene_db():
-    db = sqlite3.connect(get_filepath("best-phenos-by-gene-sqlite3"))
-    db.row_factory = sqlite3.Row
-    return db
+    return _get_best_phenos_by_gene_db_info()[1]
 
 
-def get_best_phenos_for_gene(gene: str) -> List[Dict[str, Any]]:
+def has_best_assocs_table() -> bool:
+    return _get_best_phenos_by_gene_db_info()[2]
+
+
+def get_best_phenos_json_for_gene(gene: str) -> Optional[str]:
     db = get_best_phenos_by_gene_db()
     for row in db.execute(
         "SELECT json FROM best_phenos_for_each_gene WHERE gene = ?", (gene,)
     ):
-        return json.loads(row["json"])
-    return []
+        return row["json"]
+    return None
+
+
+def get_best_phenos_for_gene(gene: str) -> List[Dict[str, Any]]:
+    best_phenos_json = get_best_phenos_json_for_gene(gene)
+    return json.loads(best_phenos_json) if best_phenos_json is not None else []
+
+
+def get_best_phenocode_for_gene(gene: str) -> Optional[str]:
+    if has_best_assocs_table():
+        for row in get_best_phenos_by_gene_db().execute(
+            "SELECT phenocode FROM best_assocs WHERE gene = ? ORDER BY rank LIMIT 1",
+            (gene,),
+        ):
+            return row["phenocode"]
+        return None
+    phenos_in_gene = get_best_phenos_for_gene(gene)
+    return phenos_in_gene[0]["phenocode"] if phenos_in_gene else None
+
+
+@bp.route("/api/gene/<genename>/best-phenos.json")
+@check_auth
+def api_gene_best_phenos(genename: str):
+    # The json is stored serialized, so send it without parsing it.
+    best_phenos_json = get_best_phenos_json_for_gene(genename)
+    if best_phenos_json is None:
+        abort(404)
+    return Response(best_phenos_json, mimetype="application/json")
+
+
+@bp.route("/api/pheno/<phenocode>/genes.json")
+@check_auth
+def api_pheno_genes(phenocode: str):
+    if phenocode not in phenos or not has_best_assocs_table():
+        abort(404)
+    max_pval = 5e-8
+    if request.args.get("max_pval"):
+        try:
+            max_pval = float(request.args["max_pval"])
+        except Exception:
+            abort(404, description="Failed to parse GET parameter `max_pval=`.")
+    return json_response(
+        get_best_assocs_for_pheno(get_best_phenos_by_gene_db(), phenocode, max_pval)
+    )
 
 
 @bp.route("/region/<phenocode>/gene/<genename>")
@@ -705,12 +829,12 @@ def gene_phenocode_page(phenocode: str, genename: str):
 @bp.route("/gene/<genename>")
 @check_auth
 def gene_page(genename: str):
-    phenos_in_gene = get_best_phenos_for_gene(genename)
-    if not phenos_in_gene:
+    phenocode = get_best_phenocode_for_gene(genename)
+    if phenocode is None:
         die(
             "Sorry, that gene doesn't appear to have any associations in any phenotype."
         )
-    return gene_phenocode_page(phenos_in_gene[0]["phenocode"], genename)
+    return gene_phenocode_page(phenocode, genename)
 
 
 if conf.should_show_download_top_hits_button():
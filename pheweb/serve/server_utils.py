@@ -1,12 +1,212 @@
-from flask import url_for, Response, redirect
+from flask import url_for, Response, redirect, request, abort, current_app
 
-from ..file_utils import MatrixReader, IndexedVariantFileReader, get_filepath
+from .. import conf
+from ..file_utils import (
+    MatrixReader,
+    IndexedVariantFileReader,
+    get_filepath,
+    get_generated_path,
+    precompressed_suffix_for_encoding,
+)
 
+import collections
+import hashlib
+import os
 import random
 import re
 import itertools
 import json
-from typing import Optional, Dict, List, Any
+import sqlite3
+import tempfile
+import threading
+from typing import Optional, Dict, List, Any, Callable
+
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
+
+def dumps_json(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+
+
+def json_response(data: Any) -> Response:
+    """Like `flask.jsonify(data)`, but faster for big responses if `orjson` is installed."""
+    return Response(dumps_json(data), mimetype="application/json")
+
+
+def send_generated_file(filepath: str, mimetype: str = "application/json") -> Response:
+    """
+    Sends a file from `generated-by-pheweb/`, using a precompressed copy (see `precompressed_suffix_for_encoding`) if the client accepts it.
+    The ETag and Last-Modified come from the original file's mtime and size, so repeat requests get a 304 without reading anything.
+    """
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        abort(404)
+    base_etag = "{:x}-{:x}".format(st.st_mtime_ns, st.st_size)
+
+    # Use the client's favorite encoding that has an up-to-date copy (preferring brotli in a tie).
+    # Its ETag is what `flask_compress` would have made, so cached responses stay valid whichever of us encoded them.
+    encoding, served_filepath = None, filepath
+    candidates = sorted(
+        (e for e in precompressed_suffix_for_encoding if request.accept_encodings[e]),
+        key=lambda e: -request.accept_encodings[e],
+    )
+    for candidate_encoding in candidates:
+        candidate_filepath = (
+            filepath + precompressed_suffix_for_encoding[candidate_encoding]
+        )
+        try:
+            candidate_st = os.stat(candidate_filepath)
+        except OSError:
+            continue
+        if candidate_st.st_mtime >= st.st_mtime:
+            encoding = candidate_encoding
+            served_filepath = candidate_filepath
+            break
+
+    if encoding is None and request.if_none_match:
+        # If `flask_compress` compressed this file for the client, don't re-compress it just to say that it's unchanged.
+        for candidate_encoding in ["br", "gzip", "deflate", "zstd"]:
+            etag = "{}:{}".format(base_etag, candidate_encoding)
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                response.headers["Vary"] = "Accept-Encoding"
+                return response
+
+    response = current_app.response_class(mimetype=mimetype)
+    response.last_modified = st.st_mtime  # type: ignore
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.get_send_file_max_age(filepath)  # type: ignore
+    if encoding is None:
+        response.set_etag(base_etag)
+    else:
+        response.set_etag("{}:{}".format(base_etag, encoding))
+        response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+    response.make_conditional(request)
+    if response.status_code == 200:
+        # Read it all, so that `flask_compress` can compress it (if it wasn't precompressed) with any algorithm, not just its streaming ones.
+        with open(served_filepath, "rb") as f:
+            response.set_data(f.read())
+    return response
+
+
+class ResponseCache:
+    """
+    Remembers the most-recently-used response bodies, in memory and in `generated-by-pheweb/response-cache/<name>/`.
+    Keys must include everything that the response depends on (like the mtime of the file it's made from), because entries are never invalidated.
+
+        body = cache.get_or_make([phenocode, mtime], lambda: dumps_json(make_data()))
+    """
+
+    def __init__(self, name: str, max_memory_bytes: int, max_disk_bytes: int):
+        self._name = name
+        self._max_memory_bytes = max_memory_bytes
+        self._max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._memory: Dict[str, bytes] = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes: Optional[int] = None  # computed when we first write
+
+    def get_or_make(self, key: Any, make: Callable[[], bytes]) -> bytes:
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        body = self._get_from_memory(digest)
+        if body is None:
+            body = self._get_from_disk(digest)
+            if body is None:
+                body = make()
+                self._put_on_disk(digest, body)
+            self._put_in_memory(digest, body)
+        return body
+
+    def _get_from_memory(self, digest: str) -> Optional[bytes]:
+        with self._lock:
+            body = self._memory.get(digest)
+            if body is not None:
+                self._memory.move_to_end(digest)  # type: ignore
+            return body
+
+    def _put_in_memory(self, digest: str, body: bytes) -> None:
+        if len(body) > self._max_memory_bytes:
+            return
+        with self._lock:
+            if digest in self._memory:
+                return
+            self._memory[digest] = body
+            self._memory_bytes += len(body)
+            while self._memory_bytes > self._max_memory_bytes:
+                _, evicted_body = self._memory.popitem(last=False)  # type: ignore
+                self._memory_bytes -= len(evicted_body)
+
+    def _get_dirpath(self) -> str:
+        return get_generated_path("response-cache", self._name)
+
+    def _get_from_disk(self, digest: str) -> Optional[bytes]:
+        if not self._max_disk_bytes:
+            return None
+        filepath = os.path.join(self._get_dirpath(), digest)
+        try:
+            with open(filepath, "rb") as f:
+                body = f.read()
+            # Eviction removes the least-recently-modified files first.
+            os.utime(filepath)
+        except OSError:
+            return None
+        return body
+
+    def _put_on_disk(self, digest: str, body: bytes) -> None:
+        if not self._max_disk_bytes or len(body) > self._max_disk_bytes:
+            return
+        dirpath = self._get_dirpath()
+        try:
+            os.makedirs(dirpath, exist_ok=True)
+            # Other processes might be reading the cache, so write to a tmp file and then rename it.
+            with tempfile.NamedTemporaryFile(
+                dir=dirpath, prefix="tmp-", delete=False
+            ) as f:
+                f.write(body)
+            os.replace(f.name, os.path.join(dirpath, digest))
+        except OSError:
+            return  # Maybe data_dir isn't writable, which is fine.
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = 0
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        self._disk_bytes += entry.stat().st_size
+            else:
+                self._disk_bytes += len(body)
+            if self._disk_bytes > self._max_disk_bytes:
+                self._evict_from_disk(dirpath)
+
+    def _evict_from_disk(self, dirpath: str) -> None:
+        # must hold `self._lock`
+        # Other processes write here too, so look at what's actually on disk.
+        files = []
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+        self._disk_bytes = sum(size for _, size, _ in files)
+        # Leave some room, so that we don't evict on every write.
+        for _, size, filepath in files:
+            if self._disk_bytes <= self._max_disk_bytes * 0.8:
+                break
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+            self._disk_bytes -= size
 
 
 class _Get_Pheno_Region:
@@ -29,6 +229,10 @@ class _Get_Pheno_Region:
     def get_pheno_region(
         phenocode: str, chrom: str, pos_start: int, pos_end: int
     ) -> dict:
+        if conf.get_region_engine() == "columns":
+            return _Get_Pheno_Region.get_pheno_region_from_columns(
+                phenocode, chrom, pos_start, pos_end
+            )
         variants = []
         with IndexedVariantFileReader(phenocode) as reader:
             for v in reader.get_region(chrom, pos_start, pos_end + 1):
@@ -48,6 +252,27 @@ class _Get_Pheno_Region:
             "lastpage": None,
         }
 
+    @staticmethod
+    def get_pheno_region_from_columns(
+        phenocode: str, chrom: str, pos_start: int, pos_end: int
+    ) -> dict:
+        # This matches `get_pheno_region()` without ever making a dict for each variant.
+        with IndexedVariantFileReader(phenocode) as reader:
+            df = reader.get_region_columns(chrom, pos_start, pos_end + 1)
+        if df:
+            df["id"] = list(
+                map("{}:{}_{}/{}".format, df["chrom"], df["pos"], df["ref"], df["alt"])
+            )
+            df["end"] = list(df["pos"])
+            _Get_Pheno_Region._rename(df, "chrom", "chr")
+            _Get_Pheno_Region._rename(df, "pos", "position")
+            _Get_Pheno_Region._rename(df, "rsids", "rsid")
+            _Get_Pheno_Region._rename(df, "pval", "pvalue")
+        return {
+            "data": df,
+            "lastpage": None,
+        }
+
 
 get_pheno_region = _Get_Pheno_Region.get_pheno_region
 
@@ -98,6 +323,28 @@ class _GetVariant:
 get_variant = _GetVariant().get_variant
 
 
+def get_best_assocs_for_pheno(
+    db: sqlite3.Connection, phenocode: str, max_pval: float
+) -> List[Dict[str, Any]]:
+    """
+    Returns the association of `phenocode` in each gene where it's one of the best phenotypes (see `gather_pvalues_for_each_gene`)
+    with pval <= `max_pval`, ordered by pval.  Each one is like `{"gene": "APOE", "rank": 0, "pval": 1e-10, "chrom": "19", ...}`.
+    """
+    cursor = db.execute(
+        "SELECT * FROM best_assocs WHERE phenocode = ? AND pval <= ? ORDER BY pval",
+        (phenocode, max_pval),
+    )
+    fields = [column[0] for column in cursor.description]
+    return [
+        {
+            field: value
+            for field, value in zip(fields, row)
+            if value is not None and field != "phenocode"
+        }
+        for row in cursor
+    ]
+
+
 def get_random_page() -> Optional[str]:
     with open(get_filepath("top-hits-1k")) as f:
         hits = json.load(f)
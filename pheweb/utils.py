@@ -58,14 +58,30 @@ assert fmt_seconds(900) == "15 minutes"
 assert fmt_seconds(90000) == "25 hours"
 
 
+# Maps filepath -> ((mtime_ns, size, inode), phenolist), so that each pheno-list.json is only parsed once until it changes.
+_phenolist_cache: Dict[
+    str, ty.Tuple[ty.Tuple[int, int, int], ty.List[ty.Dict[str, ty.Any]]]
+] = {}
+
+
 def get_phenolist(filepath: ty.Optional[str] = None) -> ty.List[ty.Dict[str, ty.Any]]:
-    # TODO: should this be memoized?
+    """
+    Returns the phenotypes in pheno-list.json, with url-quoted phenocodes.
+    The parsed file is cached until its mtime, size or inode changes.  Each call gets new copies of the phenotypes' dicts (but not of their lists, like `assoc_files`).
+    """
     from .file_utils import get_filepath
 
     filepath = filepath or get_filepath("phenolist")  # Allow override for unit testing
     try:
-        with open(os.path.join(filepath)) as f:
-            phenolist = json.load(f)
+        st = os.stat(filepath)
+        stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        cached = _phenolist_cache.get(filepath)
+        if cached is None or cached[0] != stat_key:
+            with open(filepath) as f:
+                phenolist = json.load(f)
+            for pheno in phenolist:
+                pheno["phenocode"] = urllib.parse.quote_plus(pheno["phenocode"])
+            cached = _phenolist_cache[filepath] = (stat_key, phenolist)
     except (FileNotFoundError, PermissionError):
         raise PheWebError(
             "You need a file to define your phenotypes at '{}'.\n".format(filepath)
@@ -75,9 +91,7 @@ def get_phenolist(filepath: ty.Optional[str] = None) -> ty.List[ty.Dict[str, ty.
         raise PheWebError(
             "Your file at '{}' contains invalid json.\n".format(filepath)
         ) from exc
-    for pheno in phenolist:
-        pheno["phenocode"] = urllib.parse.quote_plus(pheno["phenocode"])
-    return phenolist
+    return [dict(pheno) for pheno in cached[1]]
 
 
 def pad_gene(start: int, end: int) -> ty.Tuple[int, int]:
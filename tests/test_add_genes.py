@@ -0,0 +1,63 @@
+"""Test that sweeping through the genes gives the same nearest genes as querying the interval tree"""
+
+import random
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileReader, VariantFileWriter
+from pheweb.load import add_genes
+
+
+def make_gene_tuples(rng):
+    gene_tuples = []
+    for chrom in ["1", "2", "M"]:
+        for i in range(200):
+            start = rng.randrange(1000, 100000)
+            end = start + rng.choice([1, 2, rng.randrange(1, 5000)])
+            # Reuse names, so that one gene can overlap a position twice.
+            gene_tuples.append((chrom, start, end, "G{}".format(rng.randrange(150))))
+        # Make ties between starts and ends.
+        gene_tuples.append((chrom, 50000, 50010, "TIE_A"))
+        gene_tuples.append((chrom, 50000, 50020, "TIE_B"))
+        gene_tuples.append((chrom, 49000, 50010, "TIE_C"))
+    return gene_tuples
+
+
+def test_sweeping_gene_annotator():
+    rng = random.Random(0)
+    gene_tuples = make_gene_tuples(rng)
+    expected_annotator = add_genes.GeneAnnotator(iter(gene_tuples))
+    annotator = add_genes.SweepingGeneAnnotator(iter(gene_tuples))
+    for chrom in ["1", "2", "3", "MT"]:
+        positions = sorted(rng.randrange(1, 110000) for _ in range(3000))
+        positions += [50000, 50005, 50010, 50015, 50020, 50030]
+        # Positions that go backwards restart the sweep.
+        positions += [100, 60000, 60000, 3000]
+        for pos in positions:
+            assert annotator.annotate_position(
+                chrom, pos
+            ) == expected_annotator.annotate_position(chrom, pos), (chrom, pos)
+
+
+def test_annotate_genes(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    rng = random.Random(1)
+    gene_tuples = make_gene_tuples(rng)
+    monkeypatch.setattr(add_genes, "get_gene_tuples", lambda: iter(gene_tuples))
+    in_filepath = str(tmp_path / "sites-rsids.tsv")
+    with VariantFileWriter(in_filepath, use_gzip=False) as writer:
+        for chrom in ["1", "2", "MT"]:
+            for pos in sorted(rng.sample(range(1, 110000), 500)):
+                writer.write(
+                    dict(chrom=chrom, pos=pos, ref="A", alt="C", rsids="rs1,rs2")
+                )
+
+    expected_annotator = add_genes.GeneAnnotator(iter(gene_tuples))
+    with VariantFileReader(in_filepath) as reader:
+        expected = list(reader)
+    for v in expected:
+        v["nearest_genes"] = expected_annotator.annotate_position(v["chrom"], v["pos"])
+    out_filepath = str(tmp_path / "sites.tsv.gz")
+    add_genes.annotate_genes(in_filepath, out_filepath)
+    with VariantFileReader(out_filepath) as reader:
+        assert reader.fields == ["chrom", "pos", "ref", "alt", "rsids", "nearest_genes"]
+        assert list(reader) == expected
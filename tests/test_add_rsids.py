@@ -0,0 +1,99 @@
+"""Test that annotating rsids from the binary rsids file, one chromosome at a time, matches annotating from the text file"""
+
+import gzip
+import os
+import random
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileReader, VariantFileWriter
+from pheweb.load import add_rsids
+from pheweb.load import make_rsids_blocks as make_rsids_blocks_module
+
+
+def test_annotate_rsids_by_chrom(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    monkeypatch.setitem(conf.overrides, "num_procs", 2)
+    # Use small blocks, so that some positions are skipped.
+    monkeypatch.setattr(make_rsids_blocks_module, "BLOCK_NUM_RECORDS", 50)
+    rng = random.Random(0)
+    rsids_filepath = str(tmp_path / "rsids.tsv.gz")
+    in_filepath = str(tmp_path / "sites-unannotated.tsv")
+    # The rsids file uses `chr`-prefixed names, and chromosome 3 only has sites.
+    with gzip.open(rsids_filepath, "wt") as rsids_f, VariantFileWriter(
+        in_filepath, use_gzip=False
+    ) as writer:
+        for chrom in ["1", "2", "3", "10", "X", "MT"]:
+            for pos in range(1, 3000, 7):
+                if chrom != "3":
+                    for _ in range(rng.choice([1, 1, 2])):
+                        rsids_f.write(
+                            "chr{}\t{}\trs{}\tA\t{}\n".format(
+                                chrom,
+                                pos,
+                                rng.randrange(1, 10**6),
+                                rng.choice(["C", "G", "T", "C,T", "N", "."]),
+                            )
+                        )
+                if rng.random() < 0.5:
+                    writer.write(
+                        dict(chrom=chrom, pos=pos, ref="A", alt=rng.choice("CGT"))
+                    )
+
+    blocks_filepath = str(tmp_path / "rsids.blocks")
+    make_rsids_blocks_module.make_rsids_blocks(rsids_filepath, blocks_filepath)
+    with VariantFileReader(in_filepath) as reader:
+        expected = list(add_rsids.annotate_rsids(iter(reader), rsids_filepath))
+    assert any("," in v["rsids"] for v in expected)
+    with VariantFileReader(in_filepath) as reader:
+        assert (
+            list(add_rsids.annotate_rsids_from_blocks(iter(reader), blocks_filepath))
+            == expected
+        )
+
+    out_filepath = str(tmp_path / "sites-rsids.tsv")
+    add_rsids.annotate_rsids_by_chrom(in_filepath, blocks_filepath, out_filepath)
+    with VariantFileReader(out_filepath) as reader:
+        assert list(reader) == expected
+
+
+def test_rsids_blocks_file_is_remade_when_rsids_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    monkeypatch.setitem(conf.overrides, "num_procs", 1)
+    rsids_filepath = str(tmp_path / "rsids.tsv.gz")
+    blocks_filepath = str(tmp_path / "rsids.blocks")
+    in_filepath = str(tmp_path / "sites-unannotated.tsv")
+    with VariantFileWriter(in_filepath, use_gzip=False) as writer:
+        writer.write(dict(chrom="1", pos=100, ref="A", alt="C"))
+
+    def annotate():
+        with VariantFileReader(in_filepath) as reader:
+            return [
+                v["rsids"]
+                for v in add_rsids.annotate_rsids_from_blocks(
+                    iter(reader), blocks_filepath
+                )
+            ]
+
+    with gzip.open(rsids_filepath, "wt") as f:
+        f.write("1\t100\trs1\tA\tC\n")
+    assert not make_rsids_blocks_module.is_rsids_blocks_file_up_to_date(
+        blocks_filepath, rsids_filepath
+    )
+    make_rsids_blocks_module.make_rsids_blocks(rsids_filepath, blocks_filepath)
+    assert make_rsids_blocks_module.is_rsids_blocks_file_up_to_date(
+        blocks_filepath, rsids_filepath
+    )
+    assert annotate() == ["rs1"]
+
+    # Touching the rsids file doesn't matter, but replacing it with different contents does.
+    os.utime(rsids_filepath, ns=(1, 1))
+    assert make_rsids_blocks_module.is_rsids_blocks_file_up_to_date(
+        blocks_filepath, rsids_filepath
+    )
+    with gzip.open(rsids_filepath, "wt") as f:
+        f.write("1\t100\trs2\tA\tC\n")
+    assert not make_rsids_blocks_module.is_rsids_blocks_file_up_to_date(
+        blocks_filepath, rsids_filepath
+    )
+    make_rsids_blocks_module.make_rsids_blocks(rsids_filepath, blocks_filepath)
+    assert annotate() == ["rs2"]
@@ -1,19 +1,22 @@
 # TODO: split into multiple tests that share tmpdir and run in order
 
 import os
+import shutil
+import sqlite3
 import pytest
 
-
 pytest.skip(
     "Full integration test requires optional runtime dependencies; skipping in minimal test environment",
     allow_module_level=True,
 )
 
 
-def test_all(tmpdir, capsys):
+def test_all(tmpdir, capsys, monkeypatch):
     data_dir = str(tmpdir.realpath())
     input_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "input_files/"))
-    cache_dir = os.path.join(input_dir, "fake-cache")
+    # Use a copy of the cache, since `add-rsids` writes `rsids-*.blocks` into it.
+    cache_dir = os.path.join(data_dir, "fake-cache")
+    shutil.copytree(os.path.join(input_dir, "fake-cache"), cache_dir)
     conf = [
         "conf",
         'data_dir="{}"'.format(data_dir),
@@ -97,6 +100,8 @@ def test_all(tmpdir, capsys):
     cl_run(conf + ["process"])
     # TODO: check some properties of our files, such as manh.json
     cl_run(conf + ["top-loci"])
+    # `pheweb wsgi` writes wsgi.py into the current directory.
+    monkeypatch.chdir(data_dir)
     cl_run(conf + ["wsgi"])
     # with capsys.disabled(): print(2)
 
@@ -112,6 +117,13 @@ def test_all(tmpdir, capsys):
         assert client.get("/pheno/snowstorm").status_code == 200
         assert client.get("/api/manhattan/pheno/snowstorm.json").status_code == 200
         assert client.get("/api/qq/pheno/snowstorm.json").status_code == 200
+        etag = client.get("/api/qq/pheno/snowstorm.json").headers["ETag"]
+        assert (
+            client.get(
+                "/api/qq/pheno/snowstorm.json", headers={"If-None-Match": etag}
+            ).status_code
+            == 304
+        )
         assert client.get("/region/snowstorm/8-926279-1326279").status_code == 200
         assert (
             client.get(
@@ -126,3 +138,18 @@ def test_all(tmpdir, capsys):
         assert client.get("/api/autocomplete?query=%20DAP-2").status_code == 200
         assert b"EAR-LENGTH" in client.get("/region/1/gene/SAMD11").data
         assert b"\t" in client.get("/download/top_hits.tsv").data
+        assert client.get("/api/pheno/snowstorm/genes.json").status_code == 200
+        assert (
+            client.get("/api/pheno/snowstorm/genes.json?max_pval=x").status_code == 404
+        )
+
+        # Replacing the database with one made by an older PheWeb takes effect without restarting.
+        db_filepath = os.path.join(
+            data_dir, "generated-by-pheweb", "best-phenos-by-gene.sqlite3"
+        )
+        old_db = sqlite3.connect(db_filepath + ".old")
+        old_db.execute("CREATE TABLE best_phenos_for_each_gene (gene TEXT, json TEXT)")
+        old_db.commit()
+        old_db.close()
+        os.replace(db_filepath + ".old", db_filepath)
+        assert client.get("/api/pheno/snowstorm/genes.json").status_code == 404
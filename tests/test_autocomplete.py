@@ -0,0 +1,86 @@
+"""Test that `sites/autocomplete/` and the indexed queries on `cpras-rsids-sqlite3` find the same variants and rsids as the old `LIKE` queries"""
+
+import itertools
+import random
+import sqlite3
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileWriter
+from pheweb.load.make_autocomplete_index import make_autocomplete_index
+from pheweb.load.make_cpras_rsids_sqlite3 import make_cpras_rsids_sqlite3
+from pheweb.serve.autocomplete import (
+    VariantIndex,
+    _NgramIndex,
+    get_cpra_rsid_pairs_from_sqlite3,
+)
+from pheweb.serve.server_utils import parse_variant
+
+
+def make_variants():
+    rng = random.Random(0)
+    variants = []
+    for chrom in ["1", "2", "10", "12", "X", "MT"]:
+        positions = sorted(rng.sample(range(1, 300000), 300)) + [2**32 - 1]
+        for pos in positions:
+            for alt in rng.sample(["A", "C", "G", "GT"], rng.choice([1, 1, 2])):
+                num_rsids = rng.choice([0, 0, 1, 1, 2])
+                rsids = [
+                    "rs{}".format(rng.randrange(1, 2000)) for _ in range(num_rsids)
+                ]
+                variants.append(
+                    dict(chrom=chrom, pos=pos, ref="T", alt=alt, rsids=",".join(rsids))
+                )
+    return variants
+
+
+def test_variant_index(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    variants = make_variants()
+    sites_filepath = str(tmp_path / "sites.tsv")
+    with VariantFileWriter(sites_filepath, use_gzip=False) as writer:
+        writer.write_all(variants)
+    index_dirpath = tmp_path / "autocomplete"
+    index_dirpath.mkdir()
+    make_autocomplete_index(sites_filepath, str(index_dirpath))
+    index = VariantIndex(str(index_dirpath))
+    db_filepath = str(tmp_path / "cpras-rsids.sqlite3")
+    make_cpras_rsids_sqlite3(sites_filepath, db_filepath)
+    db = sqlite3.connect(db_filepath)
+
+    queries = ["1", "2", "M", "X", "chr1:0", "1-1", "10-2", "12:13", "X:42949"]
+    queries += ["{chrom}-{pos}".format(**v) for v in variants[::50]]
+    queries += ["{chrom}:{pos}-{ref}-{alt}".format(**v) for v in variants[::50]]
+    queries += ["{chrom}:{pos}-{ref}-G".format(**v) for v in variants[::50]]
+    queries += ["1:99999999999", "23:1", "X:4294967295-T-A"]
+    for query in queries:
+        chrom, pos, ref, alt = parse_variant(query, default_chrom_pos=False)
+        key = "-".join(str(e) for e in [chrom, pos, ref, alt] if e is not None)
+        expected = list(
+            db.execute(
+                "SELECT cpra,rsid FROM cpras_rsids WHERE cpra LIKE ? ORDER BY ROWID LIMIT 100",
+                (key + "%",),
+            )
+        )
+        assert index.get_cpra_rsid_pairs(chrom, pos, ref, alt) == expected, query
+        assert get_cpra_rsid_pairs_from_sqlite3(db, chrom, pos, key) == expected, query
+
+    for query in ["rs", "rs1", "rs12", "rs199", "rs1999", "rs3000", "rs05", "rsx"]:
+        expected = []
+        for suffix_length in [0, 1, 2]:
+            for digits in itertools.product("0123456789", repeat=suffix_length):
+                expected.extend(
+                    db.execute(
+                        "SELECT rsid,cpra FROM cpras_rsids WHERE rsid=? ORDER BY ROWID",
+                        (query + "".join(digits),),
+                    )
+                )
+        assert list(index.get_rsid_cpra_pairs(query)) == expected, query
+
+
+def test_ngram_index():
+    strings = ["type 2 diabetes", "type 1 diabetes", "ab", "", "diabetic"]
+    index = _NgramIndex(strings)
+    for query in ["", "a", "ab", "diabet", "type", "es", "1 d", "xyz"]:
+        assert list(index.search(query)) == [
+            i for i, string in enumerate(strings) if query in string
+        ], query
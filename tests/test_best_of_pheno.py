@@ -0,0 +1,103 @@
+"""Test that the best_of_pheno facets filter variants exactly like `/api/manhattan-filtered/` does without them"""
+
+import itertools
+import random
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileReader
+from pheweb.utils import vep_consqeuence_category, PheWebError
+from pheweb.load import best_of_pheno
+from pheweb.load.load_utils import MaxPriorityQueue, get_maf
+
+
+def keeps_variant(v, pheno, indel, consequence_category, min_maf, max_maf):
+    if indel == "true" and len(v["ref"]) == 1 and len(v["alt"]) == 1:
+        return False
+    if indel == "false" and (len(v["ref"]) != 1 or len(v["alt"]) != 1):
+        return False
+    # A variant whose MAF is unknown (or whose fields disagree about it) isn't filtered out by MAF.
+    try:
+        maf = get_maf(v, pheno)
+    except PheWebError:
+        maf = None
+    if maf is not None and min_maf is not None and maf < min_maf:
+        return False
+    if maf is not None and max_maf is not None and maf > max_maf:
+        return False
+    csq = vep_consqeuence_category.get(v.get("consequence", ""), "")
+    if consequence_category == "lof" and csq != "lof":
+        return False
+    if consequence_category == "nonsyn" and not csq:
+        return False
+    return True
+
+
+def make_facets(tmp_path, pheno, with_maf):
+    """Writes best_of_pheno/<phenocode> and its facets file, and returns the variants and facets"""
+    rng = random.Random(0)
+    q = MaxPriorityQueue()
+    for pos in range(1, 2001):
+        v = dict(
+            chrom=rng.choice(["1", "2", "X"]),
+            pos=pos,
+            ref=rng.choice(["A", "AT"]),
+            alt=rng.choice(["G", "GCC"]),
+            consequence=rng.choice(
+                ["", "intron_variant", "missense_variant", "stop_gained"]
+            ),
+            pval=rng.random(),
+            ac=rng.randrange(1, 2000),
+        )
+        if with_maf:
+            x = v["ac"] / 2000
+            # Some variants have a `maf` that disagrees with their `ac`, so `get_maf()` raises.
+            v["maf"] = round(min(x, 1 - x), 2) if rng.random() < 0.9 else 0.5
+        q.add_and_keep_size(v, v["pval"], 1000)
+    out_filepath = str(tmp_path / "best_of_pheno" / pheno["phenocode"])
+    facets_filepath = str(
+        tmp_path / "best_of_pheno_facets" / "{}.npz".format(pheno["phenocode"])
+    )
+    best_of_pheno.write_bestof_file(
+        q, out_filepath, facets_filepath=facets_filepath, pheno=pheno
+    )
+    with VariantFileReader(out_filepath) as reader:
+        variants = list(reader)
+    facets = best_of_pheno.read_facets_file(facets_filepath)
+    assert facets["pval"].tolist() == [v["pval"] for v in variants]
+    return variants, facets, out_filepath
+
+
+def check_mask(variants, facets, pheno):
+    for params in itertools.product(
+        ["", "true", "false"], ["", "lof", "nonsyn"], [None, 0.2], [None, 0.6]
+    ):
+        mask = best_of_pheno.get_facets_mask(facets, *params)
+        expected = [keeps_variant(v, pheno, *params) for v in variants]
+        assert mask.tolist() == expected, params
+        assert [
+            best_of_pheno.keeps_variant(v, pheno, *params) for v in variants
+        ] == expected, params
+
+
+def test_facets(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    pheno = {"phenocode": "a", "num_samples": 1000}
+    variants, facets, out_filepath = make_facets(tmp_path, pheno, with_maf=True)
+
+    lines = best_of_pheno.BestOfPhenoLines(out_filepath)
+    assert len(lines) == len(variants)
+    assert [lines.get_variant(i) for i in [0, 500, 999]] == [
+        variants[i] for i in [0, 500, 999]
+    ]
+
+    assert any(best_of_pheno.get_maf_for_filtering(v, pheno) is None for v in variants)
+    check_mask(variants, facets, pheno)
+
+
+def test_facets_with_unknown_maf(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    # Without `num_samples`, `ac` doesn't give a MAF, so no variant is filtered out by MAF.
+    pheno = {"phenocode": "b"}
+    variants, facets, _ = make_facets(tmp_path, pheno, with_maf=False)
+    assert all(best_of_pheno.get_maf_for_filtering(v, pheno) is None for v in variants)
+    check_mask(variants, facets, pheno)
@@ -0,0 +1,174 @@
+"""Test that the build manifest rebuilds outputs when (and only when) their inputs changed"""
+
+import os
+
+from pheweb import conf
+from pheweb.load import build_manifest
+from pheweb.load.load_utils import PerPhenoParallelizer
+from pheweb.load.build_manifest import BuildTarget, get_file_hash, record_added_lines
+
+
+def _write(filepath, text):
+    with open(filepath, "w") as f:
+        f.write(text)
+
+
+def test_build_target(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    inputs = [str(tmp_path / "a.tsv"), str(tmp_path / "b.tsv")]
+    output = str(tmp_path / "out.tsv")
+    _write(inputs[0], "a\n")
+    _write(inputs[1], "b\n")
+
+    assert not BuildTarget([output], inputs).is_up_to_date()
+    target = BuildTarget([output], inputs)
+    _write(output, "ab\n")
+    target.record()
+    assert BuildTarget([output], inputs).is_up_to_date()
+
+    # Touching an input without changing it doesn't matter.
+    os.utime(inputs[0], ns=(0, 2 * 10**18))
+    assert BuildTarget([output], inputs).is_up_to_date()
+
+    # Changing an input, removing an input, or changing the config does.
+    assert not BuildTarget([output], inputs[:1]).is_up_to_date()
+    assert not BuildTarget([output], inputs, config={"x": 1}).is_up_to_date()
+    _write(inputs[1], "c\n")
+    assert not BuildTarget([output], inputs).is_up_to_date()
+
+    # Deleting the output does too.
+    BuildTarget([output], inputs).record()
+    assert BuildTarget([output], inputs).is_up_to_date()
+    os.remove(output)
+    assert not BuildTarget([output], inputs).is_up_to_date()
+
+
+def test_build_target_without_record(tmp_path, monkeypatch):
+    # Outputs made before the manifest existed are checked by mtime.
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    input_filepath, output = str(tmp_path / "in.tsv"), str(tmp_path / "out.tsv")
+    _write(input_filepath, "a\n")
+    _write(output, "a\n")
+    os.utime(input_filepath, (1, 1))
+    os.utime(output, (2, 2))
+    assert BuildTarget([output], [input_filepath]).is_up_to_date()
+    # ... and then they're recorded, so mtimes don't matter anymore.
+    os.utime(input_filepath, (3, 3))
+    assert BuildTarget([output], [input_filepath]).is_up_to_date()
+
+    other_output = str(tmp_path / "other.tsv")
+    _write(other_output, "a\n")
+    os.utime(other_output, (0, 0))
+    assert not BuildTarget([other_output], [input_filepath]).is_up_to_date()
+
+
+def test_get_file_hash(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    d = tmp_path / "d"
+    d.mkdir()
+    _write(str(d / "x"), "x\n")
+    _write(str(tmp_path / "y"), "x\n")
+    dir_hash = get_file_hash(str(d))
+    assert get_file_hash(str(d / "x")) == get_file_hash(str(tmp_path / "y"))
+    _write(str(d / "x"), "xx\n")
+    assert get_file_hash(str(d)) != dir_hash
+
+
+def test_added_inputs_and_lines(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    a, b, c = [str(tmp_path / name) for name in ["a", "b", "c"]]
+    output = str(tmp_path / "out.tsv")
+    for fp in [a, b, c, output]:
+        _write(fp, fp + "\n")
+    BuildTarget([output], [a, b]).record()
+
+    # `pheweb sites` can merge just the new phenotypes.
+    assert BuildTarget([output], [a, b, c]).get_added_input_filepaths() == [c]
+    assert BuildTarget([output], [a]).get_added_input_filepaths() is None
+    assert (
+        BuildTarget([output], [a, b, c], config={"x": 1}).get_added_input_filepaths()
+        is None
+    )
+
+    # `add-rsids` can annotate just the new variants in `a`, and `augment-phenos` doesn't need to re-run.
+    old_hash = get_file_hash(a)
+    _write(a, a + "\nmore\n")
+    record_added_lines(a, old_hash)
+    assert not BuildTarget([output], [a, b]).is_up_to_date()
+    assert BuildTarget([output], [a, b]).was_made_from_fewer_lines_of(a)
+    assert not BuildTarget([output], [a, c]).was_made_from_fewer_lines_of(a)
+    assert BuildTarget([output], [a, b], lookup_input_filepaths=[a]).is_up_to_date()
+    assert BuildTarget([output], [a, b]).is_up_to_date()
+    assert BuildTarget([output], [a, b]).get_added_input_filepaths() == []
+
+    # Only changes that were recorded as added lines count.
+    _write(a, "different\n")
+    assert not BuildTarget([output], [a, b]).was_made_from_fewer_lines_of(a)
+    assert not BuildTarget([output], [a, b], lookup_input_filepaths=[a]).is_up_to_date()
+
+
+def test_connection_is_opened_once_per_process(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    inputs = [str(tmp_path / name) for name in ["a", "b", "c"]]
+    for fp in inputs + [str(tmp_path / "out")]:
+        _write(fp, fp + "\n")
+    num_connects = []
+    real_connect = build_manifest.sqlite3.connect
+    monkeypatch.setattr(
+        build_manifest.sqlite3,
+        "connect",
+        lambda *args, **kwargs: num_connects.append(1) or real_connect(*args, **kwargs),
+    )
+    BuildTarget([str(tmp_path / "out")], inputs).record()
+    assert BuildTarget([str(tmp_path / "out")], inputs).is_up_to_date()
+    assert len(num_connects) == 1
+
+    # A forked worker opens its own connection.
+    monkeypatch.setattr(build_manifest.os, "getpid", lambda: -1)
+    assert BuildTarget([str(tmp_path / "out")], inputs).is_up_to_date()
+    assert len(num_connects) == 2
+
+
+def test_stale_outputs_without_a_record_are_not_hashed(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    inputs = [str(tmp_path / "a"), str(tmp_path / "out")]
+    _write(inputs[1], "out\n")
+    _write(inputs[0], "a\n")
+    os.utime(inputs[1], ns=(0, 0))
+
+    def fail(filepath):
+        raise AssertionError("hashed {}".format(filepath))
+
+    monkeypatch.setattr(build_manifest, "get_file_hash", fail)
+    assert not BuildTarget(inputs[1:], inputs[:1]).is_up_to_date()
+
+
+def test_phenos_are_checked_in_parallel_when_hashes_are_not_cached(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    monkeypatch.setitem(conf.overrides, "num_procs", 2)
+    shared = str(tmp_path / "shared")
+    _write(shared, "shared\n")
+    phenos = [{"phenocode": str(i)} for i in range(6)]
+
+    def get_input_filepaths(pheno):
+        return [str(tmp_path / pheno["phenocode"]), shared]
+
+    def get_output_filepaths(pheno):
+        return str(tmp_path / (pheno["phenocode"] + ".out"))
+
+    for pheno in phenos:
+        _write(get_input_filepaths(pheno)[0], pheno["phenocode"] + "\n")
+        _write(get_output_filepaths(pheno), "")
+        BuildTarget([get_output_filepaths(pheno)], get_input_filepaths(pheno)).record()
+    _write(get_input_filepaths(phenos[2])[0], "changed\n")
+
+    # Copying the files changes their inodes, so none of their hashes are cached.
+    with build_manifest._connect() as db, db:
+        db.execute("DELETE FROM file_hashes")
+    tasks = PerPhenoParallelizer()._get_phenos_to_process(
+        phenos, None, get_input_filepaths, get_output_filepaths
+    )
+    assert tasks == [phenos[2]]
+    assert build_manifest.get_unhashed_size(get_input_filepaths(phenos[0])[0]) == 0
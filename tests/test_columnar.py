@@ -0,0 +1,88 @@
+"""Test the memory-mappable columnar variant files"""
+
+import math
+
+import pytest
+
+from pheweb import conf
+from pheweb.file_utils import ColumnarVariantFileReader, ColumnarVariantFileWriter
+
+VARIANTS = [
+    dict(
+        chrom="1",
+        pos=869334,
+        ref="G",
+        alt="A",
+        rsids="rs1",
+        nearest_genes="SAMD11",
+        pval=0.23,
+        beta=0.5,
+        maf=0.01,
+    ),
+    dict(
+        chrom="1",
+        pos=869335,
+        ref="GT",
+        alt="G",
+        rsids="",
+        nearest_genes="SAMD11,NOC2L",
+        pval=1e-300,
+        beta="",
+        maf=0.499,
+    ),
+    dict(
+        chrom="X",
+        pos=4294967295,
+        ref="C",
+        alt="ÅT",
+        rsids="rs2,rs3",
+        nearest_genes="",
+        pval=0.0,
+        beta=-1.25,
+        maf=0.2,
+    ),
+]
+
+
+@pytest.fixture
+def columnar_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    dirpath = str(tmp_path / "pheno_columns" / "a1c")
+    with ColumnarVariantFileWriter(dirpath) as writer:
+        writer.write_all(dict(v) for v in VARIANTS)
+    return dirpath
+
+
+def test_roundtrip_variants(columnar_dir):
+    with ColumnarVariantFileReader(columnar_dir) as reader:
+        assert reader.fields == [
+            "chrom",
+            "pos",
+            "ref",
+            "alt",
+            "rsids",
+            "nearest_genes",
+            "pval",
+            "beta",
+            "maf",
+        ]
+        assert len(reader) == len(VARIANTS)
+        assert list(reader) == VARIANTS
+        assert reader.get_variant(1) == VARIANTS[1]
+
+
+def test_columns_are_views(columnar_dir):
+    with ColumnarVariantFileReader(columnar_dir) as reader:
+        pvals = reader.get_column("pval")
+        assert pvals.dtype.name == "float64"
+        assert pvals.tolist() == [0.23, 1e-300, 0.0]
+        assert math.isnan(reader.get_column("beta")[1])
+        assert reader.get_column("pos").dtype.name == "uint32"
+        assert reader.get_column("chrom_idx").tolist() == [0, 0, 22]
+        assert reader.get_column("chrom")[2] == "X"
+        assert reader.get_column("alt")[2] == "ÅT"
+        assert reader.get_column("nearest_genes").slice_tolist(0, 3) == [
+            "SAMD11",
+            "SAMD11,NOC2L",
+            "",
+        ]
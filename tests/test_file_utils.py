@@ -0,0 +1,175 @@
+"""Test helpers in file_utils"""
+
+import gzip
+import json
+import os
+import pysam
+from pysam.libcbgzf import BGZFile
+
+from pheweb import conf
+from pheweb.file_utils import (
+    get_tabix_chrom_virtual_offsets,
+    TabixFilePool,
+    MatrixReader,
+    get_generated_path,
+    get_pheno_filepath,
+    get_tmp_path,
+    VariantFileWriter,
+    IndexedVariantFileReader,
+    convert_VariantFile_to_IndexedVariantFile,
+    read_lines_on_chrom,
+)
+
+
+def test_tabix_chrom_virtual_offsets(tmp_path):
+    tsv_filepath = tmp_path / "a.tsv"
+    with open(tsv_filepath, "w") as f:
+        f.write("chrom\tpos\n")
+        for chrom in ["1", "2", "10", "X"]:
+            for pos in range(1, 100_000, 7):  # big enough to span several bgzip blocks
+                f.write("{}\t{}\n".format(chrom, pos))
+    gz_filepath = str(tmp_path / "a.tsv.gz")
+    pysam.tabix_compress(str(tsv_filepath), gz_filepath)
+    pysam.tabix_index(gz_filepath, seq_col=0, start_col=1, end_col=1, line_skip=1)
+
+    offsets = get_tabix_chrom_virtual_offsets(gz_filepath + ".tbi")
+    assert list(offsets) == ["1", "2", "10", "X"]
+    with BGZFile(gz_filepath, "rb") as f:
+        for chrom, offset in offsets.items():
+            f.seek(offset)
+            assert f.readline().rstrip(b"\n") == "{}\t1".format(chrom).encode()
+
+
+def _write_tabixed(gz_filepath, positions):
+    tsv_filepath = gz_filepath[: -len(".gz")]
+    with open(tsv_filepath, "w") as f:
+        f.write("chrom\tpos\n")
+        for pos in positions:
+            f.write("1\t{}\n".format(pos))
+    pysam.tabix_compress(tsv_filepath, gz_filepath, force=True)
+    pysam.tabix_index(
+        gz_filepath, seq_col=0, start_col=1, end_col=1, line_skip=1, force=True
+    )
+
+
+def test_tabix_file_pool(tmp_path):
+    gz_filepath = str(tmp_path / "a.tsv.gz")
+    _write_tabixed(gz_filepath, [10, 20])
+    pool = TabixFilePool(max_idle_handles=2)
+
+    with pool.get(gz_filepath) as tabix_file:
+        first_handle = tabix_file
+        assert list(tabix_file.fetch("1", 0, 100)) == ["1\t10", "1\t20"]
+        with pool.get(
+            gz_filepath
+        ) as other_tabix_file:  # concurrent users get separate handles
+            assert other_tabix_file is not first_handle
+    with pool.get(gz_filepath) as tabix_file:
+        assert tabix_file is first_handle
+
+    # After the file is rewritten, the old handle is dropped.
+    _write_tabixed(gz_filepath, [10, 20, 30])
+    os.utime(gz_filepath, ns=(1, 1))
+    with pool.get(gz_filepath) as tabix_file:
+        assert tabix_file is not first_handle
+        assert list(tabix_file.fetch("1", 0, 100)) == ["1\t10", "1\t20", "1\t30"]
+
+    headers = []
+    read_header = lambda filepath: headers.append(filepath) or len(headers)
+    assert pool.get_header(gz_filepath, read_header) == 1
+    assert pool.get_header(gz_filepath, read_header) == 1
+    os.utime(gz_filepath, ns=(2, 2))
+    assert pool.get_header(gz_filepath, read_header) == 2
+
+
+def test_matrix_reader_projection(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    with open(tmp_path / "pheno-list.json", "w") as f:
+        json.dump(
+            [
+                {"phenocode": "a", "phenostring": "A", "assoc_files": ["a.tsv"]},
+                {"phenocode": "b", "phenostring": "B", "assoc_files": ["b.tsv"]},
+            ],
+            f,
+        )
+    matrix_filepath = get_generated_path("matrix.tsv.gz")
+    rows = [
+        ["#chrom", "pos", "ref", "alt", "pval@a", "beta@a", "pval@b", "beta@b"],
+        ["1", "100", "A", "G", "0.5", "0.1", "", ""],
+        ["1", "200", "C", "T", "1e-05", "-0.2", "0.01", "0.3"],
+    ]
+    with open(matrix_filepath[: -len(".gz")], "w") as f:
+        for row in rows:
+            f.write("\t".join(row) + "\n")
+    pysam.tabix_compress(matrix_filepath[: -len(".gz")], matrix_filepath)
+    pysam.tabix_index(matrix_filepath, seq_col=0, start_col=1, end_col=1, line_skip=1)
+
+    matrix_reader = MatrixReader()
+    with matrix_reader.context() as mr:
+        variants = list(mr.get_region("1", 1, 1000))
+    assert variants[0]["phenos"] == {
+        "a": {"pval": 0.5, "beta": 0.1, "phenocode": "a", "phenostring": "A"}
+    }
+    assert set(variants[1]["phenos"]) == {"a", "b"}
+
+    with matrix_reader.context(fields=["pval"], max_pval=1e-3) as mr:
+        variants_and_rows = list(mr.get_region_with_rows("1", 1, 1000))
+        assert [v["phenos"] for v, _ in variants_and_rows] == [
+            {},
+            {"a": {"pval": 1e-5}},
+        ]
+        assert mr.parse_pheno(variants_and_rows[1][1], "b") == {
+            "pval": 0.01,
+            "beta": 0.3,
+            "phenocode": "b",
+            "phenostring": "B",
+        }
+
+
+def test_get_region_columns(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    variants = [
+        dict(chrom="1", pos=100, ref="A", alt="G", rsids="rs1", pval=0.5, beta=0.1),
+        dict(chrom="1", pos=150, ref="A", alt="T", rsids="", pval=1e-05, beta=""),
+        dict(chrom="1", pos=200, ref="C", alt="T", rsids="rs\t2", pval=0.01, beta=-2),
+        dict(chrom="2", pos=100, ref="C", alt="T", rsids="rs3", pval=0.2, beta=0.3),
+    ]
+    pheno_gz_filepath = get_pheno_filepath("pheno_gz", "a", must_exist=False)
+    tmp_filepath = get_tmp_path(pheno_gz_filepath)
+    with VariantFileWriter(tmp_filepath, use_gzip=False) as writer:
+        writer.write_all(variants)
+    convert_VariantFile_to_IndexedVariantFile(tmp_filepath, pheno_gz_filepath)
+
+    with IndexedVariantFileReader("a") as reader:
+        for start, end in [(1, 1000), (100, 151), (101, 200), (300, 400)]:
+            expected = list(reader.get_region("1", start, end))
+            columns = reader.get_region_columns("1", start, end)
+            if not expected:
+                assert columns == {}
+                continue
+            assert list(columns) == list(expected[0])
+            assert [
+                dict(zip(columns, values)) for values in zip(*columns.values())
+            ] == expected
+        # The quoted tab needs csv.
+        assert reader.get_region_columns("1", 1, 1000)["rsids"] == ["rs1", "", "rs\t2"]
+        assert reader.get_region_columns("1", 1, 180)["beta"] == [0.1, ""]
+
+
+def test_read_lines_on_chrom(tmp_path):
+    lines = ["##comment\n", "#chrom\tpos\n"]
+    for chrom in ["chr1", "chr2", "chr10", "chrX"]:
+        lines.extend("{}\t{}\n".format(chrom, pos) for pos in range(1, 300_000, 3))
+    for filepath, open_fn in [
+        (tmp_path / "a.tsv", open),
+        (tmp_path / "a.tsv.gz", gzip.open),
+    ]:
+        with open_fn(filepath, "wt") as f:
+            f.writelines(lines)
+        for chrom_names in [["chr1"], ["10", "chr10"], ["chrX"], ["chr3"], ["chr"]]:
+            with read_lines_on_chrom(filepath, chrom_names, num_header_lines=1) as f:
+                assert [line.rstrip("\n") for line in f] == [lines[0].rstrip("\n")] + [
+                    line.rstrip("\n")
+                    for line in lines
+                    if line.split("\t")[0] in chrom_names
+                ]
@@ -0,0 +1,133 @@
+"""Test that sweeping through the matrix finds the same best phenotypes for each gene as checking each variant against every gene"""
+
+import json
+import random
+import sqlite3
+import pysam
+
+from pheweb import conf
+from pheweb.file_utils import MatrixReader, get_generated_path
+from pheweb.load.gather_pvalues_for_each_gene import (
+    get_best_phenos_for_genes_on_chrom,
+    make_best_phenos_by_gene_sqlite3,
+    order_and_truncate_phenos,
+)
+from pheweb.serve.server_utils import get_best_assocs_for_pheno
+
+
+def get_expected_best_phenos(genes, chrom):
+    best_assoc_for_pheno_gene_pair = {}
+    with MatrixReader().context(fields=["pval"]) as matrix_reader:
+        for variant, variant_row in matrix_reader.get_region_with_rows(chrom, 1, 10**9):
+            genenames = [g[2] for g in genes if g[0] <= variant["pos"] < g[1]]
+            for phenocode, pheno in variant["phenos"].items():
+                for genename in genenames:
+                    pair = (phenocode, genename)
+                    if (
+                        pair not in best_assoc_for_pheno_gene_pair
+                        or pheno["pval"] < best_assoc_for_pheno_gene_pair[pair][0]
+                    ):
+                        best_assoc_for_pheno_gene_pair[pair] = (
+                            pheno["pval"],
+                            variant_row,
+                        )
+        phenos_in_gene = {}
+        for (phenocode, genename), (
+            _,
+            variant_row,
+        ) in best_assoc_for_pheno_gene_pair.items():
+            assoc = dict(zip(["chrom", "pos", "ref", "alt"], variant_row))
+            assoc["pos"] = int(assoc["pos"])
+            assoc.update(matrix_reader.parse_pheno(variant_row, phenocode))
+            assoc["phenocode"] = phenocode
+            phenos_in_gene.setdefault(genename, []).append(assoc)
+    return {
+        genename: order_and_truncate_phenos(phenos)
+        for genename, phenos in phenos_in_gene.items()
+    }
+
+
+def test_get_best_phenos_for_genes_on_chrom(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    rng = random.Random(0)
+    phenocodes = ["p{}".format(i) for i in range(12)]
+    with open(tmp_path / "pheno-list.json", "w") as f:
+        json.dump([{"phenocode": p, "assoc_files": ["x"]} for p in phenocodes], f)
+    matrix_filepath = get_generated_path("matrix.tsv.gz")
+    with open(matrix_filepath[: -len(".gz")], "w") as f:
+        f.write(
+            "\t".join(
+                ["#chrom", "pos", "ref", "alt"]
+                + [field + "@" + p for p in phenocodes for field in ["pval", "beta"]]
+            )
+            + "\n"
+        )
+        for chrom in ["1", "2"]:
+            for pos in sorted(rng.sample(range(1, 20000), 1500)):
+                row = [chrom, str(pos), "A", "G"]
+                for _ in phenocodes:
+                    if rng.random() < 0.7:
+                        # Use few distinct pvals, so that there are many ties.
+                        row += [rng.choice(["0.5", "0.01", "1e-05", "3e-09"]), "0.1"]
+                    else:
+                        row += ["", ""]
+                f.write("\t".join(row) + "\n")
+    pysam.tabix_compress(matrix_filepath[: -len(".gz")], matrix_filepath)
+    pysam.tabix_index(matrix_filepath, seq_col=0, start_col=1, end_col=1, line_skip=1)
+
+    genes = []
+    for i in range(60):
+        start = rng.randrange(1, 19000)
+        genes.append((start, start + rng.choice([1, 50, 500, 3000]), "G{}".format(i)))
+    genes.append((21000, 22000, "after-every-variant"))
+    # One gene with two overlapping intervals.
+    genes.append((5000, 6000, "twice"))
+    genes.append((5500, 7000, "twice"))
+    for chrom in ["1", "2", "3"]:
+        best_phenos = get_best_phenos_for_genes_on_chrom(
+            {"chrom": chrom, "genes": genes}
+        )
+        assert best_phenos == get_expected_best_phenos(genes, chrom)
+        assert bool(best_phenos) == (chrom != "3")
+
+
+def test_make_best_phenos_by_gene_sqlite3(tmp_path):
+    best_phenos_for_gene = {
+        "A": [
+            dict(
+                chrom="1",
+                pos=5,
+                ref="A",
+                alt="G",
+                pval=1e-10,
+                beta=0.5,
+                phenocode="x",
+                category="c",
+            ),
+            dict(chrom="1", pos=6, ref="A", alt="G", pval=1e-3, beta="", phenocode="y"),
+        ],
+        "B": [
+            dict(chrom="2", pos=7, ref="C", alt="T", pval=1e-9, phenocode="y"),
+            dict(chrom="2", pos=8, ref="C", alt="T", pval=2e-9, phenocode="x"),
+        ],
+    }
+    db_filepath = str(tmp_path / "best-phenos-by-gene.sqlite3")
+    make_best_phenos_by_gene_sqlite3(best_phenos_for_gene, db_filepath)
+    db = sqlite3.connect(db_filepath)
+    assert {
+        gene: json.loads(best_phenos_json)
+        for gene, best_phenos_json in db.execute(
+            "SELECT gene, json FROM best_phenos_for_each_gene"
+        )
+    } == best_phenos_for_gene
+    assert get_best_assocs_for_pheno(db, "x", 5e-8) == [
+        dict(
+            gene="A", rank=0, chrom="1", pos=5, ref="A", alt="G", pval=1e-10, beta=0.5
+        ),
+        dict(gene="B", rank=1, chrom="2", pos=8, ref="C", alt="T", pval=2e-9),
+    ]
+    assert get_best_assocs_for_pheno(db, "y", 5e-8) == [
+        dict(gene="B", rank=0, chrom="2", pos=7, ref="C", alt="T", pval=1e-9)
+    ]
+    assert len(get_best_assocs_for_pheno(db, "y", 1)) == 2
+    assert get_best_assocs_for_pheno(db, "z", 1) == []
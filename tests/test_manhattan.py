@@ -0,0 +1,64 @@
+"""Test that ArrayBinner gives exactly the same Manhattan plot as Binner"""
+
+import json
+import random
+
+import numpy as np
+import pytest
+
+from pheweb import conf
+from pheweb.utils import chrom_order
+from pheweb.load.manhattan import Binner, ArrayBinner
+
+
+def make_variants(num_variants, seed):
+    rng = random.Random(seed)
+    variants = []
+    for chrom in ["1", "2", "7", "X", "MT"]:
+        positions = sorted(rng.sample(range(1, 30_000_000), num_variants // 5))
+        for pos in positions:
+            r = rng.random()
+            if r < 0.002:
+                pval = 0.0
+            elif r < 0.01:
+                pval = float("{:.2g}".format(10 ** -rng.uniform(20, 60)))
+            elif r < 0.05:
+                pval = float("{:.2g}".format(10 ** -rng.uniform(5, 20)))
+            else:
+                pval = float("{:.2g}".format(rng.random()))  # lots of ties
+            variants.append(
+                dict(chrom=chrom, pos=pos, ref="A", alt="G", pval=pval, beta=0.1)
+            )
+    return variants
+
+
+def get_both_results(variants):
+    binner = Binner()
+    for v in variants:
+        binner.process_variant(dict(v))
+    array_binner = ArrayBinner()
+    array_binner.process_arrays(
+        np.array([chrom_order[v["chrom"]] for v in variants], dtype=np.uint8),
+        np.array([v["pos"] for v in variants], dtype=np.uint32),
+        np.array([v["pval"] for v in variants], dtype=np.float64),
+        lambda i: dict(variants[i]),
+    )
+    return (
+        json.dumps(binner.get_result()),
+        json.dumps(array_binner.get_result()),
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_array_binner_matches_binner(seed):
+    expected, actual = get_both_results(make_variants(20_000, seed))
+    assert actual == expected
+
+
+@pytest.mark.parametrize("seed", [3, 4])
+def test_array_binner_matches_binner_with_small_queues(seed, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "manhattan_num_unbinned", 20)
+    monkeypatch.setitem(conf.overrides, "manhattan_peak_max_count", 5)
+    monkeypatch.setattr(ArrayBinner, "_chunk_size", 100)
+    expected, actual = get_both_results(make_variants(5_000, seed))
+    assert actual == expected
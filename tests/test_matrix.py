@@ -0,0 +1,87 @@
+"""Test that `pheweb matrix` joins every line of every pheno_gz/* onto sites.tsv, including the last variant of each phenotype"""
+
+import gzip
+import os
+import random
+
+import pysam
+
+from pheweb import conf
+from pheweb.load import matrix
+
+
+def test_make_matrix(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    monkeypatch.setitem(conf.overrides, "num_procs", 2)
+    generated_dir = tmp_path / "generated-by-pheweb"
+    os.makedirs(str(generated_dir / "sites"))
+    os.makedirs(str(generated_dir / "pheno_gz"))
+    rng = random.Random(0)
+
+    sites_header = ["chrom", "pos", "ref", "alt", "nearest_genes"]
+    sites = [
+        (chrom, str(pos), "A", alt, "GENE{}".format(pos % 3))
+        for chrom in ["1", "2", "X"]
+        for pos in range(100, 20_000, 37)
+        for alt in ["C", "G"][: rng.choice([1, 2])]
+    ]
+    with open(str(generated_dir / "sites" / "sites.tsv"), "w") as f:
+        for row in [sites_header] + sites:
+            f.write("\t".join(row) + "\n")
+
+    # `b` has no variants on chromosome 1, and each phenotype has the last variant of each of its chromosomes.
+    per_assoc_fields = {"a": ["pval", "beta"], "b": ["pval", "beta"], "c": ["pval"]}
+    chroms = {"a": ["1", "X"], "b": ["2", "X"], "c": ["1", "2", "X"]}
+    last_sites = {
+        chrom: [s for s in sites if s[0] == chrom][-1] for chrom in ["1", "2", "X"]
+    }
+    assocs = {
+        phenocode: [
+            s
+            for s in sites
+            if s[0] in chroms[phenocode]
+            and (rng.random() < 0.3 or s == last_sites[s[0]])
+        ]
+        for phenocode in per_assoc_fields
+    }
+    values = {}
+    for phenocode, variants in assocs.items():
+        tsv_filepath = str(generated_dir / "pheno_gz" / phenocode)
+        with open(tsv_filepath, "w") as f:
+            f.write("\t".join(sites_header + per_assoc_fields[phenocode]) + "\n")
+            for v in variants:
+                vals = [
+                    "{:.3g}".format(rng.random()) for _ in per_assoc_fields[phenocode]
+                ]
+                values[phenocode, v] = vals
+                f.write("\t".join(list(v) + vals) + "\n")
+        gz_filepath = tsv_filepath + ".gz"
+        pysam.tabix_compress(tsv_filepath, gz_filepath)
+        pysam.tabix_index(gz_filepath, seq_col=0, start_col=1, end_col=1, line_skip=1)
+        os.remove(tsv_filepath)
+
+    out_filepath = str(tmp_path / "matrix.tsv.gz")
+    matrix.make_matrix(out_filepath)
+    with gzip.open(out_filepath, "rt") as f:
+        lines = f.read().split("\n")
+
+    phenocodes = sorted(per_assoc_fields)
+    expected = [
+        "#"
+        + "\t".join(
+            sites_header
+            + [
+                "{}@{}".format(field, phenocode)
+                for phenocode in phenocodes
+                for field in per_assoc_fields[phenocode]
+            ]
+        )
+    ]
+    for s in sites:
+        row = list(s)
+        for phenocode in phenocodes:
+            row += values.get(
+                (phenocode, tuple(s)), [""] * len(per_assoc_fields[phenocode])
+            )
+        expected.append("\t".join(row))
+    assert lines == expected + [""]
@@ -0,0 +1,92 @@
+"""Test that `Parallelizer` runs every task once when it orders tasks by cost and batches them"""
+
+import os
+import time
+
+from pheweb import conf
+from pheweb.load import load_utils
+from pheweb.load.load_utils import (
+    Parallelizer,
+    WorkerPool,
+    describe_task,
+    get_task_batches,
+)
+
+
+def square(task):
+    if task["n"] == 7:
+        time.sleep(0.3)
+    return task["n"] ** 2
+
+
+def get_pid_and_override(task):
+    print("working on", task["n"])
+    return os.getpid(), conf.overrides.get("x")
+
+
+def test_get_task_batches():
+    costs = [1] * 100 + [50, 30]
+    batches = get_task_batches(list(range(102)), costs, n_procs=2)
+    assert batches[:2] == [[100], [101]]
+    assert sorted(task for batch in batches for task in batch) == list(range(102))
+    # The cheap tasks are batched, but no batch costs much more than the target.
+    assert len(batches) < 20
+    assert all(sum(costs[task] for task in batch) <= 23 for batch in batches[2:])
+    # Free tasks aren't a problem.
+    assert get_task_batches(["a", "b"], [0, 0], n_procs=4) == [["a"], ["b"]]
+
+
+def test_run_single_tasks_with_cost(tmp_path, monkeypatch, capsys):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    monkeypatch.setitem(conf.overrides, "num_procs", 3)
+    tasks = [{"n": n} for n in range(40)]
+    results = {
+        ret["task"]["n"]: ret["value"]
+        for ret in Parallelizer().run_single_tasks(
+            tasks, square, get_cost=lambda task: 1 + task["n"] % 7
+        )
+    }
+    assert results == {n: n**2 for n in range(40)}
+    # The slowest task is reported by name.
+    assert "Slowest tasks: {!r} (".format({"n": 7}) in capsys.readouterr().out
+
+
+def test_describe_task():
+    assert describe_task({"phenocode": "250.2", "chrom": "1"}) == "250.2"
+    assert describe_task({"chrom": "X", "out_filepath": "/tmp/x"}) == "chrX"
+    assert (
+        describe_task({"files_to_merge": [], "out_filepath": "/tmp/merging-1"})
+        == "merging-1"
+    )
+    assert describe_task("/data/manhattan/a.json") == "/data/manhattan/a.json"
+
+
+def test_worker_pool_is_reused(tmp_path, monkeypatch, capsys):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    monkeypatch.setitem(conf.overrides, "num_procs", 2)
+    pool = WorkerPool(2, 1)
+    try:
+        monkeypatch.setattr(load_utils, "_worker_pool", None)
+        monkeypatch.setattr(load_utils, "_worker_pool_pid", None)
+        load_utils.use_worker_pool(pool, 0)
+        pool_pids = set(p.pid for p in pool.procs)
+        for x in [1, 2]:
+            # Each run sends the current overrides to the workers.
+            monkeypatch.setitem(conf.overrides, "x", x)
+            rets = list(
+                Parallelizer().run_single_tasks(
+                    [{"n": n} for n in range(10)], get_pid_and_override
+                )
+            )
+            assert sorted(ret["task"]["n"] for ret in rets) == list(range(10))
+            assert set(ret["value"][0] for ret in rets) <= pool_pids
+            assert set(ret["value"][1] for ret in rets) == {x}
+        assert "working on 9\n" in capsys.readouterr().out
+
+        # Functions that can't be pickled run in their own processes.
+        rets = list(
+            Parallelizer().run_single_tasks([{"n": 3}], lambda task: os.getpid())
+        )
+        assert rets[0]["value"] not in pool_pids | {os.getpid()}
+    finally:
+        pool.close()
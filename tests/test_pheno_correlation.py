@@ -11,8 +11,7 @@ import shutil
 import pytest
 
 from pheweb.load import pheno_correlation
-from pheweb import weetabix
-
+from pheweb import conf, weetabix
 
 # Simplified files for testing purposes
 CORREL_FILE = os.path.join(
@@ -32,9 +31,12 @@ def sample_data(tmpdir_factory):
 
 
 @pytest.fixture(scope="module")
-def annotated_sample(sample_data):
+def annotated_sample(sample_data, tmpdir_factory):
     output_fn = str(sample_data) + ".out"
-    pheno_correlation.main(sample_data, output_fn, phenolist_path=PHENOLIST)
+    # Keep the temporary symmetric file out of the current directory.
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setitem(conf.overrides, "data_dir", str(tmpdir_factory.mktemp("data")))
+        pheno_correlation.main(sample_data, output_fn, phenolist_path=PHENOLIST)
     return output_fn
 
 
@@ -0,0 +1,66 @@
+"""Test that the phenolist is only re-parsed when pheno-list.json changes, and that `pheno-list-info.bin` matches it"""
+
+import json
+import os
+
+from pheweb import conf
+from pheweb import utils
+from pheweb import file_utils
+from pheweb.file_utils import PhenoInfoReader, get_pheno_info_reader
+
+
+def write_phenolist(filepath, phenolist):
+    with open(filepath, "w") as f:
+        json.dump(phenolist, f)
+
+
+def test_get_phenolist_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "_phenolist_cache", {})
+    filepath = str(tmp_path / "pheno-list.json")
+    write_phenolist(
+        filepath, [{"phenocode": "a b", "assoc_files": ["a.tsv"], "num_cases": 5}]
+    )
+    phenolist = utils.get_phenolist(filepath)
+    assert phenolist == [{"phenocode": "a+b", "assoc_files": ["a.tsv"], "num_cases": 5}]
+    # Changing the returned dicts doesn't change the cache.
+    phenolist[0]["phenostring"] = "A B"
+    assert utils.get_phenolist(filepath) == [
+        {"phenocode": "a+b", "assoc_files": ["a.tsv"], "num_cases": 5}
+    ]
+
+    write_phenolist(filepath, [{"phenocode": "c", "assoc_files": ["c.tsv"]}])
+    os.utime(filepath, ns=(1, 1))
+    assert utils.get_phenolist(filepath) == [
+        {"phenocode": "c", "assoc_files": ["c.tsv"]}
+    ]
+
+
+def test_pheno_info_reader(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    monkeypatch.setattr(utils, "_phenolist_cache", {})
+    monkeypatch.setattr(file_utils, "_pheno_info_reader", None)
+    phenolist = [
+        {"phenocode": "p{}".format(i), "assoc_files": ["x"], "num_cases": i}
+        for i in range(20)
+    ]
+    phenolist[3]["phenostring"] = "Ünïcödé"
+    write_phenolist(str(tmp_path / "pheno-list.json"), phenolist)
+
+    reader = get_pheno_info_reader()
+    assert reader.phenocodes == [p["phenocode"] for p in phenolist]
+    for pheno in phenolist:
+        assert pheno["phenocode"] in reader
+        assert reader[pheno["phenocode"]] == {
+            k: v for k, v in pheno.items() if k != "assoc_files"
+        }
+    assert "p20" not in reader
+    assert get_pheno_info_reader() is reader
+
+    # A changed pheno-list.json re-makes the file.
+    write_phenolist(str(tmp_path / "pheno-list.json"), phenolist[:2])
+    os.utime(str(tmp_path / "pheno-list.json"), ns=(1, 1))
+    assert get_pheno_info_reader().phenocodes == ["p0", "p1"]
+    monkeypatch.setattr(file_utils, "_pheno_info_reader", None)
+    assert get_pheno_info_reader().phenocodes == ["p0", "p1"]
+
+    assert PhenoInfoReader(PhenoInfoReader.serialize([], (0, 0, 0))).phenocodes == []
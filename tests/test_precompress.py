@@ -0,0 +1,38 @@
+"""Test that `pheweb precompress` makes exact copies, and only re-makes them when the original changes"""
+
+import gzip
+import os
+
+from pheweb import conf
+from pheweb.load import precompress
+
+
+def test_precompress_file(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    filepath = str(tmp_path / "a.json")
+    data = b'{"variant_bins": []}' * 100
+    with open(filepath, "wb") as f:
+        f.write(data)
+    os.utime(filepath, (1, 1))
+    assert precompress.get_stale_encodings(filepath) == list(
+        precompress.get_compressors()
+    )
+
+    precompress.precompress_file(filepath)
+    assert precompress.get_stale_encodings(filepath) == []
+    with open(filepath + ".gz", "rb") as f:
+        gzipped = f.read()
+    assert gzip.decompress(gzipped) == data
+    if precompress.brotli is not None:
+        with open(filepath + ".br", "rb") as f:
+            assert precompress.brotli.decompress(f.read()) == data
+
+    # The same file always gets the same copy.
+    precompress.precompress_file(filepath)
+    os.utime(filepath, (2 * 10**9, 2 * 10**9))
+    assert precompress.get_stale_encodings(filepath) == list(
+        precompress.get_compressors()
+    )
+    precompress.precompress_file(filepath)
+    with open(filepath + ".gz", "rb") as f:
+        assert f.read() == gzipped
@@ -0,0 +1,77 @@
+"""Test that `pheweb process` runs each step after the steps it depends on"""
+
+import os
+import signal
+import time
+
+import pytest
+
+from pheweb import conf
+from pheweb.utils import PheWebError
+from pheweb.load import load_utils, process_assoc_files
+
+
+def test_get_plan():
+    plan = process_assoc_files.get_plan(process_assoc_files.scripts)
+    assert list(plan) == process_assoc_files.scripts
+    for idx, script in enumerate(process_assoc_files.scripts):
+        assert all(dep in process_assoc_files.scripts[:idx] for dep in plan[script])
+    assert plan["make_gene_aliases_sqlite3"] == ["phenolist verify"]
+    assert plan["sites"] == ["parse_input_files"]
+
+    # Skipped scripts are replaced by the scripts they depend on.
+    plan = process_assoc_files.get_plan(
+        [s for s in process_assoc_files.scripts if s != "parse_input_files"]
+    )
+    assert plan["sites"] == ["phenolist verify"]
+    assert plan["augment_phenos"] == ["add_genes"]
+
+
+def test_run_scripts(tmp_path, monkeypatch, capsys):
+    monkeypatch.setitem(conf.overrides, "num_procs", 2)
+    log_filepath = str(tmp_path / "log")
+
+    def fake_run_script_in_child(script, out_fd):
+        os.write(out_fd, "hello from {}\npartial".format(script).encode())
+        with open(log_filepath, "a") as f:
+            f.write("start {}\n".format(script))
+        time.sleep(0.2)
+        with open(log_filepath, "a") as f:
+            f.write("end {}\n".format(script))
+        if script == "c":
+            raise Exception("c failed")
+
+    monkeypatch.setattr(
+        process_assoc_files, "_run_script_in_child", fake_run_script_in_child
+    )
+    with pytest.raises(PheWebError):
+        process_assoc_files.run_scripts({"a": [], "b": [], "c": ["a"], "d": ["c"]})
+    with open(log_filepath) as f:
+        log = f.read().split("\n")
+    # `a` and `b` run at the same time, `c` runs after `a`, and `d` doesn't run.
+    assert set(log[:2]) == {"start a", "start b"}
+    assert log.index("start c") > log.index("end a")
+    assert "start d" not in log
+    out = capsys.readouterr().out
+    assert "[a] hello from a\n" in out and "[a] partial\n" in out
+    assert "==> `pheweb c` failed" in out
+
+
+def test_run_scripts_stops_when_a_worker_dies(monkeypatch, capsys):
+    monkeypatch.setitem(conf.overrides, "num_procs", 2)
+
+    def fake_run_script_in_child(script, out_fd):
+        if script == "sites":
+            os.kill(load_utils._get_worker_pool().procs[0].pid, signal.SIGKILL)
+        time.sleep(30)
+
+    monkeypatch.setattr(
+        process_assoc_files, "_run_script_in_child", fake_run_script_in_child
+    )
+    start_time = time.time()
+    with pytest.raises(PheWebError):
+        process_assoc_files.run_scripts({"sites": [], "add_rsids": ["sites"]})
+    assert time.time() - start_time < 10
+    out = capsys.readouterr().out
+    assert "==> A worker process died" in out
+    assert "`pheweb sites` failed" in out
@@ -0,0 +1,56 @@
+"""Check that ChunkedAssocFileReader gives the same results as AssocFileReader"""
+
+import glob
+import os
+
+import pytest
+
+from pheweb.load.read_input_file import AssocFileReader, ChunkedAssocFileReader
+
+
+def _read(reader_class, filepath, pheno, minimum_maf):
+    variants = []
+    try:
+        for variant in reader_class(filepath, pheno).get_variants(
+            minimum_maf=minimum_maf
+        ):
+            variants.append([(k, v, type(v)) for k, v in variant.items()])
+    except Exception as exc:
+        return variants, (type(exc), str(exc))
+    return variants, None
+
+
+@pytest.mark.parametrize(
+    "filepath",
+    sorted(
+        glob.glob(os.path.join(os.path.dirname(__file__), "input_files/assoc-files/*"))
+    ),
+)
+def test_chunked_matches_python(filepath, monkeypatch):
+    monkeypatch.setattr(ChunkedAssocFileReader, "chunk_num_lines", 7)
+    for pheno in [{}, {"num_samples": 1000}]:
+        for minimum_maf in [0, 0.2]:
+            assert _read(ChunkedAssocFileReader, filepath, pheno, minimum_maf) == _read(
+                AssocFileReader, filepath, pheno, minimum_maf
+            )
+
+
+def test_chunked_errors_match_python(tmp_path, monkeypatch):
+    monkeypatch.setattr(ChunkedAssocFileReader, "chunk_num_lines", 4)
+    header = "chrom\tpos\tref\talt\tpval\tbeta\taf\n"
+    good_lines = [
+        "1\t{}\tA\tG\t0.{}\tNA\t0.97\n".format(100 + i, i + 1) for i in range(6)
+    ]
+    for bad_line in [
+        "1\t200\tA\tG\t1.5\t0.1\t0.2\n",  # pval out of range
+        "1\t200\tA\tG\t0.5\tx\t0.2\n",  # not a float
+        "1\t200.5\tA\tG\t0.5\t0.1\t0.2\n",  # not an int
+        "1\t200\tA\tG\t0.5\t0.1\n",  # too few values
+        "1\t200\tA\tG\tNA\t0.1\t7\n",  # af out of range
+    ]:
+        filepath = str(tmp_path / "a.tsv")
+        with open(filepath, "w") as f:
+            f.write(header + "".join(good_lines) + bad_line + good_lines[0])
+        python_result = _read(AssocFileReader, filepath, {}, 0)
+        assert python_result[1] is not None
+        assert _read(ChunkedAssocFileReader, filepath, {}, 0) == python_result
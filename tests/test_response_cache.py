@@ -0,0 +1,47 @@
+"""Test that the filtered Manhattan response cache keeps the most-recently-used bodies"""
+
+import os
+
+from pheweb import conf
+from pheweb.serve.server_utils import ResponseCache, dumps_json
+
+
+def test_response_cache(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    made = []
+
+    def make(key):
+        made.append(key)
+        return dumps_json({"key": key, "padding": "x" * 80})
+
+    cache = ResponseCache("test", max_memory_bytes=250, max_disk_bytes=10**6)
+    body = cache.get_or_make(["a", 1], lambda: make("a"))
+    assert cache.get_or_make(["a", 1], lambda: make("a")) == body
+    assert made == ["a"]
+    assert cache.get_or_make(["a", 2], lambda: make("a2")) != body
+    assert made == ["a", "a2"]
+
+    # "a" is evicted from memory, but another process (or a restart) can still read it from disk.
+    cache.get_or_make(["b"], lambda: make("b"))
+    assert len(cache._memory) == 2
+    restarted_cache = ResponseCache("test", max_memory_bytes=0, max_disk_bytes=10**6)
+    assert restarted_cache.get_or_make(["a", 1], lambda: make("a")) == body
+    assert made == ["a", "a2", "b"]
+
+
+def test_response_cache_disk_eviction(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    cache = ResponseCache("test", max_memory_bytes=0, max_disk_bytes=1000)
+    for i in range(20):
+        cache.get_or_make([i], lambda: b"x" * 100)
+    dirpath = tmp_path / "generated-by-pheweb" / "response-cache" / "test"
+    sizes = [os.path.getsize(str(fp)) for fp in dirpath.iterdir()]
+    assert 0 < sum(sizes) <= 1000
+    # The newest response is still there.
+    made = []
+    cache.get_or_make([19], lambda: made.append(1) or b"y")
+    assert made == []
+
+    disabled_cache = ResponseCache("disabled", max_memory_bytes=0, max_disk_bytes=0)
+    assert disabled_cache.get_or_make([1], lambda: b"z") == b"z"
+    assert not (dirpath.parent / "disabled").exists()
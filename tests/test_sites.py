@@ -0,0 +1,71 @@
+"""Test merging parsed files into the list of sites"""
+
+import gzip
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileWriter
+from pheweb.load import sites
+from pheweb.load.load_utils import update_annotated_variant_file
+
+
+def write_parsed(filepath, variants):
+    with VariantFileWriter(str(filepath), use_gzip=False) as writer:
+        writer.write_all(
+            dict(chrom=chrom, pos=pos, ref=ref, alt=alt, pval=0.5)
+            for chrom, pos, ref, alt in variants
+        )
+
+
+def test_heap_merge_unions_variants(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    write_parsed(tmp_path / "a", [("1", 10, "A", "G"), ("2", 5, "C", "T")])
+    write_parsed(tmp_path / "b", [("1", 10, "A", "G"), ("1", 10, "A", "T")])
+    write_parsed(tmp_path / "c", [("1", 9, "G", "C"), ("X", 1, "A", "G")])
+    (tmp_path / "empty").write_text("chrom\tpos\tref\talt\tpval\n")
+    files = [
+        {"type": "input", "filepath": str(tmp_path / name)}
+        for name in ["a", "b", "empty", "c"]
+    ]
+    out_filepath = str(tmp_path / "merged.tsv.gz")
+    warnings = list(sites.heap_merge(files, out_filepath))
+    assert len(warnings) == 1 and "empty" in warnings[0]["warning_str"]
+    with gzip.open(out_filepath, "rt") as f:
+        assert f.read().splitlines() == [
+            "chrom\tpos\tref\talt",
+            "1\t9\tG\tC",
+            "1\t10\tA\tG",
+            "1\t10\tA\tT",
+            "2\t5\tC\tT",
+            "X\t1\tA\tG",
+        ]
+
+
+def test_update_annotated_variant_file(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, "data_dir", str(tmp_path))
+    in_filepath, out_filepath = str(tmp_path / "in.tsv"), str(tmp_path / "out.tsv")
+    with VariantFileWriter(in_filepath, use_gzip=False) as writer:
+        writer.write_all(
+            dict(chrom=chrom, pos=pos, ref="A", alt="G")
+            for chrom, pos in [("1", 5), ("1", 10), ("2", 3), ("X", 1), ("X", 7)]
+        )
+    with VariantFileWriter(out_filepath, use_gzip=False) as writer:
+        writer.write_all(
+            dict(chrom=chrom, pos=pos, ref="A", alt="G", rsids="old")
+            for chrom, pos in [("1", 10), ("X", 1)]
+        )
+
+    def annotate(variants):
+        for v in variants:
+            v["rsids"] = "new"
+            yield v
+
+    assert update_annotated_variant_file(in_filepath, out_filepath, annotate) == 3
+    with gzip.open(out_filepath, "rt") as f:
+        assert f.read().splitlines() == [
+            "chrom\tpos\tref\talt\trsids",
+            "1\t5\tA\tG\tnew",
+            "1\t10\tA\tG\told",
+            "2\t3\tA\tG\tnew",
+            "X\t1\tA\tG\told",
+            "X\t7\tA\tG\tnew",
+        ]